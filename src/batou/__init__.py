@@ -5,8 +5,6 @@ import socket
 import traceback
 from typing import List, Optional
 
-import jinja2
-
 from ._output import output
 
 # Configure `remote-pdb` to be used with `breakpoint()` in Python 3.7+:
@@ -50,6 +48,20 @@ def prepare_traceback_from_stack(stack):
     return "".join(traceback.format_list(new_stack))
 
 
+def _freeze(value):
+    """Return a hashable equivalent of `value` that compares equal to the
+    frozen versions of all values that are equal to `value`."""
+    if isinstance(value, dict):
+        return ("dict", frozenset((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return ("set", frozenset(_freeze(v) for v in value))
+    if isinstance(value, list):
+        return ("list", tuple(_freeze(v) for v in value))
+    if isinstance(value, tuple):
+        return ("tuple", tuple(_freeze(v) for v in value))
+    return value
+
+
 class ReportingException(Exception):
     """Exceptions that support user-readable reporting."""
 
@@ -78,6 +90,23 @@ class ReportingException(Exception):
         dict_other.pop("affected_hostname", None)
         return dict_self == dict_other
 
+    def merge_key(self):
+        """
+        returns a hashable key that is equal for all exceptions that should
+        be merged, or None if `should_merge` has to be used instead.
+        """
+        if type(self).should_merge is not ReportingException.should_merge:
+            # Customized merging can not be expressed as a key.
+            return None
+        attributes = self.__dict__.copy()
+        attributes.pop("affected_hostname", None)
+        try:
+            key = (type(self), _freeze(attributes))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
     @classmethod
     def merge(cls, selfs):
         """Merge multiple instances of this exception."""
@@ -966,6 +995,8 @@ class TemplatingError(ReportingException):
 
     @classmethod
     def from_context(cls, exception, template_identifier):
+        import jinja2
+
         self = cls()
         self.exception_str = prepare_error(exception)
         self.template_identifier = template_identifier
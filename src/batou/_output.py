@@ -5,10 +5,10 @@ from batou.remote_core import Output
 
 
 class TerminalBackend(object):
-    def __init__(self):
+    def __init__(self, file=None):
         import py.io
 
-        self._tw = py.io.TerminalWriter(sys.stdout)
+        self._tw = py.io.TerminalWriter(file or sys.stdout)
 
         if os.environ.get("IN_TOX_TEST") == "1":
             self._tw.fullwidth = 80
@@ -34,6 +34,55 @@ class NullBackend(object):
         pass
 
 
+class LineWriter(object):
+    """Pass only complete lines on to a file, so that the lines of processes
+    that write to the same file are not mixed up."""
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ""
+
+    def write(self, text):
+        self.buffer += text
+        if "\n" in self.buffer:
+            lines, _, self.buffer = self.buffer.rpartition("\n")
+            self.file.write(lines + "\n")
+            self.file.flush()
+
+    def flush(self):
+        # Complete lines are flushed when they are written.
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class PrefixBackend(object):
+    """Prefix the output of another backend, e.g. to tell apart the output
+    of environments that are deployed at the same time."""
+
+    def __init__(self, backend, prefix):
+        self.backend = backend
+        self.prefix = prefix
+
+    def _prefix_lines(self, text):
+        return "".join(
+            f"{self.prefix}: {line}" for line in text.splitlines(True)
+        )
+
+    def line(self, message, **format):
+        self.backend.line(
+            "\n".join(f"{self.prefix}: {line}" for line in message.split("\n")),
+            **format,
+        )
+
+    def sep(self, sep, title, **format):
+        self.backend.sep(sep, f"{self.prefix}: {title}", **format)
+
+    def write(self, content, **format):
+        self.backend.write(self._prefix_lines(content), **format)
+
+
 class TestBackend(object):
     def __init__(self):
         self.output = ""
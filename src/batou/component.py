@@ -403,6 +403,7 @@ class Component(object):
                 if not predict_only:
                     with self.timer.step("update"):
                         self.update()
+                    self.invalidate_host_caches()
                 self.changed = True
 
         output.clear_buffer()
@@ -459,6 +460,17 @@ class Component(object):
         """
         pass
 
+    def invalidate_host_caches(self):
+        """Forget state of the host that may have been changed by
+        ``update``.
+
+        This is called after ``update``. Components that know exactly what
+        they changed can override this to keep more of the host's caches.
+
+        """
+        self.host.probe_cache.invalidate()
+        self.host.stat_cache.invalidate()
+
     def last_updated(self):
         """When this component was last updated, given as a timestamp (
         seconds since epoch in local time on the system).
@@ -819,6 +831,8 @@ class Component(object):
         communicate=True,
         env=None,
         expand=True,
+        stream=False,
+        log=None,
     ):
         """Perform a (shell) command.
 
@@ -851,6 +865,14 @@ class Component(object):
 
         :param dict env: Extends environment variables with given ones.
 
+        :param bool stream: Show the output line by line while the command
+            is running instead of collecting it. Only the last lines of
+            stdout and stderr are kept and returned. Use this for
+            long-running commands with a lot of output, e.g. builds.
+
+        :param str log: Write the full output of a streamed command to this
+            file.
+
         :return: (stdout, stderr) if ``communicate`` is ``True``,
             otherwise the  :py:class:`Popen` process is returned.
 
@@ -860,7 +882,32 @@ class Component(object):
         """
         if expand:
             cmd = self.expand(cmd)
-        return batou.utils.cmd(cmd, silent, ignore_returncode, communicate, env)
+        return batou.utils.cmd(
+            cmd,
+            silent,
+            ignore_returncode,
+            communicate,
+            env,
+            stream=stream,
+            log=log,
+        )
+
+    def probe(self, cmd, ignore_returncode=False, env=None, expand=True):
+        """Perform a read-only (shell) command and remember its result.
+
+        Use this instead of :py:meth:`cmd` for commands that only inspect
+        the system, e.g. during ``verify``. Components running the same
+        command in the same directory on a host share its result until any
+        component on the host has been updated.
+
+        The parameters and the return value are the same as for
+        :py:meth:`cmd`. A failing command raises
+        :py:class:`CmdExecutionError` each time its result is used.
+
+        """
+        if expand:
+            cmd = self.expand(cmd)
+        return self.host.probe_cache.cmd(cmd, ignore_returncode, env)
 
     def map(self, path):
         """Perform a VFS mapping on the given path.
@@ -1,31 +1,60 @@
 import asyncio
+import contextlib
+import importlib
+import multiprocessing
+import os
 import pickle
+import queue
 import random
 import sys
 import threading
 import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from batou import (
     ConfigurationError,
     ReportingException,
     SilentConfigurationError,
+    remote_core,
+)
+from batou._output import (
+    LineWriter,
+    PrefixBackend,
+    TerminalBackend,
+    output,
 )
-from batou._output import TerminalBackend, output
 
 from .environment import Environment
-from .utils import Timer, locked, notify, self_id
+from .utils import Timer, locked, notify, self_id, shared_files_locked
 
 
 class Connector(threading.Thread):
-    def __init__(self, host, sem):
+    def __init__(self, host, sem, finished=None, provisioning=None):
         self.host = host
         self.sem = sem
         self.exc_info = None
+        # A queue that receives this connector once it is done.
+        self.finished = finished
+        # The future of the host's provisioning that needs to finish
+        # before connecting.
+        self.provisioning = provisioning
         super(Connector, self).__init__(name=host.name)
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            if self.finished is not None:
+                self.finished.put(self)
+
+    def _run(self):
+        if self.provisioning is not None:
+            try:
+                self.provisioning.result()
+            except Exception:
+                self.exc_info = sys.exc_info()
+                return
         tries = 0
         while True:
             tries += 1
@@ -54,6 +83,115 @@ class Connector(threading.Thread):
             raise exc_value.with_traceback(exc_tb)
 
 
+class RecordingChannel(object):
+    """Stands in for the execnet channel of `remote_core` and records the
+    output that is sent through it."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+
+def configure_locally(host_name, calls):
+    """Set up the deployment of a single host in a worker process with the
+    `remote_core` calls that a `LocalHost` sends through its channel.
+
+    Returns the pickled errors and the recorded output.
+
+    """
+    channel = remote_core.channel = RecordingChannel()
+    with output.prefix(host_name):
+        for name, args in calls:
+            result = getattr(remote_core, name)(*args)
+    return result, channel.messages
+
+
+class LocalCheck(object):
+    """Configures a host for the local consistency check in a worker
+    process. Can be used in place of a `Connector`.
+
+    """
+
+    def __init__(self, host, future, finished=None):
+        self.host = host
+        self.future = future
+        self.errors = None
+        if finished is not None:
+            future.add_done_callback(lambda _: finished.put(self))
+
+    def join(self):
+        self.errors, messages = self.future.result()
+        for _, method, args, format in messages:
+            getattr(output.backend, method)(*args, **format)
+
+
+class ErrorClasses(object):
+    """Groups the errors reported by hosts into classes of errors that
+    should be merged.
+
+    Errors are grouped by their merge key. Only errors without a key are
+    compared pairwise with `should_merge`. Errors may be added in any order,
+    the classes are ordered by the smallest `position` of their errors.
+
+    """
+
+    def __init__(self):
+        self.classes = []
+        self._positions = []
+        self._by_key = {}
+        self._without_key = []
+
+    def _find(self, error, key):
+        if key is not None:
+            return self._by_key.get(key)
+        should_merge = getattr(error, "should_merge", None)
+        if should_merge is None:
+            return None
+        for index in self._without_key:
+            if should_merge(self.classes[index][0][1]):
+                return index
+        return None
+
+    def add(self, hostname, error, position=()):
+        merge_key = getattr(error, "merge_key", None)
+        key = merge_key() if merge_key else None
+        index = self._find(error, key)
+        if index is None:
+            index = len(self.classes)
+            self.classes.append([])
+            self._positions.append(position)
+            if key is not None:
+                self._by_key[key] = index
+            else:
+                self._without_key.append(index)
+        self.classes[index].append((hostname, error))
+        self._positions[index] = min(self._positions[index], position)
+
+    def merged(self):
+        """Return a list of (reporting_hostnames, affected_hostnames, error)
+        tuples, one for each class."""
+        merged_errors = []
+        for _, equivalence_class in sorted(
+            zip(self._positions, self.classes), key=lambda x: x[0]
+        ):
+            reporting_hostnames = set(
+                hostname for hostname, _ in equivalence_class
+            )
+            merged_error, affected_hostnames = type(
+                equivalence_class[0][1]
+            ).merge([e for _, e in equivalence_class])
+            merged_errors.append(
+                (
+                    reporting_hostnames,
+                    affected_hostnames,
+                    merged_error,
+                )
+            )
+        return merged_errors
+
+
 class ConfigureErrors(ReportingException):
     def __init__(self, errors, all_reporting_hostnames):
         self.errors = errors  # in the format of [(set[reporting_hostnames], set[affected_hostnames], error)]
@@ -104,6 +242,15 @@ class ConfigureErrors(ReportingException):
 class Deployment(object):
     _upstream = None
 
+    # Number of hosts that are provisioned at the same time.
+    provision_workers = 5
+    # Disabled if the repository was already verified for several
+    # environments at once.
+    verify_repository = True
+    # Number of processes for the local consistency check (default: one
+    # per CPU).
+    check_workers = None
+
     def __init__(
         self,
         environment,
@@ -131,6 +278,11 @@ class Deployment(object):
         self.jobs = jobs
 
         self.timer = Timer("deployment")
+        # Futures of hosts that are being provisioned, by host name.
+        self._provisioning = {}
+        # Worker processes of the local consistency check, shut down when
+        # disconnecting.
+        self._check_pool = None
 
     @property
     def local_consistency_check(self):
@@ -160,34 +312,61 @@ class Deployment(object):
 
         # This is located here to avoid duplicating the verification check
         # when loading the repository on the remote environment object.
-        output.step("main", "Verifying repository ...", icon="🔍")
-        self.environment.repository.verify()
+        if self.verify_repository:
+            output.step("main", "Verifying repository ...", icon="🔍")
+            self.environment.repository.verify()
 
         output.step("main", "Loading secrets ...", icon="🔑")
-        self.environment.load_secrets()
+        # Environments that are deployed at the same time decrypt their
+        # secrets one after the other, so passphrase prompts don't mix.
+        with shared_files_locked(self.environment.base_dir):
+            self.environment.load_secrets()
 
     def provision(self):
+        """Start provisioning the hosts in the background.
+
+        Each host connects as soon as its own provisioning finished.
+
+        """
         if not self.environment.provisioners:
             return
+        hosts = [
+            host
+            for _, host in sorted(self.environment.hosts.items())
+            if host.provisioner
+        ]
+        if not hosts:
+            return
         output.section("Provisioning hosts ...")
-        for host in self.environment.hosts.values():
-            if host.provisioner:
-                output.step(
-                    host.name,
-                    "Provisioning with `{}` provisioner. {}".format(
-                        host.provisioner.name,
-                        "(Rebuild)" if host.provisioner.rebuild else "",
-                    ),
-                    icon="🧱",
-                )
-                host.provisioner.provision(host)
+        pool = ThreadPoolExecutor(
+            max_workers=min(self.provision_workers, len(hosts)),
+            thread_name_prefix="provision",
+        )
+        for host in hosts:
+            output.step(
+                host.name,
+                "Provisioning with `{}` provisioner. {}".format(
+                    host.provisioner.name,
+                    "(Rebuild)" if host.provisioner.rebuild else "",
+                ),
+                icon="🧱",
+            )
+            self._provisioning[host.name] = pool.submit(
+                self._provision_host, host
+            )
+        # Don't wait here: the pool finishes the submitted hosts.
+        pool.shutdown(wait=False)
 
-    def _connections(self):
+    def _provision_host(self, host):
+        with output.prefix(host.name):
+            host.provisioner.provision(host)
+
+    def _connections(self, finished=None):
         self.environment.prepare_connect()
         if self.local_consistency_check:
-            hosts = sorted(self.environment.hosts)[:1]
-        else:
-            hosts = sorted(self.environment.hosts)
+            yield from self._local_checks(finished)
+            return
+        hosts = sorted(self.environment.hosts)
         sem = threading.Semaphore(5)
         for i, hostname in enumerate(hosts, 1):
             host = self.environment.hosts[hostname]
@@ -202,20 +381,43 @@ class Deployment(object):
                     icon="⏭️",
                 )
                 continue
-            if not self.local_consistency_check:
-                output.step(
-                    hostname,
-                    "Connecting via {} ({}/{})".format(
-                        self.environment.connect_method,
-                        i,
-                        len(hosts),
-                    ),
-                    icon="🌐",
-                )
-            c = Connector(host, sem)
+            output.step(
+                hostname,
+                "Connecting via {} ({}/{})".format(
+                    self.environment.connect_method,
+                    i,
+                    len(hosts),
+                ),
+                icon="🌐",
+            )
+            c = Connector(host, sem, finished, self._provisioning.get(hostname))
             c.start()
             yield c
 
+    def _local_checks(self, finished=None):
+        """Configure the model for all hosts in local worker processes,
+        each pretending to be the host it checks."""
+        hosts = [
+            host
+            for _, host in sorted(self.environment.hosts.items())
+            if not host.ignore
+        ]
+        if not hosts:
+            return
+        # Provisioning and resolving run in threads by now, so the workers
+        # are spawned instead of forked.
+        pool = self._check_pool = ProcessPoolExecutor(
+            max_workers=min(
+                self.check_workers or os.cpu_count() or 1, len(hosts)
+            ),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        for host in hosts:
+            future = pool.submit(
+                configure_locally, host.name, host.setup_calls()
+            )
+            yield LocalCheck(host, future, finished)
+
     def connect(self):
         if self.consistency_only and self.environment.check_and_predict_local:
             output.section("LOCAL CONSISTENCY CHECK")
@@ -224,54 +426,40 @@ class Deployment(object):
         # Consume the connection iterator to start all remaining connections
         # but do not wait for them to be joined.
         with self.timer.step("connect"):
-            self.connections = list(self._connections())
-            [c.join() for c in self.connections]
-        all_errors = []
-        all_reporting_hostnames = set()
-        for c in self.connections:
-            errors = pickle.loads(c.errors)
-            reporting_hostname = c.host.name
-            all_reporting_hostnames.add(reporting_hostname)
-            all_errors.extend([(reporting_hostname, e) for e in errors])
-            # collects all errors into (reporting_hostname, error) tuples
+            # Resolve the hosts once for all remotes, they receive the
+            # addresses along with the resolver overrides.
+            self.environment.prefetch_addresses()
+            finished = queue.Queue()
+            self.connections = list(self._connections(finished))
+            # Group the errors of each host as soon as it is configured.
+            error_classes = ErrorClasses()
+            all_reporting_hostnames = set()
+            failures = []
+            for _ in self.connections:
+                c = finished.get()
+                try:
+                    c.join()
+                except Exception as e:
+                    # Keep configuring the other hosts.
+                    failures.append(e)
+                    continue
+                all_reporting_hostnames.add(c.host.name)
+                host_position = self.connections.index(c)
+                for i, error in enumerate(pickle.loads(c.errors)):
+                    error_classes.add(c.host.name, error, (host_position, i))
+        if failures:
+            # Report all hosts that could not be connected.
+            self.environment.exceptions.extend(failures[1:])
+            raise failures[0]
         # if there are no connections, then we append a ConfigurationError
         if not self.connections:
             raise ConfigurationError.from_context(
                 "No host found in environment."
             )
         # if there are no errors, we're done
-        if not all_errors:
+        if not error_classes.classes:
             return
-        # collect with .should_merge
-        errors_by_equivalence_class = []
-        for hostname, error in all_errors:
-            # check wether it fits into an existing equivalence class
-            for equivalence_class in errors_by_equivalence_class:
-                # they are non-empty
-                if error.should_merge(equivalence_class[0][1]):
-                    equivalence_class.append((hostname, error))
-                    break
-            else:
-                # no existing equivalence class fits, create a new one
-                errors_by_equivalence_class.append([(hostname, error)])
-        # now we have a list of equivalence classes of errors
-        # we can merge them into a list of (reporting_hostname, affected_hostnames, error) tuples
-        merged_errors = []
-        for equivalence_class in errors_by_equivalence_class:
-            reporting_hostnames = set(
-                hostname for hostname, _ in equivalence_class
-            )
-            merged_error, affected_hostnames = type(
-                equivalence_class[0][1]
-            ).merge([e for _, e in equivalence_class])
-            merged_errors.append(
-                (
-                    reporting_hostnames,
-                    affected_hostnames,
-                    merged_error,
-                )
-            )
-
+        merged_errors = error_classes.merged()
         merged_errors.sort(key=lambda e: getattr(e[2], "sort_key", (-99,)))
         raise ConfigureErrors(merged_errors, all_reporting_hostnames)
 
@@ -374,6 +562,151 @@ class Deployment(object):
         output.step("main", "Disconnecting from nodes ...", debug=True)
         for node in list(self.environment.hosts.values()):
             node.disconnect()
+        if self._check_pool is not None:
+            self._check_pool.shutdown()
+
+
+def report_failure(exceptions, summary):
+    """Report the exceptions of a failed deployment and exit."""
+    # Note: There is a similar sorting / output routine in
+    # remote_core __channelexec__. This is a bit of copy/paste
+    # due to the way bootstrapping works
+    exceptions = list(
+        filter(
+            lambda e: not isinstance(e, SilentConfigurationError),
+            exceptions,
+        )
+    )
+
+    exceptions.sort(key=lambda x: getattr(x, "sort_key", (-99,)))
+
+    exception = ""
+    for exception in exceptions:
+        # if isinstance(exception, ReportingException):
+        # since at least one or two exceptions have to be duck typed:
+        if hasattr(exception, "report"):
+            output.line("")
+            exception.report()
+        else:
+            output.line("")
+            output.error("Unexpected exception")
+            tb = traceback.TracebackException.from_exception(exception)
+            for line in tb.format():
+                output.line("\t" + line.strip(), red=True)
+
+    output.section(summary, red=True)
+
+    notify(summary, str(exception))
+    sys.exit(1)
+
+
+def run(deployment, steps, action, success_format):
+    environment = deployment.environment
+    try:
+        for step in steps:
+            try:
+                getattr(deployment, step)()
+            except Exception as e:
+                environment.exceptions.append(e)
+
+            if not environment.exceptions:
+                continue
+
+            report_failure(
+                environment.exceptions,
+                "{} FAILED (during {})".format(action, step),
+            )
+
+    finally:
+        deployment.disconnect()
+    output.section("{} FINISHED".format(action), **success_format)
+    notify("{} SUCCEEDED".format(action), environment.name)
+
+
+def verify_repositories(deployments):
+    """Verify the repository of each deployment, but only once for
+    deployments that share the same repository settings."""
+    verified = set()
+    for deployment in deployments:
+        environment = deployment.environment
+        repository = environment.load_repository()
+        key = (
+            type(repository),
+            repository.root,
+            getattr(repository, "branch", None),
+            environment.repository_url,
+        )
+        if key in verified:
+            continue
+        output.step(environment.name, "Verifying repository ...", icon="🔍")
+        repository.verify()
+        verified.add(key)
+
+
+def _run_prefixed(deployment, debug, steps, action, success_format):
+    # Spawned processes start with fresh module state.
+    from batou.main import DEBUG_MODULES
+
+    output.enable_debug = debug
+    for name in DEBUG_MODULES:
+        importlib.import_module(name).debug = debug
+    # Write whole lines so the output of the environments is interleaved
+    # line by line.
+    output.backend = PrefixBackend(
+        TerminalBackend(LineWriter(sys.stdout)), deployment.environment.name
+    )
+    run(deployment, steps, action, success_format)
+
+
+def run_concurrently(deployments, steps, action, success_format):
+    """Run the deployments of several environments in parallel processes.
+
+    The repositories are verified once before the processes are started.
+    Each process prefixes its output with the name of its environment.
+
+    """
+    output.section("Preparing")
+    try:
+        verify_repositories(deployments)
+    except Exception as e:
+        report_failure([e], "{} FAILED (during verify)".format(action))
+
+    # The environments use module-level state (e.g. the resolver) which
+    # is why they are deployed in separate processes. The processes are
+    # spawned instead of forked: forking is unsafe on macOS and for
+    # processes that run threads.
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for deployment in deployments:
+        deployment.verify_repository = False
+        process = context.Process(
+            target=_run_prefixed,
+            args=(
+                deployment,
+                output.enable_debug,
+                steps,
+                action,
+                success_format,
+            ),
+            name=deployment.environment.name,
+        )
+        # Avoid that the children repeat output that is still buffered.
+        sys.stdout.flush()
+        process.start()
+        processes.append(process)
+
+    failed = []
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            failed.append(process.name)
+
+    if failed:
+        summary = "{} FAILED ({})".format(action, ", ".join(failed))
+        output.section(summary, red=True)
+        notify(summary, "")
+        sys.exit(1)
+    output.section("{} FINISHED".format(action), **success_format)
 
 
 def main(
@@ -408,66 +741,37 @@ def main(
             sys.exit(1)
         ACTION += " (local)"
 
-    with locked(".batou-lock", exit_on_failure=True):
-        deployment = Deployment(
-            environment,
-            platform,
-            timeout,
-            dirty,
-            jobs,
-            consistency_only,
-            predict_only,
-            check_and_predict_local,
-            provision_rebuild,
-        )
-        environment = deployment.environment
-        try:
-            for step in STEPS:
-                try:
-                    getattr(deployment, step)()
-                except Exception as e:
-                    environment.exceptions.append(e)
-
-                if not environment.exceptions:
-                    continue
-
-                # Note: There is a similar sorting / output routine in
-                # remote_core __channelexec__. This is a bit of copy/paste
-                # due to the way bootstrapping works
-                environment.exceptions = list(
-                    filter(
-                        lambda e: not isinstance(e, SilentConfigurationError),
-                        environment.exceptions,
-                    )
-                )
-
-                environment.exceptions.sort(
-                    key=lambda x: getattr(x, "sort_key", (-99,))
+    if isinstance(environment, str):
+        environments = [environment]
+    else:
+        environments = list(dict.fromkeys(environment))
+
+    # Each environment has its own lock so that different environments
+    # can be deployed at the same time.
+    os.makedirs(".batou", exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        for name in environments:
+            stack.enter_context(
+                locked(
+                    os.path.join(".batou", "{}.lock".format(name)),
+                    exit_on_failure=True,
                 )
-
-                exception = ""
-                for exception in environment.exceptions:
-                    # if isinstance(exception, ReportingException):
-                    # since at least one or two exceptions have to be duck typed:
-                    if hasattr(exception, "report"):
-                        output.line("")
-                        exception.report()
-                    else:
-                        output.line("")
-                        output.error("Unexpected exception")
-                        tb = traceback.TracebackException.from_exception(
-                            exception
-                        )
-                        for line in tb.format():
-                            output.line("\t" + line.strip(), red=True)
-
-                summary = "{} FAILED (during {})".format(ACTION, step)
-                output.section(summary, red=True)
-
-                notify(summary, str(exception))
-                sys.exit(1)
-
-        finally:
-            deployment.disconnect()
-        output.section("{} FINISHED".format(ACTION), **SUCCESS_FORMAT)
-        notify("{} SUCCEEDED".format(ACTION), environment.name)
+            )
+        deployments = [
+            Deployment(
+                name,
+                platform,
+                timeout,
+                dirty,
+                jobs,
+                consistency_only,
+                predict_only,
+                check_and_predict_local,
+                provision_rebuild,
+            )
+            for name in environments
+        ]
+        if len(deployments) == 1:
+            run(deployments[0], STEPS, ACTION, SUCCESS_FORMAT)
+        else:
+            run_concurrently(deployments, STEPS, ACTION, SUCCESS_FORMAT)
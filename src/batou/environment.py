@@ -5,6 +5,8 @@ import os
 import os.path
 import pathlib
 import sys
+import tempfile
+import time
 from configparser import RawConfigParser
 from importlib.metadata import entry_points
 from typing import Dict, List, Set
@@ -26,6 +28,7 @@ from batou import (
     SilentConfigurationError,
     SuperfluousComponentSection,
     SuperfluousSection,
+    TemplatingError,
     UnknownComponentConfigurationError,
     UnsatisfiedResources,
     UnusedComponentsInitialized,
@@ -95,6 +98,26 @@ class Config(object):
             return default
 
 
+def load_components(base_dir):
+    """Load the component definitions of a deployment.
+
+    Returns a dict of component definitions by name and a list of errors
+    of component files that could not be loaded.
+
+    """
+    components = {}
+    errors = []
+    for filename in sorted(
+        glob.glob(os.path.join(base_dir, "components/*/component.py"))
+    ):
+        try:
+            components.update(load_components_from_file(filename))
+        except Exception as e:
+            exc_type, ex, tb = sys.exc_info()
+            errors.append(ComponentLoadingError.from_context(filename, e, tb))
+    return components, errors
+
+
 class Environment(object):
     """An environment assigns components to hosts and provides
     environment-specific configuration for components.
@@ -111,6 +134,8 @@ class Environment(object):
     timeout = None
     target_directory = None
     jobs = None
+    artifact_cache = None
+    resolver_cache_ttl = None
 
     require_v4 = True
     require_v6 = False
@@ -120,6 +145,10 @@ class Environment(object):
 
     provision_rebuild = False
 
+    # The deployment (on the controller or on a remote host) that uses this
+    # environment.
+    deployment = None
+
     host_factory = Host
 
     def __init__(
@@ -143,6 +172,7 @@ class Environment(object):
         self.check_and_predict_local = check_and_predict_local
 
         self.hostname_mapping: Dict[str, str] = {}
+        self._resolver_cache_expires = {}
 
         # These are the component classes, decorated with their
         # name.
@@ -158,6 +188,8 @@ class Environment(object):
 
         self.provisioners: Dict[str, Provisioner] = {}
 
+        self._artifacts = None
+
     @classmethod
     def all(cls):
         for path in pathlib.Path("environments").glob("*/environment.cfg"):
@@ -187,9 +219,23 @@ class Environment(object):
         if not os.path.isdir(self._environment_path()):
             os.makedirs(self._environment_path())
 
+    @property
+    def artifacts(self):
+        """The store for downloaded artifacts in this environment's work
+        directory."""
+        if self._artifacts is None:
+            from batou.lib.download import ArtifactStore
+
+            self._artifacts = ArtifactStore(
+                os.path.join(self.workdir_base, ".artifacts")
+            )
+        return self._artifacts
+
     def load(self):
         batou.utils.resolve_override.clear()
         batou.utils.resolve_v6_override.clear()
+        batou.utils.resolve_cache.clear()
+        batou.utils.resolve_v6_cache.clear()
 
         config_file = (
             pathlib.Path(self.base_dir)
@@ -211,16 +257,9 @@ class Environment(object):
                     self.hostname_mapping[k] = v
 
         # Scan all components
-        for filename in sorted(
-            glob.glob(os.path.join(self.base_dir, "components/*/component.py"))
-        ):
-            try:
-                self.components.update(load_components_from_file(filename))
-            except Exception as e:
-                exc_type, ex, tb = sys.exc_info()
-                self.exceptions.append(
-                    ComponentLoadingError.from_context(filename, e, tb)
-                )
+        components, errors = load_components(self.base_dir)
+        self.components.update(components)
+        self.exceptions.extend(errors)
 
         config = Config(config_file)
 
@@ -228,6 +267,7 @@ class Environment(object):
         self.load_provisioners(config)
         self.load_hosts(config)
         self.load_resolver(config)
+        self.load_resolver_cache()
 
         # load overrides
         for section in config:
@@ -262,6 +302,19 @@ class Environment(object):
             self.base_dir, self.repository.root
         )
 
+    def load_repository(self):
+        """Set up the repository without loading the whole environment.
+
+        This allows verifying a repository once for several environments.
+
+        """
+        config_file = self._environment_path("environment.cfg")
+        if not os.path.exists(config_file):
+            raise MissingEnvironment.from_context(self)
+        self.load_environment(Config(config_file))
+        self.repository = Repository.from_environment(self)
+        return self.repository
+
     def load_secrets(self):
         self.secret_provider = SecretProvider.from_environment(self)
         self.secret_provider.inject_secrets()
@@ -281,6 +334,8 @@ class Environment(object):
             "repository_url",
             "repository_root",
             "jobs",
+            "artifact_cache",
+            "resolver_cache_ttl",
         ]:
             if key not in environment:
                 continue
@@ -340,6 +395,77 @@ class Environment(object):
         batou.utils.resolve_override.update(v4)
         batou.utils.resolve_v6_override.update(v6)
 
+    @property
+    def _resolver_cache_path(self):
+        return os.path.join(
+            self.base_dir, ".batou", "resolver-cache-{}.json".format(self.name)
+        )
+
+    def load_resolver_cache(self):
+        """Fill the resolver caches with the unexpired addresses that were
+        stored by previous runs."""
+        self._resolver_cache_expires = {}
+        if not self.resolver_cache_ttl:
+            return
+        try:
+            with open(self._resolver_cache_path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for version, cache in [
+            ("v4", batou.utils.resolve_cache),
+            ("v6", batou.utils.resolve_v6_cache),
+        ]:
+            for host, (address, expires) in stored.get(version, {}).items():
+                if expires <= now:
+                    continue
+                cache[host] = address
+                self._resolver_cache_expires[version, host] = expires
+
+    def save_resolver_cache(self):
+        """Store the resolved addresses for `resolver_cache_ttl` seconds."""
+        if not self.resolver_cache_ttl:
+            return
+        expires = time.time() + int(self.resolver_cache_ttl)
+        stored = {}
+        for version, cache in [
+            ("v4", batou.utils.resolve_cache),
+            ("v6", batou.utils.resolve_v6_cache),
+        ]:
+            stored[version] = {
+                host: [
+                    address,
+                    self._resolver_cache_expires.get((version, host), expires),
+                ]
+                for host, address in batou.utils.resolved_addresses(
+                    cache
+                ).items()
+            }
+        path = self._resolver_cache_path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Several deployments may store their caches concurrently.
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=os.path.basename(path) + "."
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(stored, f, sort_keys=True)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def prefetch_addresses(self):
+        """Resolve the names of all hosts in parallel, so configuring
+        the model finds them in the resolver cache."""
+        batou.utils.prefetch_addresses(
+            [host.fqdn for host in self.hosts.values() if not host.ignore],
+            v4=bool(batou.utils.Address.require_v4),
+            v6=bool(batou.utils.Address.require_v6),
+        )
+        self.save_resolver_cache()
+
     def load_provisioners(self, config):
         self.provisioners = {}
         if self.check_and_predict_local:
@@ -570,7 +696,7 @@ class Environment(object):
             root_dependencies = self.root_dependencies()
             try:
                 order = batou.utils.topological_sort(
-                    batou.utils.revert_graph(root_dependencies)
+                    root_dependencies, reverse=True
                 )
             except CycleError as e:
                 exceptions.append(CycleErrorDetected.from_context(e))
@@ -618,10 +744,49 @@ class Environment(object):
         for root in order:
             root.log_finish_configure()
 
+        if not exceptions:
+            exceptions.extend(self.render_contents())
+
         self.exceptions.extend(exceptions)
 
         return self.exceptions
 
+    def render_contents(self):
+        """Render the file contents of all root components that this
+        process deploys and return the errors that occurred.
+
+        Configure passes only record the inputs of templates. Rendering them
+        once after the model converged keeps reporting template errors as
+        configuration errors, while a remote host only spends time on its
+        own components.
+
+        """
+        from batou.lib.file import ManagedContentBase
+
+        host_name = getattr(self.deployment, "host_name", None)
+        exceptions = []
+        for root in self.root_components:
+            if root.ignore or root.host.ignore:
+                continue
+            if host_name is not None and root.host.name != host_name:
+                continue
+            for component in root.component.recursive_sub_components:
+                if not isinstance(component, ManagedContentBase):
+                    continue
+                try:
+                    component.render_content()
+                except (ConfigurationError, TemplatingError) as e:
+                    exceptions.append(e)
+                except Exception as e:
+                    ex_type, ex, tb = sys.exc_info()
+                    exceptions.append(
+                        UnknownComponentConfigurationError.from_context(
+                            root, e, tb
+                        )
+                    )
+                    break
+        return exceptions
+
     def root_dependencies(self, host=None):
         """Return all roots (host/component) with their direct dependencies.
 
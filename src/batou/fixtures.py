@@ -46,6 +46,9 @@ def pytest_assertrepr_compare(op, left, right):
 def reset_resolve_overrides():
     batou.utils.resolve_override.clear()
     batou.utils.resolve_v6_override.clear()
+    batou.utils.resolve_cache.clear()
+    batou.utils.resolve_v6_cache.clear()
+    batou.utils.failed_lookups.clear()
 
 
 @pytest.fixture(autouse=True)
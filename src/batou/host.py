@@ -1,5 +1,6 @@
 import ast
 import os
+import pickle
 import subprocess
 import sys
 
@@ -8,7 +9,7 @@ import yaml
 
 import batou.utils
 from batou import DeploymentError, SilentConfigurationError, output, remote_core
-from batou.utils import BagOfAttributes
+from batou.utils import BagOfAttributes, CmdCache, StatCache
 
 # Keys in os.environ which get propagated to the remote side:
 REMOTE_OS_ENV_KEYS = (
@@ -136,6 +137,11 @@ class Host(object):
         self.rpc = RPCWrapper(self)
         self.environment = environment
 
+        # Results of read-only commands, see `Component.probe`.
+        self.probe_cache = CmdCache()
+        # File metadata used by the components in `batou.lib.file`.
+        self.stat_cache = StatCache()
+
         self.ignore = ast.literal_eval(config.get("ignore", "False"))
 
         self.platform = config.get("platform", environment.platform)
@@ -217,23 +223,34 @@ class LocalHost(Host):
         self.channel = self.gateway.remote_exec(remote_core)
 
     def start(self):
-        self.rpc.lock()
-
-        # Since we reconnected, any state on the remote side has been lost,
-        # so we need to set the target directory again (which we only can
-        # know about locally).
-        self.rpc.setup_output(output.enable_debug)
-
+        results = {}
+        for name, args in self.setup_calls():
+            results[name] = getattr(self.rpc, name)(*args)
+        self.remote_repository = results["ensure_repository"]
+        self.remote_base = results["ensure_base"]
+        return results["setup_deployment"]
+
+    def setup_calls(self):
+        """Return the `remote_core` calls that set up the deployment of this
+        host as `(name, args)` tuples."""
         env = self.environment
+        return [
+            ("lock", ()),
+            # Since we reconnected, any state on the remote side has been
+            # lost, so we need to set the target directory again (which we
+            # only can know about locally).
+            ("setup_output", (output.enable_debug,)),
+            ("ensure_repository", (env.target_directory, "local")),
+            ("ensure_base", (env.deployment_base,)),
+            # XXX the cwd isn't right.
+            ("setup_deployment", self.deployment_args()),
+        ]
 
-        self.remote_repository = self.rpc.ensure_repository(
-            env.target_directory, "local"
-        )
-
-        self.remote_base = self.rpc.ensure_base(env.deployment_base)
-
-        # XXX the cwd isn't right.
-        return self.rpc.setup_deployment(
+    def deployment_args(self):
+        """Return the arguments for a `remote_core.Deployment` of this
+        host."""
+        env = self.environment
+        return (
             env.name,
             self.name,
             env.overrides,
@@ -244,6 +261,9 @@ class LocalHost(Host):
             env._host_data(),
             env.timeout,
             env.platform,
+            None,
+            batou.utils.resolved_addresses(batou.utils.resolve_cache),
+            batou.utils.resolved_addresses(batou.utils.resolve_v6_cache),
         )
 
     def disconnect(self):
@@ -335,7 +355,17 @@ class RemoteHost(Host):
         output.step(self.name, "Updating repository ...", debug=True)
         env.repository.update(self)
 
-        self.rpc.build_batou()
+        # The remote working copy now matches ours, so we can tell whether
+        # the last appenv build on the remote is still current.
+        if self.rpc.appenv_built() == remote_core.appenv_fingerprint(
+            env.base_dir
+        ):
+            output.step(
+                self.name, "Environment up to date, skipping build", debug=True
+            )
+        else:
+            output.step(self.name, "Building environment ...", debug=True)
+            self.rpc.build_batou()
 
         # Now, replace the basic interpreter connection, with a "real" one
         # that has all our dependencies installed.
@@ -356,7 +386,7 @@ class RemoteHost(Host):
         # know about locally)
         self.rpc.setup_output(output.enable_debug)
 
-        return self.rpc.setup_deployment(
+        errors = self.rpc.setup_deployment(
             env.name,
             self.name,
             env.overrides,
@@ -372,7 +402,34 @@ class RemoteHost(Host):
                 for key in REMOTE_OS_ENV_KEYS
                 if os.environ.get(key)
             },
+            batou.utils.resolved_addresses(batou.utils.resolve_cache),
+            batou.utils.resolved_addresses(batou.utils.resolve_v6_cache),
         )
+        if env.artifact_cache == "controller" and not pickle.loads(errors):
+            self.push_artifacts()
+        return errors
+
+    def push_artifacts(self):
+        """Transfer the artifacts that the remote's downloads need from the
+        controller's artifact store.
+
+        Each artifact is downloaded only once by the controller, even if
+        multiple hosts need it.
+
+        """
+        store = self.environment.artifacts
+        for uri, key in self.rpc.missing_artifacts():
+            output.step(
+                self.name,
+                "Transferring artifact {} ...".format(key),
+                debug=True,
+            )
+            offset = 0
+            with open(store.fetch(uri, key), "rb") as f:
+                for chunk in iter(lambda: f.read(store.chunk_size), b""):
+                    self.rpc.receive_artifact(key, chunk, offset)
+                    offset += len(chunk)
+            self.rpc.commit_artifact(key)
 
     def disconnect(self):
         if self.gateway is not None:
@@ -1,10 +1,17 @@
+import functools
+import hashlib
 import itertools
+import json
 import os
 import os.path
 import plistlib
 import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile
 
+import batou
+import batou.utils
 from batou.component import Component
 from batou.lib.file import Directory
 from batou.utils import cmd
@@ -17,6 +24,7 @@ class Extract(Component):
     target = None
 
     strip = 0
+    deep_verify = False
 
     def configure(self):
         self.archive = self.map(self.archive)
@@ -33,6 +41,7 @@ class Extract(Component):
             target=self.target,
             create_target_dir=self.create_target_dir,
             strip=self.strip,
+            deep_verify=self.deep_verify,
         )
         # Testability
         self.extractor = extractor
@@ -45,6 +54,15 @@ class Extract(Component):
 
 
 class Extractor(Component):
+    """Extract an archive and record what was extracted in a manifest.
+
+    The manifest contains the archive's digest and stat information and
+    the list of extracted files. Verifying an unchanged archive thus only
+    needs to stat the archive and the manifest. With ``deep_verify`` the
+    presence of all extracted files is checked as well.
+
+    """
+
     namevar = "archive"
 
     _supports_strip = False
@@ -53,6 +71,23 @@ class Extractor(Component):
     suffixes = ()
     strip = 0
     target = None
+    deep_verify = False
+
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        update = cls.__dict__.get("update")
+        if update is None:
+            return
+
+        # Subclasses that still extract in `update()` instead of `extract()`
+        # get the manifest written as well, so they don't extract again on
+        # every deployment.
+        @functools.wraps(update)
+        def update_and_write_manifest(self):
+            update(self)
+            self._write_manifest()
+
+        cls.update = update_and_write_manifest
 
     @classmethod
     def can_handle(cls, archive):
@@ -82,25 +117,101 @@ class Extractor(Component):
             self.target = d.path
         else:
             self.target = self.map(".")
+        key = "{}\0{}".format(os.path.abspath(self.archive), self.target)
+        self.manifest = os.path.join(
+            self.workdir,
+            ".batou-extract-{}.json".format(
+                hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+            ),
+        )
 
     def verify(self):
         # If the archive is not there yet, then it will likely be downloaded
         # and thus we'll unpack it.
         assert os.path.exists(self.archive)
-        # Check that all files in the directory are newer than the archive.
-        # XXX Might also have a problem regarding archive attribute
-        # preservation?
+        manifest = self._read_manifest()
+        if manifest is None:
+            raise batou.UpdateNeeded()
+        if manifest.get("strip") != self.strip:
+            raise batou.UpdateNeeded()
+        archive_stat = os.stat(self.archive)
+        unchanged = (
+            manifest["size"] == archive_stat.st_size
+            and manifest["mtime"] == archive_stat.st_mtime_ns
+            and archive_stat.st_ctime <= os.stat(self.manifest).st_mtime
+        )
+        if not unchanged:
+            # The archive was touched. Only extract again if its content
+            # changed.
+            if manifest["digest"] != self._archive_digest():
+                raise batou.UpdateNeeded()
+        # The manifest lives in the work directory, so make sure that the
+        # target was not removed or emptied since.
+        if not os.path.isdir(self.target):
+            raise batou.UpdateNeeded()
+        if self.deep_verify:
+            paths = [os.path.join(self.target, f) for f in manifest["files"]]
+            with ThreadPoolExecutor(16) as pool:
+                if not all(pool.map(os.path.lexists, paths)):
+                    raise batou.UpdateNeeded()
+        else:
+            top_level = {f.split(os.path.sep, 1)[0] for f in manifest["files"]}
+            for name in top_level:
+                if not os.path.lexists(os.path.join(self.target, name)):
+                    raise batou.UpdateNeeded()
+
+    def update(self):
+        self.extract()
+        self._write_manifest()
+
+    def extract(self):
+        """Extract the archive into the target.
+
+        Subclasses implement this and `get_names_from_archive`, which
+        returns the names of the archive's members. Subclasses that override
+        `update()` instead are supported as well.
+
+        """
+        raise NotImplementedError()
+
+    def get_extracted_files(self):
+        """Return the paths of all extracted files relative to the target."""
         for filename in self.get_names_from_archive():
-            filename = os.path.join(*filename.split(os.path.sep)[self.strip :])
-            filename = os.path.join(self.target, filename)
-            if os.path.isdir(filename):
-                # We can't compare the ctime of things like / or other
-                # directories that might be outside of our control as their
-                # ctimes won't change when extracting over them.
+            parts = filename.split(os.path.sep)[self.strip :]
+            if not parts or not parts[-1]:
+                # Stripped away completely or a directory entry.
                 continue
-            self.assert_file_is_current(
-                filename, [self.archive], key="st_ctime"
-            )
+            filename = os.path.join(*parts)
+            if os.path.isdir(os.path.join(self.target, filename)):
+                continue
+            yield filename
+
+    def _archive_digest(self):
+        return batou.utils.hash(self.archive, "sha256")
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self):
+        archive_stat = os.stat(self.archive)
+        manifest = dict(
+            archive=os.path.abspath(self.archive),
+            digest=self._archive_digest(),
+            size=archive_stat.st_size,
+            mtime=archive_stat.st_mtime_ns,
+            strip=self.strip,
+            files=sorted(set(self.get_extracted_files())),
+        )
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(self.manifest), prefix=".batou-extract-"
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+        os.rename(tmp, self.manifest)
 
     @property
     def namevar_for_breadcrumb(self):
@@ -114,7 +225,7 @@ class Unzip(Extractor):
         with ZipFile(self.archive) as f:
             return f.namelist()
 
-    def update(self):
+    def extract(self):
         self.cmd(
             self.expand(
                 "unzip -o {{component.archive}} -d {{component.target}}"
@@ -140,7 +251,7 @@ class Untar(Extractor):
         )
         return stdout.splitlines()
 
-    def update(self):
+    def extract(self):
         self.cmd(
             "tar xf {{component.archive}} -C {{component.target}} "
             "--strip-components {{component.strip}}"
@@ -161,7 +272,9 @@ class DMGVolume(object):
     def namelist(self):
         for root, dirnames, filenames in os.walk(self.volume_path):
             for name in itertools.chain(dirnames, filenames):
-                yield os.path.join(root, name)
+                yield os.path.relpath(
+                    os.path.join(root, name), self.volume_path
+                )
 
     def copy_to(self, target_dir):
         if os.path.exists(target_dir):
@@ -208,5 +321,5 @@ class DMGExtractor(Extractor):
     def get_names_from_archive(self):
         return self.volume.namelist()
 
-    def update(self):
+    def extract(self):
         self.volume.copy_to(os.path.join(self.workdir, self.target))
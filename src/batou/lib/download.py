@@ -1,5 +1,11 @@
+import hashlib
+import json
+import os
 import os.path
+import threading
 import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
@@ -12,6 +18,27 @@ try:
 except ImportError:
     from urllib.request import urlretrieve
 
+CHUNK_SIZE = 4 * 1024**2
+
+# Ranges that are fetched in parallel are at least this large.
+RANGE_MIN_SIZE = 16 * 1024**2
+
+
+_sessions = threading.local()
+
+
+def http_session():
+    """The HTTP session shared by the downloads of the current thread to
+    reuse connections.
+
+    Sessions are not thread-safe, so every thread uses its own.
+
+    """
+    session = getattr(_sessions, "session", None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    return session
+
 
 class Download(Component):
     namevar = "uri"
@@ -19,6 +46,7 @@ class Download(Component):
     target = None  # Filename where the download will be stored.
     checksum = None
     requests_kwargs = None
+    parallel = 1  # Number of ranges to fetch in parallel via HTTP(S).
 
     def configure(self):
         if not self.target:
@@ -35,19 +63,24 @@ class Download(Component):
     def verify(self):
         if not os.path.exists(self.target):
             raise batou.UpdateNeeded()
-        if self.checksum != batou.utils.hash(
-            self.target, self.checksum_function
-        ):
+        if self.checksum != self._target_checksum():
             raise batou.UpdateNeeded()
 
     def update(self):
         scheme = urllib.parse.urlsplit(self.uri)[0]
-        if scheme in ["http", "https"]:
-            self._update_requests()
+        artifacts = self._artifacts
+        if artifacts is not None and self.artifact in artifacts:
+            # Content-addressed and verified when it was added to the store.
+            artifacts.copy(self.artifact, self.target)
+            target_checksum = self.checksum
+        elif scheme in ["http", "https"]:
+            target_checksum = self._update_requests()
         else:
             self._update_urllib()
+            target_checksum = batou.utils.hash(
+                self.target, self.checksum_function
+            )
 
-        target_checksum = batou.utils.hash(self.target, self.checksum_function)
         assert self.checksum == target_checksum, """\
 Checksum mismatch!
 expected: %s
@@ -55,21 +88,171 @@ got: %s""" % (
             self.checksum,
             target_checksum,
         )
+        self._store_checksum(target_checksum)
+
+    @property
+    def artifact(self):
+        """The key of this download in an :py:class:`ArtifactStore`."""
+        return "{}:{}".format(self.checksum_function, self.checksum)
+
+    @property
+    def _artifacts(self):
+        # Downloads that are not attached to an environment (e.g. in tests)
+        # do not have an artifact store.
+        if getattr(self, "parent", None) is None:
+            return None
+        return self.environment.artifacts
+
+    def is_current(self):
+        if not os.path.isdir(self.workdir):
+            return False
+        with self.chdir(self.workdir):
+            try:
+                self.verify()
+            except batou.UpdateNeeded:
+                return False
+        return True
 
     def _update_requests(self):
-        r = requests.get(
-            self.uri, **(self.requests_kwargs if self.requests_kwargs else {})
+        # Downloads go to a separate file first so that an interrupted
+        # transfer can be resumed later on.
+        part = self.target + ".part"
+        if self.parallel > 1 and self._fetch_ranges(part):
+            checksum = batou.utils.hash(part, self.checksum_function)
+        else:
+            checksum = self._fetch_resumable(part)
+        os.replace(part, self.target)
+        return checksum
+
+    def _get(self, method="get", **headers):
+        kw = dict(self.requests_kwargs or {})
+        headers.update(kw.pop("headers", None) or {})
+        return getattr(http_session(), method)(
+            self.uri, headers=headers, stream=True, **kw
         )
+
+    def _fetch_resumable(self, part):
+        h = getattr(hashlib, self.checksum_function)()
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset:
+            r = self._get(Range="bytes={}-".format(offset))
+            if r.status_code == 416:
+                # Nothing left to fetch if the partial download is complete.
+                if r.headers.get("Content-Range") == "bytes */{}".format(
+                    offset
+                ):
+                    return batou.utils.hash(part, self.checksum_function)
+                offset = 0
+            elif r.status_code != 206 or not r.headers.get(
+                "Content-Range", ""
+            ).startswith("bytes {}-".format(offset)):
+                offset = 0
+            if not offset:
+                r.close()
+        if not offset:
+            r = self._get()
         r.raise_for_status()
 
-        with open(self.target, "wb") as fd:
-            for chunk in r.iter_content(4 * 1024**2):
+        # Compute the checksum while streaming to avoid reading the
+        # file again afterwards.
+        with open(part, "r+b" if offset else "wb") as fd:
+            if offset:
+                for chunk in iter(lambda: fd.read(CHUNK_SIZE), b""):
+                    h.update(chunk)
+            for chunk in r.iter_content(CHUNK_SIZE):
                 fd.write(chunk)
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _fetch_ranges(self, part):
+        """Fetch the download with parallel range requests.
+
+        Returns False if the server does not support range requests or the
+        download is too small to be worth splitting.
+
+        """
+        r = self._get("head")
+        size = int(r.headers.get("Content-Length", 0))
+        if (
+            not r.ok
+            or r.headers.get("Accept-Ranges") != "bytes"
+            or size < 2 * RANGE_MIN_SIZE
+        ):
+            return False
+        count = min(self.parallel, size // RANGE_MIN_SIZE)
+        bounds = [size * i // count for i in range(count + 1)]
+
+        def fetch(start, end):
+            r = self._get(Range="bytes={}-{}".format(start, end - 1))
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RuntimeError(
+                    "Server ignored range request for {}".format(
+                        self.namevar_for_breadcrumb
+                    )
+                )
+            with open(part, "r+b") as fd:
+                fd.seek(start)
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    fd.write(chunk)
+
+        with open(part, "wb") as fd:
+            fd.truncate(size)
+        try:
+            with ThreadPoolExecutor(count) as pool:
+                list(pool.map(fetch, bounds[:-1], bounds[1:]))
+        except BaseException:
+            # A sparse partial file can not be resumed.
+            os.unlink(part)
+            raise
+        return True
 
     def _update_urllib(self):
         path, headers = urlretrieve(self.uri, self.target)
         assert path == self.target
 
+    # The verified checksum of the target is cached in a sidecar file and
+    # is considered valid as long as the target's inode, size, and mtime
+    # do not change. This avoids hashing large artifacts on every deployment.
+
+    @property
+    def _checksum_cache(self):
+        head, tail = os.path.split(self.target)
+        return os.path.join(head, ".{}.batou-checksum".format(tail))
+
+    def _checksum_cache_key(self):
+        st = os.stat(self.target)
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def _target_checksum(self):
+        try:
+            with open(self._checksum_cache) as f:
+                cache = json.load(f)
+            if cache["key"] == self._checksum_cache_key():
+                checksum = cache["checksums"].get(self.checksum_function)
+                if checksum:
+                    return checksum
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        checksum = batou.utils.hash(self.target, self.checksum_function)
+        if checksum == self.checksum:
+            self._store_checksum(checksum)
+        return checksum
+
+    def _store_checksum(self, checksum):
+        try:
+            cache = dict(
+                key=self._checksum_cache_key(),
+                checksums={self.checksum_function: checksum},
+            )
+            tmp = self._checksum_cache + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, self._checksum_cache)
+        except OSError:
+            # The cache is an optimization only.
+            pass
+
     @property
     def namevar_for_breadcrumb(self):
         uri = self.uri
@@ -78,3 +261,115 @@ got: %s""" % (
             # Indeed, this is a very simple approach.
             uri = uri.replace(password, "*****")
         return uri
+
+
+def iter_uri(uri, chunk_size, requests_kwargs=None):
+    """Yield the content of `uri` in chunks."""
+    scheme = urllib.parse.urlsplit(uri)[0]
+    if scheme in ["http", "https"]:
+        r = http_session().get(uri, stream=True, **(requests_kwargs or {}))
+        r.raise_for_status()
+        yield from r.iter_content(chunk_size)
+    else:
+        with urllib.request.urlopen(uri) as f:
+            yield from iter(lambda: f.read(chunk_size), b"")
+
+
+class ArtifactStore(object):
+    """A content-addressed store for downloaded artifacts.
+
+    Artifacts are identified by their checksum in the ``function:hexdigest``
+    format used by :py:class:`Download` and are only added to the store after
+    their content has been verified.
+
+    """
+
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fetching = {}
+
+    def _path(self, key):
+        function, checksum = key.split(":")
+        return os.path.join(self.path, function, checksum)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def copy(self, key, target):
+        with open(self._path(key), "rb") as src, open(target, "wb") as dst:
+            for chunk in iter(lambda: src.read(self.chunk_size), b""):
+                dst.write(chunk)
+
+    def _commit(self, key, part, got):
+        function, checksum = key.split(":")
+        if got != checksum:
+            os.unlink(part)
+            raise ValueError(
+                "Checksum mismatch for artifact {}, got: {}".format(key, got)
+            )
+        os.replace(part, self._path(key))
+
+    def fetch(self, uri, key, requests_kwargs=None):
+        """Download `uri` into the store unless `key` is already present.
+
+        Concurrent fetches of the same key download it only once.
+        Returns the path of the artifact in the store.
+
+        """
+        with self._lock:
+            lock = self._fetching.setdefault(key, threading.Lock())
+        with lock:
+            path = self._path(key)
+            if os.path.exists(path):
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            h = getattr(hashlib, key.split(":")[0])()
+            with open(path + ".part", "wb") as f:
+                for chunk in iter_uri(uri, self.chunk_size, requests_kwargs):
+                    f.write(chunk)
+                    h.update(chunk)
+            self._commit(key, path + ".part", h.hexdigest())
+            return path
+
+    def receive(self, key, data, offset):
+        """Write a chunk of an artifact that is transferred in pieces."""
+        part = self._path(key) + ".part"
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        with open(part, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            f.write(data)
+
+    def commit(self, key):
+        """Verify a received artifact and add it to the store."""
+        part = self._path(key) + ".part"
+        open(part, "ab").close()
+        self._commit(key, part, batou.utils.hash(part, key.split(":")[0]))
+
+
+def missing_artifacts(environment, host):
+    """Return `(uri, key)` pairs for all downloads on `host` that are
+    neither current nor available in the environment's artifact store.
+
+    Downloads that need extra `requests_kwargs` (e.g. for authentication)
+    are always fetched by the host itself.
+
+    """
+    missing = {}
+    for root in environment.root_components:
+        if root.host is not host or not hasattr(root, "component"):
+            continue
+        for component in root.component.recursive_sub_components:
+            if not isinstance(component, Download):
+                continue
+            if component.requests_kwargs:
+                continue
+            key = component.artifact
+            if key in missing or key in environment.artifacts:
+                continue
+            if component.is_current():
+                continue
+            missing[key] = component.uri
+    return sorted((uri, key) for key, uri in missing.items())
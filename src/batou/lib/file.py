@@ -1,10 +1,11 @@
 import difflib
+import errno
+import fnmatch
 import glob
-import grp
+import hashlib
 import itertools
 import json
 import os.path
-import pwd
 import re
 import shutil
 import stat
@@ -15,7 +16,7 @@ import yaml
 import batou
 from batou import ComponentUsageError, output
 from batou.component import Attribute, Component
-from batou.utils import dict_merge
+from batou.utils import StatCache, dict_merge
 
 # Explain the logic that in a multi-user and concurrent system there isn't really a coarse grained guarantee around files not existing.
 
@@ -53,13 +54,84 @@ def ensure_path_nonexistent(path: str) -> None:
             pass
 
 
+def stat_cache(component):
+    """Return the file system metadata cache of the component's host.
+
+    Components that are not part of a deployment get a cache of their own.
+
+    """
+    try:
+        return component.host.stat_cache
+    except AttributeError:
+        return StatCache()
+
+
+def invalidate_path(component, path):
+    """Forget the host's cached state of `path` after `component` changed
+    it."""
+    component.host.probe_cache.invalidate()
+    component.host.stat_cache.invalidate(path)
+
+
+def _copy_file_range(src, dst, count):
+    return os.copy_file_range(src, dst, count)
+
+
+def _sendfile(src, dst, count):
+    return os.sendfile(dst, src, None, count)
+
+
+_KERNEL_COPIES = []
+if hasattr(os, "copy_file_range"):
+    _KERNEL_COPIES.append(_copy_file_range)
+if hasattr(os, "sendfile") and os.uname().sysname == "Linux":
+    _KERNEL_COPIES.append(_sendfile)
+
+
+def copy_file(source: str, target: str) -> None:
+    """Copy the content of `source` to `target`.
+
+    An existing target is overwritten in place and keeps its permissions. A
+    new target gets the permissions of the source (subject to the umask).
+
+    The data is copied by the kernel where possible, which allows
+    copy-on-write clones on filesystems that support them.
+    """
+    with open(source, "rb") as src:
+        size = os.fstat(src.fileno()).st_size
+        mode = os.fstat(src.fileno()).st_mode & 0o777
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with open(fd, "wb") as dst:
+            remaining = size
+            for copy in _KERNEL_COPIES:
+                try:
+                    while remaining > 0:
+                        copied = copy(src.fileno(), dst.fileno(), remaining)
+                        if not copied:
+                            break
+                        remaining -= copied
+                except OSError as e:
+                    if e.errno not in (
+                        errno.EXDEV,
+                        errno.ENOSYS,
+                        errno.EINVAL,
+                        errno.EOPNOTSUPP,
+                    ):
+                        raise
+                    continue
+                break
+            # Copy whatever the kernel did not (e.g. on unsupported files).
+            src.seek(size - remaining)
+            dst.seek(size - remaining)
+            shutil.copyfileobj(src, dst)
+
+
 class File(Component):
     namevar = "path"
 
     ensure = "file"  # or: directory, symlink
 
     # Content oriented parameters
-    content = None
     source = ""
     is_template = True
     template_context = None
@@ -80,6 +152,19 @@ class File(Component):
     # Signal that the content is sensitive data.
     sensitive_data = None
 
+    _content_component = None
+
+    @property
+    def content(self):
+        """The content as given or, once configured, as rendered."""
+        if self._prepared and self._content_component is not None:
+            return self._content_component.content
+        return self.__dict__.get("content")
+
+    @content.setter
+    def content(self, value):
+        self.__dict__["content"] = value
+
     def configure(self):
         self._unmapped_path = self.path
         self.path = self.map(self.path)
@@ -144,7 +229,7 @@ class File(Component):
                 sensitive_data=self.sensitive_data,
             )
             self += content
-            self.content = content.content
+            self._content_component = content
 
         if self.owner:
             self += Owner(self.path, owner=self.owner)
@@ -160,9 +245,10 @@ class File(Component):
         return os.path.abspath(self.path)
 
     def last_updated(self, key="st_mtime"):
-        if not os.path.exists(self.path):
+        st = stat_cache(self).stat(self.path)
+        if st is None:
             return None
-        return getattr(os.stat(self.path), key)
+        return getattr(st, key)
 
 
 class BinaryFile(File):
@@ -180,7 +266,8 @@ class Presence(Component):
             self += Directory(os.path.dirname(self.path), leading=self.leading)
 
     def verify(self):
-        assert os.path.isfile(self.path)
+        st = stat_cache(self).stat(self.path)
+        assert st is not None and stat.S_ISREG(st.st_mode)
 
     def update(self):
         ensure_path_nonexistent(self.path)
@@ -188,6 +275,9 @@ class Presence(Component):
             # We're just touching it.
             pass
 
+    def invalidate_host_caches(self):
+        invalidate_path(self, self.path)
+
     @property
     def namevar_for_breadcrumb(self):
         if isinstance(self.parent, File):
@@ -198,18 +288,153 @@ class Presence(Component):
         return os.path.abspath(self.path)
 
     def last_updated(self, key="st_mtime"):
-        if not os.path.exists(self.path):
+        st = stat_cache(self).stat(self.path)
+        if st is None:
             return None
-        return getattr(os.stat(self.path), key)
+        return getattr(st, key)
+
+
+class DigestManifest(object):
+    """Content digests of files, stored in a JSON file and reused as long as
+    the inode, size and modification time of a file did not change.
+
+    The manifest is an optimization only: it is rewritten with the digests
+    that have been used since it was loaded.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(self.path) as f:
+                self.stored = json.load(f)
+        except (OSError, ValueError):
+            self.stored = {}
+        self.used = {}
+
+    def digest(self, path, st):
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        path = os.path.abspath(path)
+        cached = self.stored.get(path)
+        if cached and cached[:3] == key:
+            digest = cached[3]
+        else:
+            digest = batou.utils.hash(path, "sha256")
+        self.used[path] = key + [digest]
+        return digest
+
+    def record(self, path, digest):
+        st = os.stat(path)
+        self.used[os.path.abspath(path)] = [
+            st.st_ino,
+            st.st_size,
+            st.st_mtime_ns,
+            digest,
+        ]
+
+    def forget(self, path):
+        self.used.pop(os.path.abspath(path), None)
+
+    def save(self):
+        if self.used == self.stored:
+            return
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.used, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            # The manifest is an optimization only.
+            return
+        self.stored = dict(self.used)
+
+
+def excluded(patterns, path, is_dir):
+    """Tell whether the relative `path` matches any of the rsync-like
+    exclude `patterns`."""
+    for pattern in patterns:
+        if pattern.endswith("/"):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip("/")
+        if pattern.startswith("/"):
+            if fnmatch.fnmatchcase(path, pattern[1:]):
+                return True
+        elif "/" in pattern:
+            if fnmatch.fnmatchcase(path, pattern) or fnmatch.fnmatchcase(
+                path, "*/" + pattern
+            ):
+                return True
+        elif fnmatch.fnmatchcase(os.path.basename(path), pattern):
+            return True
+    return False
+
+
+def write_atomic(target, data=None, source=None):
+    """Replace `target` with `data` or a copy of the file `source`.
+
+    The content is written to a temporary file next to the target which is
+    then renamed, so the target never has partial content. An existing
+    target keeps its permissions and (if possible) its ownership.
+
+    """
+    directory, name = os.path.split(target)
+    tmp = os.path.join(directory, ".{}.batou-tmp".format(name))
+    ensure_path_nonexistent(tmp)
+    try:
+        if source is not None:
+            copy_file(source, tmp)
+        else:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            with open(fd, "wb") as f:
+                f.write(data)
+        try:
+            current = os.stat(target)
+        except FileNotFoundError:
+            current = None
+        if current is not None and stat.S_ISREG(current.st_mode):
+            os.chmod(tmp, stat.S_IMODE(current.st_mode))
+            try:
+                os.chown(tmp, current.st_uid, current.st_gid)
+            except PermissionError:
+                pass
+        if os.path.isdir(target) and not os.path.islink(target):
+            ensure_path_nonexistent(target)
+        os.replace(tmp, target)
+    except BaseException:
+        ensure_path_nonexistent(tmp)
+        raise
 
 
 class SyncDirectory(Component):
+    """Synchronize the contents of a source directory to a target directory.
+
+    Files are considered unchanged if their size and modification time
+    match. Otherwise their content is compared. Content digests are cached
+    in a manifest in the work directory, so unchanged files are not read
+    again. Files in the target that do not exist in the source are kept.
+
+    If rsync options (`verify_opts` or `sync_opts`) are given, rsync is used
+    instead.
+
+    """
+
     namevar = "path"
     source = None
     exclude = ()
 
-    verify_opts = "-rclnv"
-    sync_opts = "--inplace -lr"
+    # Compare the content of files whose modification time differs.
+    verify_checksums = True
+
+    verify_opts = None
+    sync_opts = None
+
+    rsync_verify_opts = "-rclnv"
+    rsync_sync_opts = "--inplace -lr"
+
+    #: The paths (relative to the target) that need to be synchronized, as
+    #: determined by the last verify().
+    changed_files = None
 
     def configure(self):
         self.path = self.map(self.path)
@@ -220,6 +445,16 @@ class SyncDirectory(Component):
         self.source = os.path.normpath(
             os.path.join(self.root.defdir, self.source)
         )
+        key = hashlib.sha256(
+            "{}\0{}".format(self.source, os.path.abspath(self.path)).encode()
+        ).hexdigest()[:16]
+        self.manifest = os.path.join(
+            self.workdir, ".batou-sync-{}.json".format(key)
+        )
+
+    @property
+    def use_rsync(self):
+        return bool(self.verify_opts or self.sync_opts)
 
     @property
     def exclude_arg(self):
@@ -231,25 +466,124 @@ class SyncDirectory(Component):
         if not os.path.isdir(self.path):
             raise batou.UpdateNeeded()
 
-        stdout, stderr = self.cmd(
-            "rsync {} {}{}/ {}".format(
-                self.verify_opts, self.exclude_arg, self.source, self.path
+        if self.use_rsync:
+            stdout, stderr = self.cmd(
+                "rsync {} {}{}/ {}".format(
+                    self.verify_opts or self.rsync_verify_opts,
+                    self.exclude_arg,
+                    self.source,
+                    self.path,
+                )
             )
-        )
 
-        # In case of we see non-convergent rsync runs
-        output.annotate("rsync result:", debug=True)
-        output.annotate(stdout, debug=True)
+            # In case of we see non-convergent rsync runs
+            output.annotate("rsync result:", debug=True)
+            output.annotate(stdout, debug=True)
+
+            if len(stdout.strip().splitlines()) - 4 > 0:
+                raise batou.UpdateNeeded()
+            return
 
-        if len(stdout.strip().splitlines()) - 4 > 0:
+        self.changed_files = self._changes()
+        for path in self.changed_files:
+            output.annotate("changed: {}".format(path), debug=True)
+        if self.changed_files:
             raise batou.UpdateNeeded()
 
     def update(self):
-        self.cmd(
-            "rsync {} {}{}/ {}".format(
-                self.sync_opts, self.exclude_arg, self.source, self.path
+        if self.use_rsync:
+            self.cmd(
+                "rsync {} {}{}/ {}".format(
+                    self.sync_opts or self.rsync_sync_opts,
+                    self.exclude_arg,
+                    self.source,
+                    self.path,
+                )
             )
-        )
+            return
+
+        if not os.path.isdir(self.path):
+            ensure_path_nonexistent(self.path)
+            os.mkdir(self.path)
+        if self.changed_files is None:
+            self.changed_files = self._changes()
+        for path in self.changed_files:
+            source = os.path.join(self.source, path)
+            target = os.path.join(self.path, path)
+            st = os.lstat(source)
+            if stat.S_ISLNK(st.st_mode):
+                ensure_path_nonexistent(target)
+                os.symlink(os.readlink(source), target)
+            elif stat.S_ISDIR(st.st_mode):
+                ensure_path_nonexistent(target)
+                os.mkdir(target, st.st_mode & 0o777)
+            else:
+                if os.path.islink(target) or (
+                    os.path.lexists(target) and not os.path.isfile(target)
+                ):
+                    ensure_path_nonexistent(target)
+                copy_file(source, target)
+                # Keep the modification time so that the next verify can
+                # tell that the file is unchanged without reading it.
+                os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.changed_files = None
+
+    def _excluded(self, path, is_dir):
+        return excluded(self.exclude, path, is_dir)
+
+    def _changes(self):
+        """Return the paths (relative to the source) of all entries that
+        differ between source and target, parents before their children."""
+        self._digests = DigestManifest(self.manifest)
+
+        changes = []
+        pending = [""]
+        while pending:
+            directory = pending.pop()
+            with os.scandir(os.path.join(self.source, directory)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in reversed(entries):
+                path = os.path.join(directory, entry.name)
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if self._excluded(path, is_dir):
+                    continue
+                target = os.path.join(self.path, path)
+                try:
+                    target_stat = os.lstat(target)
+                except FileNotFoundError:
+                    target_stat = None
+                if entry.is_symlink():
+                    if (
+                        target_stat is None
+                        or not stat.S_ISLNK(target_stat.st_mode)
+                        or os.readlink(target) != os.readlink(entry.path)
+                    ):
+                        changes.append(path)
+                elif is_dir:
+                    if target_stat is None or not stat.S_ISDIR(
+                        target_stat.st_mode
+                    ):
+                        changes.append(path)
+                    pending.append(path)
+                elif not self._same_file(entry, target, target_stat):
+                    changes.append(path)
+
+        self._digests.save()
+        return sorted(changes)
+
+    def _same_file(self, entry, target, target_stat):
+        if target_stat is None or not stat.S_ISREG(target_stat.st_mode):
+            return False
+        source_stat = entry.stat(follow_symlinks=False)
+        if source_stat.st_size != target_stat.st_size:
+            return False
+        if source_stat.st_mtime_ns == target_stat.st_mtime_ns:
+            return True
+        if not self.verify_checksums:
+            return False
+        return self._digests.digest(
+            entry.path, source_stat
+        ) == self._digests.digest(target, target_stat)
 
     @property
     def namevar_for_breadcrumb(self):
@@ -261,6 +595,241 @@ class SyncDirectory(Component):
         return os.path.abspath(self.path)
 
 
+class FileTree(Component):
+    """Manage all files below a directory as a single component.
+
+    The files are taken from a source directory and/or a mapping of relative
+    paths to content. They are verified with a single walk of the target
+    directory, comparing content digests that are cached in a manifest in
+    the work directory. Changed files are replaced atomically.
+
+    """
+
+    namevar = "path"
+
+    # Directory (relative to the definition directory) to take files from.
+    source = None
+    exclude = ()
+
+    # Mapping of relative paths to content (str or bytes). Takes precedence
+    # over files from the source directory.
+    files = None
+
+    is_template = False
+    template_context = None
+    template_args = None
+    encoding = "utf-8"
+
+    # Remove files in the target that are not managed.
+    purge = False
+
+    #: The files (relative to the target) that need to be written, as
+    #: determined by the last verify().
+    changed_files = None
+
+    #: The unmanaged files (relative to the target) that will be purged, as
+    #: determined by the last verify().
+    unmanaged_files = None
+
+    def configure(self):
+        self.path = self.map(self.path)
+        if self.source is None and self.files is None:
+            raise ComponentUsageError.from_context(
+                "FileTree requires a source directory or files."
+            )
+        if self.source is not None:
+            self.source = os.path.normpath(
+                os.path.join(self.root.defdir, self.source)
+            )
+        files = {}
+        for path, content in (self.files or {}).items():
+            normalized = os.path.normpath(path)
+            if (
+                os.path.isabs(normalized)
+                or normalized == "."
+                or normalized.split(os.path.sep)[0] == ".."
+            ):
+                raise ComponentUsageError.from_context(
+                    "FileTree files must be relative paths inside the "
+                    "tree: {}".format(path)
+                )
+            files[normalized] = content
+        self.files = files
+        if self.template_args is None:
+            self.template_args = {}
+        if not self.template_context:
+            self.template_context = self.parent
+        key = hashlib.sha256(os.path.abspath(self.path).encode()).hexdigest()[
+            :16
+        ]
+        self.manifest = os.path.join(
+            self.workdir, ".batou-filetree-{}.json".format(key)
+        )
+
+    def verify(self):
+        self._changes()
+        for path in self.changed_files:
+            output.annotate("changed: {}".format(path), debug=True)
+        for path in self.unmanaged_files:
+            output.annotate("unmanaged: {}".format(path), debug=True)
+        if self.changed_files or self.unmanaged_files:
+            raise batou.UpdateNeeded()
+
+    def update(self):
+        if self.changed_files is None:
+            self._changes()
+        for path in self.changed_files:
+            target = os.path.join(self.path, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if path in self._links:
+                ensure_path_nonexistent(target)
+                os.symlink(self._links[path], target)
+                continue
+            source, data, digest = self._wanted[path]
+            write_atomic(target, data=data, source=source)
+            self._digests.record(target, digest)
+        for path in self.unmanaged_files:
+            target = os.path.join(self.path, path)
+            ensure_path_nonexistent(target)
+            self._digests.forget(target)
+            # Remove directories that became empty.
+            directory = os.path.dirname(target)
+            while directory != self.path and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+        self._digests.save()
+        self.changed_files = self.unmanaged_files = None
+
+    def render(self):
+        """Return the wanted files as a mapping of relative paths to
+        `(source, data, digest)`, where either `source` is the path of a
+        file to copy or `data` the rendered content.
+
+        Symlinks in the source are copied as symlinks. They are collected
+        in `_links`, mapping their relative paths to the link targets.
+
+        """
+        wanted = {}
+        self._links = {}
+        if self.source is not None:
+            for path, st in self._walk(self.source, self.exclude):
+                if stat.S_ISLNK(st.st_mode):
+                    self._links[path] = os.readlink(
+                        os.path.join(self.source, path)
+                    )
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    raise ComponentUsageError.from_context(
+                        "FileTree can not copy special file: {}".format(
+                            os.path.join(self.source, path)
+                        )
+                    )
+                source = os.path.join(self.source, path)
+                if self.is_template:
+                    with open(source, "rb") as f:
+                        wanted[path] = self._render_content(f.read())
+                else:
+                    wanted[path] = (
+                        source,
+                        None,
+                        self._digests.digest(source, st),
+                    )
+        for path, content in self.files.items():
+            self._links.pop(path, None)
+            wanted[path] = self._render_content(content)
+        return wanted
+
+    def _render_content(self, content):
+        if self.is_template:
+            if isinstance(content, bytes):
+                content = content.decode(self.encoding)
+            content = self.expand(
+                content, self.template_context, args=self.template_args
+            )
+        if isinstance(content, str):
+            content = content.encode(self.encoding)
+        return (None, content, hashlib.sha256(content).hexdigest())
+
+    def _walk(self, top, exclude=()):
+        """Yield the relative paths and stats of all non-directory entries
+        below `top`."""
+        pending = [""]
+        while pending:
+            directory = pending.pop()
+            try:
+                it = os.scandir(os.path.join(top, directory))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            with it:
+                for entry in it:
+                    path = os.path.join(directory, entry.name)
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if excluded(exclude, path, is_dir):
+                        continue
+                    if is_dir:
+                        pending.append(path)
+                    else:
+                        yield path, entry.stat(follow_symlinks=False)
+
+    def _changes(self):
+        self._digests = DigestManifest(self.manifest)
+        self._wanted = self.render()
+        # Excluded directories are pruned so that their contents are
+        # neither compared nor purged.
+        current = dict(self._walk(self.path, self.exclude))
+
+        changes = []
+        for path, link in self._links.items():
+            target = os.path.join(self.path, path)
+            st = current.get(path) or self._lstat(target)
+            if (
+                st is None
+                or not stat.S_ISLNK(st.st_mode)
+                or os.readlink(target) != link
+            ):
+                changes.append(path)
+        for path, (source, data, digest) in self._wanted.items():
+            st = current.get(path) or self._lstat(os.path.join(self.path, path))
+            if st is None or not stat.S_ISREG(st.st_mode):
+                changes.append(path)
+                continue
+            size = len(data) if source is None else None
+            if size is not None and size != st.st_size:
+                changes.append(path)
+                continue
+            target = os.path.join(self.path, path)
+            if self._digests.digest(target, st) != digest:
+                changes.append(path)
+        self.changed_files = sorted(changes)
+        self.unmanaged_files = []
+        if self.purge:
+            self.unmanaged_files = sorted(
+                path
+                for path in current
+                if path not in self._wanted and path not in self._links
+            )
+        self._digests.save()
+
+    def _lstat(self, path):
+        try:
+            return os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def last_updated(self, key="st_mtime"):
+        newest = 0  # epoch
+        for path, st in self._walk(self.path):
+            newest = max(newest, getattr(st, key))
+        return newest
+
+    @property
+    def namevar_for_breadcrumb(self):
+        relpath = os.path.relpath(self.path, self.environment.base_dir)
+        if not relpath.startswith(".."):
+            return relpath
+        return os.path.abspath(self.path)
+
+
 class Directory(Component):
     namevar = "path"
     leading = False
@@ -285,7 +854,8 @@ class Directory(Component):
             self += SyncDirectory(self.path, **args)
 
     def verify(self):
-        assert os.path.isdir(self.path)
+        st = stat_cache(self).stat(self.path)
+        assert st is not None and stat.S_ISDIR(st.st_mode)
 
     def update(self):
         ensure_path_nonexistent(self.path)
@@ -294,6 +864,9 @@ class Directory(Component):
         else:
             os.mkdir(self.path)
 
+    def invalidate_host_caches(self):
+        invalidate_path(self, self.path)
+
     def last_updated(self, key="st_mtime"):
         newest = 0  # epoch
         for dirpath, dirnames, filenames in os.walk(self.path):
@@ -321,6 +894,9 @@ class FileComponent(Component):
         self.original_path = self.path
         self.path = self.map(self.original_path)
 
+    def invalidate_host_caches(self):
+        invalidate_path(self, self.path)
+
     @property
     def namevar_for_breadcrumb(self):
         if isinstance(self.parent, File):
@@ -373,7 +949,6 @@ class ManagedContentBase(FileComponent):
     Not intended for direct use.
     """
 
-    content = None
     source = ""
     sensitive_data = None
 
@@ -383,11 +958,34 @@ class ManagedContentBase(FileComponent):
     encoding = "utf-8"
 
     _delayed = False
+    _rendered = False
+    _rendering = False
     _max_diff = 200
     _max_diff_lead = 50
 
     _content_source_attribute = "content"
 
+    @property
+    def content(self):
+        """The content to write.
+
+        Once configured, reading the content renders it (see
+        `render_content()`), so other components can inspect it.
+
+        """
+        if (
+            self._prepared
+            and not self._rendered
+            and not self._rendering
+            and not self._delayed
+        ):
+            self.render_content()
+        return self.__dict__.get("content")
+
+    @content.setter
+    def content(self, value):
+        self.__dict__["content"] = value
+
     def configure(self):
         super(ManagedContentBase, self).configure()
 
@@ -412,9 +1010,26 @@ class ManagedContentBase(FileComponent):
             if not self.source.startswith("/"):
                 self.source = os.path.join(self.root.defdir, self.source)
 
-        self._render()
+        # The content is rendered by the host that deploys it, see
+        # `render_content()`.
+
+    def render_content(self, delay=True):
+        """Render the content unless this already happened.
 
-    def _render(self):
+        A source file that does not exist (yet) may be created by other
+        components during the deployment. In that case rendering is retried
+        later if `delay` is true, otherwise an error is raised.
+
+        """
+        if self._rendered:
+            return
+        self._rendering = True
+        try:
+            self._render(delay)
+        finally:
+            self._rendering = False
+
+    def _render(self, delay=True):
         # Phase 1: acquire the source data into self.content
         if self.source:
             if os.path.exists(self.source):
@@ -425,7 +1040,7 @@ class ManagedContentBase(FileComponent):
                 ) as f:
                     self.content = f.read()
             else:
-                if self._delayed:
+                if self._delayed or not delay:
                     raise FileNotFoundError(
                         "Could not find source file {}".format(self.source)
                     )
@@ -444,11 +1059,11 @@ class ManagedContentBase(FileComponent):
         # Phase 4: If we have an encoding, encode the content (again)
         if self.encoding:
             self.content = self.content.encode(self.encoding)
+        self._rendered = True
 
     def verify(self, predicting=False):
         try:
-            if self._delayed:
-                self._render()
+            self.render_content(delay=False)
         except FileNotFoundError:
             if predicting:
                 # During prediction runs we accept that delayed rending may
@@ -534,17 +1149,88 @@ class ManagedContentBase(FileComponent):
         raise batou.UpdateNeeded()
 
     def update(self):
+        self.render_content(delay=False)
         with open(self.path, "wb") as target:
             target.write(self.content)
 
 
 class Content(ManagedContentBase):
-    """Manage the content of a file - possibly using templating."""
+    """Manage the content of a file - possibly using templating.
+
+    Binary content that is neither templated nor encoded (see
+    :py:class:`BinaryFile`) is copied from its source without being loaded
+    into memory.
+
+    """
 
     is_template = File.is_template
     template_context = None
     template_args = None  # dict, actually
 
+    @property
+    def copies_source(self):
+        return bool(self.source) and not self.is_template and not self.encoding
+
+    def _render(self, delay=True):
+        if not self.copies_source:
+            return super()._render(delay)
+        # Only remember the source. Its content is compared and copied on
+        # the host that deploys this file.
+        if not os.path.exists(self.source):
+            if self._delayed or not delay:
+                raise FileNotFoundError(
+                    "Could not find source file {}".format(self.source)
+                )
+            self._delayed = True
+            return
+        self._delayed = False
+        self._rendered = True
+
+    def verify(self, predicting=False):
+        if not self.copies_source:
+            return super().verify(predicting)
+        try:
+            self.render_content(delay=False)
+        except FileNotFoundError:
+            if predicting:
+                assert False
+            raise
+        source = os.stat(self.source)
+        target = stat_cache(self).stat(self.path)
+        digests = self._digests()
+        try:
+            if (
+                target is not None
+                and stat.S_ISREG(target.st_mode)
+                and target.st_size == source.st_size
+                and digests.digest(self.path, target)
+                == digests.digest(self.source, source)
+            ):
+                return
+        finally:
+            digests.save()
+        output.annotate("Not showing diff for binary data.", yellow=True)
+        raise batou.UpdateNeeded()
+
+    def update(self):
+        if not self.copies_source:
+            return super().update()
+        write_atomic(self.path, source=self.source)
+        digests = self._digests()
+        digest = digests.digest(self.source, os.stat(self.source))
+        digests.record(self.path, digest)
+        digests.save()
+
+    def _digests(self):
+        """The digests of the source and the target, reused as long as
+        the files do not change."""
+        key = hashlib.sha256(os.path.abspath(self.path).encode()).hexdigest()[
+            :16
+        ]
+        return DigestManifest(
+            os.path.join(self.workdir, ".batou-content-{}.json".format(key))
+        )
+
     def render(self):
         if not self.is_template:
             return
@@ -613,10 +1299,11 @@ class Owner(FileComponent):
     owner = None
 
     def verify(self):
-        assert os.path.exists(self.path)
+        st = stat_cache(self).stat(self.path)
+        assert st is not None
         if isinstance(self.owner, str):
-            self.owner = pwd.getpwnam(self.owner).pw_uid
-        assert os.stat(self.path).st_uid == self.owner
+            self.owner = stat_cache(self).uid(self.owner)
+        assert st.st_uid == self.owner
 
     def update(self):
         group = os.stat(self.path).st_gid
@@ -627,10 +1314,11 @@ class Group(FileComponent):
     group = None
 
     def verify(self):
-        assert os.path.exists(self.path)
+        st = stat_cache(self).stat(self.path)
+        assert st is not None
         if isinstance(self.group, str):
-            self.group = grp.getgrnam(self.group).gr_gid
-        assert os.stat(self.path).st_gid == self.group
+            self.group = stat_cache(self).gid(self.group)
+        assert st.st_gid == self.group
 
     def update(self):
         owner = os.stat(self.path).st_uid
@@ -698,18 +1386,20 @@ class Mode(FileComponent):
             # Happens on systems without lstat/lchmod implementation (like
             # Linux) Not sure whether ignoring it is really the right thing.
             return
-        assert os.path.lexists(self.path)
-        current = self._stat(self.path).st_mode
-        assert stat.S_IMODE(current) == self.mode
+        current = self._stat(self.path)
+        assert current is not None
+        assert stat.S_IMODE(current.st_mode) == self.mode
 
     def update(self):
         self._chmod(self.path, self.mode)
 
     def _select_stat_implementation(self):
-        self._stat = os.stat
+        cache = stat_cache(self)
+        self._stat = cache.stat
         self._chmod = os.chmod
-        if os.path.islink(self.path):
-            self._stat = os.lstat
+        link = cache.lstat(self.path)
+        if link is not None and stat.S_ISLNK(link.st_mode):
+            self._stat = cache.lstat
             self._chmod = os.lchmod
 
 
@@ -722,13 +1412,17 @@ class Symlink(Component):
         self.source = self.map(self.source)
 
     def verify(self):
-        assert os.path.islink(self.target)
+        st = stat_cache(self).lstat(self.target)
+        assert st is not None and stat.S_ISLNK(st.st_mode)
         assert os.readlink(self.target) == self.source
 
     def update(self):
         ensure_path_nonexistent(self.target)
         os.symlink(self.source, self.target)
 
+    def invalidate_host_caches(self):
+        invalidate_path(self, self.target)
+
 
 class Purge(Component):
     """Ensure that a set of files (given as a glob) does not exist."""
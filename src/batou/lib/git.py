@@ -1,4 +1,6 @@
+import hashlib
 import os.path
+import weakref
 
 from batou import UpdateNeeded, output
 from batou.component import Component
@@ -25,6 +27,63 @@ def exactly_one(*args):
     return sum(map(bool, args)) == 1
 
 
+# Shared object stores that have been fetched into on each host during this
+# deployment.
+_fetched_stores = weakref.WeakKeyDictionary()
+
+# Determine everything verify() needs to know about a clone with a single
+# shell call: the remote URL (empty if there is no `origin`), the tags
+# pointing at HEAD, and (after a NUL byte) the branch and working tree
+# status.
+PROBE_COMMAND = (
+    "{ git remote get-url origin 2>/dev/null || echo; } && "
+    "git for-each-ref --points-at=HEAD --format='%(refname:short)' "
+    "refs/tags && "
+    "printf '\\0' && "
+    "git status --porcelain=v2 --branch --untracked-files=all -z"
+)
+
+
+def parse_probe(stdout):
+    """Parse the output of `PROBE_COMMAND` into a state dict."""
+    head, status = stdout.split("\0", 1)
+    url, *tags = head.splitlines()
+    state = dict(
+        url=url.strip(),
+        tags=tags,
+        revision=None,
+        branch=None,
+        ahead=0,
+        behind=0,
+        changes=False,
+        untracked=[],
+    )
+    entries = iter(status.split("\0"))
+    for entry in entries:
+        if not entry:
+            continue
+        if entry.startswith("# branch.oid "):
+            revision = entry.split()[2]
+            if revision != "(initial)":
+                state["revision"] = revision
+        elif entry.startswith("# branch.head "):
+            branch = entry.split(None, 2)[2]
+            state["branch"] = "HEAD" if branch == "(detached)" else branch
+        elif entry.startswith("# branch.ab "):
+            ahead, behind = entry.split()[2:4]
+            state["ahead"], state["behind"] = int(ahead), -int(behind)
+        elif entry.startswith("#"):
+            continue
+        else:
+            state["changes"] = True
+            if entry.startswith("? "):
+                state["untracked"].append(entry[2:])
+            elif entry.startswith("2 "):
+                # Renames and copies are followed by the original path.
+                next(entries)
+    return state
+
+
 class Clone(Component):
     namevar = "url"
     target = "."
@@ -44,6 +103,11 @@ class Clone(Component):
         self.target = self.map(self.target)
         self += Directory(self.target)
 
+    # Share git objects between all clones of the same URL on a host.
+    shared_objects = False
+
+    _state = None
+
     def verify(self):
         self._force_clone = False
         if not os.path.exists(self.target):
@@ -55,74 +119,92 @@ class Clone(Component):
             if not os.path.exists(".git"):
                 self._force_clone = True
                 raise UpdateNeeded()
+        # All checks share the state of a single probe.
+        self._state = self.probe_state()
+        try:
+            self._verify_state()
+        finally:
+            self._state = None
 
-            if self.remote_url() != self.url:
-                self._force_clone = True
-                raise UpdateNeeded()
+    def _verify_state(self):
+        if self.remote_url() != self.url:
+            self._force_clone = True
+            raise UpdateNeeded()
 
-            if not self.vcs_update:
-                return
+        if not self.vcs_update:
+            return
 
-            if self.has_outgoing_changesets():
+        if self.has_outgoing_changesets():
+            output.annotate(
+                "Git clone at {} has outgoing changesets.".format(self.target)
+            )
+
+        if self.has_changes():
+            if self.clobber:
                 output.annotate(
-                    "Git clone at {} has outgoing changesets.".format(
+                    "Git clone at {} is dirty, going to lose changes.".format(
                         self.target
-                    )
+                    ),
+                    red=True,
                 )
+                raise UpdateNeeded()
+            else:
+                output.annotate(
+                    "Git clone at {} is dirty - refusing to clobber. "
+                    "Use `clobber=True` if this is intentional .".format(
+                        self.target
+                    ),
+                    red=True,
+                )
+                raise RuntimeError("Refusing to clobber dirty work directory.")
 
-            if self.has_changes():
-                if self.clobber:
-                    output.annotate(
-                        "Git clone at {} is dirty, going to lose changes.".format(
-                            self.target
-                        ),
-                        red=True,
-                    )
-                    raise UpdateNeeded()
-                else:
-                    output.annotate(
-                        "Git clone at {} is dirty - refusing to clobber. "
-                        "Use `clobber=True` if this is intentional .".format(
-                            self.target
-                        ),
-                        red=True,
-                    )
-                    raise RuntimeError(
-                        "Refusing to clobber dirty work directory."
-                    )
+        if self.revision and self.current_revision() != self.revision:
+            raise UpdateNeeded()
+        if self.branch and (
+            self.current_branch() != self.branch
+            or self.has_incoming_changesets()
+        ):
+            raise UpdateNeeded()
+        if self.tag and (
+            self.tag not in self.state()["tags"]
+            or self.has_incoming_changesets()
+        ):
+            raise UpdateNeeded()
 
-            if self.revision and self.current_revision() != self.revision:
-                raise UpdateNeeded()
-            if self.branch and (
-                self.current_branch() != self.branch
-                or self.has_incoming_changesets()
-            ):
-                raise UpdateNeeded()
-            if self.tag and (
-                self.current_tag() != self.tag or self.has_incoming_changesets()
-            ):
-                raise UpdateNeeded()
+    def probe_state(self, cached=True):
+        """Determine the clone's state with a single shell call.
+
+        The result is shared through the host's probe cache unless `cached`
+        is false.
+
+        """
+        run = self.probe if cached else self.cmd
+        with self.chdir(self.target):
+            stdout, stderr = run(PROBE_COMMAND, expand=False)
+        return parse_probe(stdout)
+
+    def state(self):
+        """Return the clone's state.
+
+        During verify() this is the state determined once for all checks,
+        otherwise the clone is probed again.
+
+        """
+        if self._state is not None:
+            return self._state
+        return self.probe_state(cached=False)
 
     def current_tag(self):
-        try:
-            with self.chdir(self.target):
-                stdout, stderr = self.cmd("LANG=C git describe --tags")
-        except RuntimeError:
-            return None
-        return stdout.strip()
+        tags = self.state()["tags"]
+        if self.tag in tags:
+            return self.tag
+        return tags[0] if tags else None
 
     def current_revision(self):
-        try:
-            with self.chdir(self.target):
-                stdout, stderr = self.cmd("LANG=C git show -s --format=%H")
-        except RuntimeError:
-            return None
-        return stdout.strip()
+        return self.state()["revision"]
 
     def current_branch(self):
-        with self.chdir(self.target):
-            stdout, stderr = self.cmd("git rev-parse --abbrev-ref HEAD")
-        return stdout.strip()
+        return self.state()["branch"]
 
     def has_incoming_changesets(self):
         with self.chdir(self.target):
@@ -130,32 +212,72 @@ class Clone(Component):
             return stderr.strip()
 
     def has_outgoing_changesets(self):
-        with self.chdir(self.target):
-            stdout, stderr = self.cmd("LANG=C git status")
-        return "Your branch is ahead of" in stdout
+        return self.state()["ahead"] > 0
 
     def has_changes(self):
-        with self.chdir(self.target):
-            stdout, stderr = self.cmd("git status --porcelain")
-        return bool(stdout.strip())
+        return self.state()["changes"]
 
     def remote_url(self):
-        with self.chdir(self.target):
-            stdout, stderr = self.cmd("git remote get-url origin")
-        return stdout.strip()
+        return self.state()["url"]
+
+    @property
+    def object_store(self):
+        """Path of the bare repository that shares its objects with all
+        clones of this URL on the host."""
+        return os.path.join(
+            self.environment.workdir_base,
+            ".git-objects",
+            hashlib.sha256(self.url.encode("utf-8")).hexdigest(),
+        )
+
+    def update_object_store(self):
+        fetched = _fetched_stores.setdefault(self.host, set())
+        if self.object_store in fetched:
+            return
+        # Clones borrow objects from the store without copying them. The
+        # store must therefore never lose objects: it is not pruned and
+        # garbage collection is disabled.
+        if os.path.exists(self.object_store):
+            self.cmd(
+                "git -C {} fetch".format(self.object_store),
+                expand=False,
+            )
+        else:
+            os.makedirs(os.path.dirname(self.object_store), exist_ok=True)
+            self.cmd(
+                self.expand(
+                    "git clone --mirror -c gc.auto=0 -c maintenance.auto=false "
+                    "-c remote.origin.prune=false {{component.url}} "
+                    "{{component.object_store}}"
+                )
+            )
+        fetched.add(self.object_store)
 
     def update(self):
         just_cloned = False
+        if self.shared_objects:
+            self.update_object_store()
         if self._force_clone:
             ensure_empty_directory(self.target)
-            self.cmd(
-                self.expand("git clone {{component.url}} {{component.target}}")
-            )
+            if self.shared_objects:
+                self.cmd(
+                    self.expand(
+                        "git clone --reference-if-able "
+                        "{{component.object_store}} "
+                        "{{component.url}} {{component.target}}"
+                    )
+                )
+            else:
+                self.cmd(
+                    self.expand(
+                        "git clone {{component.url}} {{component.target}}"
+                    )
+                )
             just_cloned = True
         with self.chdir(self.target):
-            for filepath in self.untracked_files():
-                os.unlink(os.path.join(self.target, filepath))
             if not just_cloned:
+                for filepath in self.untracked_files():
+                    os.unlink(os.path.join(self.target, filepath))
                 self.cmd("git fetch")
             if self.branch:
                 self.cmd(
@@ -172,24 +294,7 @@ class Clone(Component):
             self.cmd("git submodule update --init --recursive")
 
     def untracked_files(self):
-        stdout, stderr = self.cmd(
-            "git status --porcelain --untracked-files=all"
-        )
-        items = (line.split(None, 1) for line in stdout.splitlines())
-        untracked_items = [
-            filepath for status, filepath in items if status == "??"
-        ]
-
-        # from the manpage of git-status: If a filename contains whitespace
-        # or other nonprintable characters, that field will be quoted
-        # in the manner of a C string literal
-        # so we need to unquote the filenames
-        def unquote_git(s):
-            if s.startswith('"') and s.endswith('"'):
-                return s[1:-1].encode().decode("unicode-escape")
-            return s
-
-        return [unquote_git(item) for item in untracked_items]
+        return self.probe_state(cached=False)["untracked"]
 
     def last_updated(self):
         with self.chdir(self.target):
@@ -1,11 +1,44 @@
+import hashlib
+import json
 import os.path
-import re
+import weakref
 
 from batou import UpdateNeeded, output
 from batou.component import Component
 from batou.lib.file import Directory
 from batou.utils import CmdExecutionError
 
+# Shared stores that have been pulled into on each host during this
+# deployment.
+_pulled_stores = weakref.WeakKeyDictionary()
+
+# Determine the working copy's parent, its branch and date, the status of
+# all files, and whether there are changesets that have not been published
+# (draft changesets) with a single shell call, all in JSON.
+PROBE_COMMAND = (
+    "HGPLAIN=1 hg log -r . -T json && HGPLAIN=1 hg status -T json && "
+    "HGPLAIN=1 hg log -r 'first(draft())' -T json"
+)
+
+
+def parse_probe(stdout):
+    """Parse the output of `PROBE_COMMAND` into a state dict."""
+    decoder = json.JSONDecoder()
+    stdout = stdout.strip()
+    (parent,), end = decoder.raw_decode(stdout)
+    stdout = stdout[end:].lstrip()
+    status, end = decoder.raw_decode(stdout)
+    draft, _ = decoder.raw_decode(stdout[end:].lstrip())
+    timestamp, offset = parent["date"]
+    return dict(
+        revision=parent["node"] if parent["rev"] >= 0 else None,
+        branch=parent["branch"],
+        date=float(timestamp) - float(offset),
+        changes=bool(status),
+        untracked=[f["path"] for f in status if f["status"] == "?"],
+        outgoing=bool(draft),
+    )
+
 
 class Clone(Component):
     namevar = "url"
@@ -14,7 +47,11 @@ class Clone(Component):
     branch = None
     vcs_update = True
 
-    _revision_pattern = re.compile(r"changeset: +\d+:([a-f0-9]+)")
+    # Check out a working copy of a store that is shared by all clones of
+    # the same URL on a host, instead of cloning the repository.
+    shared_store = False
+
+    _state = None
 
     def configure(self):
         if (not self.revision_or_branch) or (self.revision and self.branch):
@@ -32,59 +69,82 @@ class Clone(Component):
             if not self.vcs_update:
                 return
 
-            if self.has_outgoing_changesets():
-                output.annotate(
-                    "Hg clone at {} has outgoing changesets.".format(
-                        self.target
-                    ),
-                    red=True,
-                )
+            # All checks share the state of a single probe.
+            self._state = self.probe_state()
+            try:
+                self._verify_state()
+            finally:
+                self._state = None
+
+    def _verify_state(self):
+        if self.has_outgoing_changesets():
+            output.annotate(
+                "Hg clone at {} has outgoing changesets.".format(self.target),
+                red=True,
+            )
 
-            if self.has_changes():
-                output.annotate(
-                    "Hg clone at {} is dirty, going to lose changes.".format(
-                        self.target
-                    ),
-                    red=True,
-                )
-                raise UpdateNeeded()
+        if self.has_changes():
+            output.annotate(
+                "Hg clone at {} is dirty, going to lose changes.".format(
+                    self.target
+                ),
+                red=True,
+            )
+            raise UpdateNeeded()
 
-            if self.revision:
-                long_rev = len(self.revision) == 40
-                if self.current_revision(long_rev) != self.revision:
-                    raise UpdateNeeded()
-            if self.branch and (
-                self.current_branch() != self.branch
-                or self.has_incoming_changesets()
-            ):
+        if self.revision:
+            long_rev = len(self.revision) == 40
+            if self.current_revision(long_rev) != self.revision:
                 raise UpdateNeeded()
+        if self.branch and (
+            self.current_branch() != self.branch
+            or self.has_incoming_changesets()
+        ):
+            raise UpdateNeeded()
 
     @property
     def revision_or_branch(self):
         # Mercurial often takes either a revision or a branch.
         return self.revision or self.branch
 
+    def probe_state(self, cached=True):
+        """Determine the clone's state with a single local shell call.
+
+        The result is shared through the host's probe cache unless `cached`
+        is false.
+
+        """
+        run = self.probe if cached else self.cmd
+        with self.chdir(self.target):
+            stdout, stderr = run(PROBE_COMMAND, expand=False)
+        return parse_probe(stdout)
+
+    def state(self):
+        """Return the clone's state.
+
+        During verify() this is the state determined once for all checks,
+        otherwise the clone is probed again.
+
+        """
+        if self._state is not None:
+            return self._state
+        return self.probe_state(cached=False)
+
     def current_revision(self, long=False):
-        debug = "--debug" if long else ""
-        stdout, stderr = self.cmd(
-            self.expand(
-                "LANG=C hg --cwd {{component.target}} {{debug}} parent | "
-                "grep changeset:",
-                debug=debug,
-            )
-        )
-        match = self._revision_pattern.search(stdout)
-        if not match:
-            return None
-        return match.group(1)
+        revision = self.state()["revision"]
+        if revision and not long:
+            return revision[:12]
+        return revision
 
     def current_branch(self):
-        stdout, stderr = self.cmd("hg branch")
-        return stdout.strip()
+        return self.state()["branch"]
 
     def has_incoming_changesets(self):
+        # Compare with the URL explicitly: the default path of a shared
+        # working copy is the store.
         try:
-            self.cmd("hg incoming -q -l1")
+            with self.chdir(self.target):
+                self.cmd(self.expand("hg incoming -q -l1 {{component.url}}"))
         except CmdExecutionError as e:
             if e.returncode == 1:
                 return False
@@ -92,22 +152,56 @@ class Clone(Component):
         return True
 
     def has_outgoing_changesets(self):
-        try:
-            with self.chdir(self.target):
-                self.cmd("hg outgoing -q -l1")
-        except CmdExecutionError as e:
-            if e.returncode == 1:
-                return False
-            raise
-        return True
+        # Changesets that were pulled from the (publishing) URL are public,
+        # changesets committed to the clone stay draft until pushed.
+        return self.state()["outgoing"]
 
-    def has_changes(self):
+    def has_revision(self):
+        """Tell whether the pinned revision is present in the clone."""
         with self.chdir(self.target):
-            stdout, stderr = self.cmd("hg status")
-        return bool(stdout.strip())
+            stdout, stderr = self.cmd(
+                self.expand("hg log -r {{component.revision}} -T x"),
+                ignore_returncode=True,
+            )
+        return stdout == "x"
+
+    def has_changes(self):
+        return self.state()["changes"]
+
+    @property
+    def store(self):
+        """Path of the repository that is shared by all clones of this URL
+        on the host."""
+        return os.path.join(
+            self.environment.workdir_base,
+            ".hg-stores",
+            hashlib.sha256(self.url.encode("utf-8")).hexdigest(),
+        )
+
+    def update_store(self):
+        pulled = _pulled_stores.setdefault(self.host, set())
+        if self.store in pulled:
+            return
+        if os.path.exists(self.store):
+            self.cmd(self.expand("hg pull -R {{component.store}}"))
+        else:
+            os.makedirs(os.path.dirname(self.store), exist_ok=True)
+            self.cmd(
+                self.expand("hg clone -U {{component.url}} {{component.store}}")
+            )
+        pulled.add(self.store)
 
     def update(self):
         with self.chdir(self.target):
+            if self.shared_store:
+                self.update_store()
+                if not os.path.exists(".hg"):
+                    self.cmd(
+                        self.expand(
+                            "hg --config extensions.share= "
+                            "share -U {{component.store}} ."
+                        )
+                    )
             if not os.path.exists(".hg"):
                 self.cmd(
                     self.expand(
@@ -116,9 +210,19 @@ class Clone(Component):
                     )
                 )
                 return
-            self.cmd(
-                self.expand("hg pull --rev {{component.revision_or_branch}}")
-            )
+            # Shared working copies get their changesets from the store, and
+            # a pinned revision that is present already needs no pull.
+            if self.shared_store and os.path.exists(".hg/sharedpath"):
+                needs_pull = False
+            else:
+                needs_pull = not (self.revision and self.has_revision())
+            if needs_pull:
+                self.cmd(
+                    self.expand(
+                        "hg pull --rev {{component.revision_or_branch}} "
+                        "{{component.url}}"
+                    )
+                )
             for filepath in self.untracked_files():
                 os.unlink(os.path.join(self.target, filepath))
             self.cmd(
@@ -128,17 +232,10 @@ class Clone(Component):
             )
 
     def untracked_files(self):
-        stdout, stderr = self.cmd("hg status -q -u")
-        items = (line.split(None, 1) for line in stdout.splitlines())
-        return [filepath for status, filepath in items if status == "?"]
+        return self.probe_state(cached=False)["untracked"]
 
     def last_updated(self):
         with self.chdir(self.target):
             if not os.path.exists(".hg"):
                 return None
-            stdout, stderr = self.cmd(
-                'hg log -r %s --template "{date|hgdate}\n"'
-                % self.current_revision()
-            )
-            timestamp, offset = stdout.split()
-            return float(timestamp) - float(offset)
+        return self.probe_state(cached=False)["date"]
@@ -1,13 +1,159 @@
+import atexit
 import os
-import tempfile
+import selectors
+import time
+import uuid
+import weakref
 
 from batou import UpdateNeeded
 from batou.component import Component
+from batou.utils import CmdExecutionError
 
 # Pass `USE_SUDO` as `admin_password` to use sudo for authorisation, like we
 # have on FC platform.
 USE_SUDO = object()
 
+# Client sessions of each host, by client command line and working
+# directory.
+_sessions = weakref.WeakKeyDictionary()
+
+
+class Session(object):
+    """A persistent mysql client process to run statements in.
+
+    Each call to `execute` is followed by a query for a unique marker, so
+    the output (and errors) can be attributed to the statements that caused
+    them. The client's stdout and stderr are read concurrently, so neither
+    pipe can fill up and block the client.
+
+    The client stops at the first failing statement, like a client that is
+    started for a single command. After each statement the delimiter is
+    reset and the client reconnects to `db`, so no session state (`USE`,
+    `SET`, open transactions) carries over to the next statement.
+
+    """
+
+    def __init__(self, process, command, db):
+        self.process = process
+        self.command = command
+        self.db = db
+        for pipe in [process.stdin, process.stdout, process.stderr]:
+            os.set_blocking(pipe.fileno(), False)
+        # Ignore what the client tells us on startup, e.g. warnings about
+        # passwords given on the command line.
+        try:
+            self._run("", self.command)
+        except CmdExecutionError:
+            self.close()
+            raise
+
+    def _run(self, statement, cmd, timeout=None, reset=False):
+        marker = "batou-{}".format(uuid.uuid4().hex)
+        marker_line = "{}\n".format(marker).encode("utf-8")
+        # Client commands are recognized with any delimiter: send what is
+        # left of the statement and reset the delimiter.
+        script = statement.strip() + "\n\\g\n\\d ;\n"
+        if reset:
+            script += "\\r {}\n".format(self.db)
+        script += "SELECT '{}';\n".format(marker)
+        pending = script.encode("utf-8")
+        out = err = b""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def failed(returncode, message=""):
+            return CmdExecutionError(
+                cmd,
+                returncode,
+                out.decode("utf-8", errors="replace"),
+                err.decode("utf-8", errors="replace") + message,
+            )
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.process.stdin, selectors.EVENT_WRITE)
+            selector.register(self.process.stdout, selectors.EVENT_READ)
+            selector.register(self.process.stderr, selectors.EVENT_READ)
+            while True:
+                if deadline is None:
+                    remaining = None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # The statement may have swallowed the marker (e.g.
+                        # an unterminated string), so the session is unusable.
+                        self.process.kill()
+                        self.close()
+                        raise failed(
+                            self.process.returncode,
+                            "Timed out after {} seconds.\n".format(timeout),
+                        )
+                for key, _ in selector.select(remaining):
+                    if key.fileobj is self.process.stdin:
+                        try:
+                            written = os.write(key.fd, pending)
+                        except BrokenPipeError:
+                            written = len(pending)
+                        pending = pending[written:]
+                        if not pending:
+                            selector.unregister(key.fileobj)
+                        continue
+                    chunk = os.read(key.fd, 65536)
+                    if key.fileobj is self.process.stderr:
+                        err += chunk
+                        if not chunk:
+                            selector.unregister(key.fileobj)
+                        continue
+                    if not chunk:
+                        # The client stopped, e.g. because a statement or
+                        # the authentication failed.
+                        err += self._read_stderr()
+                        self.close()
+                        raise failed(self.process.returncode)
+                    out += chunk
+                    if out == marker_line or out.endswith(b"\n" + marker_line):
+                        # Errors were written before the marker.
+                        err += self._read_stderr()
+                        out = out[: -len(marker_line)]
+                        return (
+                            out.decode("utf-8", errors="replace"),
+                            err.decode("utf-8", errors="replace"),
+                        )
+
+    def _read_stderr(self):
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.process.stderr.fileno(), 65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def execute(self, statement, timeout=None):
+        out, err = self._run(statement, statement, timeout, reset=True)
+        # The client also reports warnings on stderr, only errors fail.
+        if any(line.startswith("ERROR") for line in err.splitlines()):
+            raise CmdExecutionError(statement, 1, out, err)
+        return out, err
+
+    def close(self):
+        for pipe in [self.process.stdin, self.process.stdout]:
+            try:
+                pipe.close()
+            except (BrokenPipeError, BlockingIOError):
+                pass
+        self.process.wait()
+        self.process.stderr.close()
+
+
+@atexit.register
+def close_sessions():
+    for sessions in list(_sessions.values()):
+        for session in sessions.values():
+            session.close()
+    _sessions.clear()
+
 
 class Command(Component):
     namevar = "statement"
@@ -18,6 +164,10 @@ class Command(Component):
 
     db = "mysql"
 
+    # Seconds to wait for a statement to finish. The client session is
+    # restarted afterwards. Raise this for long-running statements.
+    timeout = 60
+
     # Unless allows you to specify a query that generates output if the
     # target state has been reached already.
     unless = ""
@@ -26,17 +176,13 @@ class Command(Component):
         self.statement = self.expand(self.statement)
         self.unless = self.expand(self.unless)
 
-    def _mysql(self, cmd):
-        with tempfile.NamedTemporaryFile("w", suffix="sql", delete=False) as f:
-            self.tmp = f.name
-            f.write(cmd + "\n")
-
+    def _client_command(self):
         command = []
 
         if self.admin_password is USE_SUDO:
             command.append("sudo -u mysql")
 
-        command.append("mysql -Bs")
+        command.append("mysql -Bs --unbuffered")
 
         if self.admin_password is not USE_SUDO:
             command.append("-u{{component.admin_user}}")
@@ -46,11 +192,30 @@ class Command(Component):
             command.append("-h {{component.hostname}}")
         if self.port:
             command.append("-P {{component.port}}")
-        command.append("{{component.db}} < {{component.tmp}}")
+        command.append("{{component.db}}")
+        return self.expand(" ".join(command))
 
-        out, err = self.cmd(self.expand(" ".join(command)))
-        os.remove(self.tmp)
-        return out, err
+    def session(self):
+        """Return the client session that is shared by all commands on this
+        host that connect the same way."""
+        command = self._client_command()
+        sessions = _sessions.setdefault(self.host, {})
+        # Relative paths in statements (e.g. `\\. file`) are resolved by the
+        # client relative to its working directory.
+        key = (command, os.getcwd())
+        session = sessions.get(key)
+        if session is None or session.process.poll() is not None:
+            if session is not None:
+                session.close()
+            session = sessions[key] = Session(
+                self.cmd(command, communicate=False, expand=False),
+                command,
+                self.db,
+            )
+        return session
+
+    def _mysql(self, cmd):
+        return self.session().execute(cmd, timeout=self.timeout)
 
     def verify(self):
         if not self.unless:
@@ -74,6 +239,8 @@ class Database(Component):
     namevar = "database"
     charset = "UTF8"
     base_import_file = None
+    # Seconds to wait for the base import to finish.
+    import_timeout = 3600
     admin_password = None
 
     def configure(self):
@@ -92,6 +259,7 @@ CREATE DATABASE IF NOT EXISTS
                 db=self.database,
                 unless=self.expand("show tables"),
                 admin_password=self.admin_password,
+                timeout=self.import_timeout,
             )
 
 
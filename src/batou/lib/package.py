@@ -1,7 +1,20 @@
+import functools
+
 from batou import UpdateNeeded
 from batou.component import Component
 
 
+@functools.lru_cache(maxsize=1)
+def parse_selections(stdout):
+    """Parse the output of `dpkg --get-selections` into a mapping of
+    package names to their status."""
+    selections = {}
+    for line in stdout.splitlines():
+        candidate, status = line.split()
+        selections[candidate] = status
+    return selections
+
+
 class DPKG(Component):
     """Install a dpkg system package.
 
@@ -12,14 +25,40 @@ class DPKG(Component):
     namevar = "package"
 
     def verify(self):
-        stdout, stderr = self.cmd("LANG=C dpkg --get-selections")
-        for line in stdout.splitlines():
-            candidate, status = line.split()
-            if candidate == self.package and status == "install":
-                break
-        else:
+        if self.selections().get(self.package) != "install":
             raise UpdateNeeded()
 
     def update(self):
+        packages = " ".join(p.package for p in self._pending_batch())
         # /dev/null: a talky apt-get get blocks remote execution
-        self.cmd("LANG=C apt-get -qy install {0}".format(self.package))
+        self.cmd("LANG=C apt-get -qy install {0}".format(packages))
+
+    def selections(self):
+        """Return the host's dpkg selections as a mapping of package names
+        to their status.
+
+        The selections are probed, so DPKG components share them until any
+        component on the host was updated.
+
+        """
+        stdout, stderr = self.probe("LANG=C dpkg --get-selections")
+        return parse_selections(stdout)
+
+    def _pending_batch(self):
+        """Return this component followed by the directly subsequent sibling
+        DPKG components whose packages are not installed either.
+
+        Only a consecutive run of packages is installed together to keep
+        the order relative to other components, e.g. those that configure
+        apt sources.
+
+        """
+        batch = [self]
+        siblings = getattr(self.parent, "sub_components", [self])
+        selections = self.selections()
+        for other in siblings[siblings.index(self) + 1 :]:
+            if not isinstance(other, DPKG):
+                break
+            if selections.get(other.package) != "install":
+                batch.append(other)
+        return batch
@@ -1,9 +1,62 @@
+import json
+import re
+import shlex
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.version import InvalidVersion, Version
+
 import batou
 from batou.component import Component
 from batou.lib.archive import Extract
 from batou.lib.download import Download
 from batou.utils import CmdExecutionError
 
+# Script that is run with the virtualenv's interpreter to report its
+# version, whether pip is available, and all installed distributions. It is
+# kept compatible with old Pythons that lack importlib.metadata.
+PROBE_SCRIPT = """\
+import json, sys
+try:
+    from importlib.metadata import distributions
+    dists = [(d.metadata["Name"], d.version) for d in distributions()]
+except ImportError:
+    import pkg_resources
+    dists = [(d.project_name, d.version) for d in pkg_resources.working_set]
+try:
+    import pip
+    has_pip = True
+except ImportError:
+    has_pip = False
+print(json.dumps(dict(
+    version=list(sys.version_info[:3]),
+    pip=has_pip,
+    distributions=dict((n, v) for n, v in dists if n))))
+"""
+
+
+def canonical_name(name):
+    """Normalize a distribution name as specified by PEP 503."""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def requirement_name(requirement):
+    """Return the canonical distribution name of a requirement, ignoring
+    extras and environment markers."""
+    try:
+        name = Requirement(requirement).name
+    except InvalidRequirement:
+        name = requirement
+    return canonical_name(name)
+
+
+def same_version(installed, expected):
+    if installed == expected:
+        return True
+    try:
+        return Version(installed) == Version(expected)
+    except InvalidVersion:
+        return False
+
 
 class VirtualEnv(Component):
     """Manage a virtualenv installation.
@@ -50,52 +103,106 @@ class VirtualEnvPyBase(Component):
     installer = "pip"
     install_options = ()
 
+    _venv_state = None
+
+    def venv_state(self):
+        """Return the virtualenv's Python version, pip availability and
+        installed distributions, determined with a single interpreter call.
+
+        The result is shared by all packages of this virtualenv until it is
+        invalidated by installing packages or rebuilding the virtualenv.
+        Returns `None` if the interpreter is not functional.
+
+        """
+        if self._venv_state is None:
+            try:
+                stdout, _ = self.cmd(
+                    "bin/python -c {}".format(shlex.quote(PROBE_SCRIPT)),
+                    expand=False,
+                )
+                state = json.loads(stdout)
+            except (CmdExecutionError, ValueError):
+                return None
+            state["distributions"] = {
+                canonical_name(name): version
+                for name, version in state["distributions"].items()
+            }
+            self._venv_state = state
+        return self._venv_state
+
     def verify(self):
-        expected_version = tuple(int(x) for x in self.parent.version.split("."))
-        version_specificity = len(expected_version)
-        self.assert_cmd(
-            'bin/python -c "import sys; '
-            'assert sys.version_info[:{}] == {}"'.format(
-                version_specificity, repr(expected_version)
-            )
-        )
-        # Is this Python (still) functional 'enough'
-        # from a setuptools/distribute perspective?
-        self.assert_cmd('bin/python -c "import pkg_resources"')
-        self.assert_cmd('bin/python -c "import pip"')
+        # Always start a deployment with a fresh view on the virtualenv.
+        self._venv_state = None
+        state = self.venv_state()
+        if state is None:
+            raise batou.UpdateNeeded()
+        expected_version = [int(x) for x in self.parent.version.split(".")]
+        if state["version"][: len(expected_version)] != expected_version:
+            raise batou.UpdateNeeded()
+        # Is this Python (still) functional 'enough'?
+        if not state["pip"]:
+            raise batou.UpdateNeeded()
 
     def update(self):
+        self._venv_state = None
         self.cmd("chmod -R u+w bin/ lib/ include/ .Python || true")
         self.cmd("rm -rf bin/ lib/ include/ .Python")
 
+    def pkg_is_current(self, pkg):
+        state = self.venv_state()
+        if state is None:
+            return False
+        installed = state["distributions"].get(requirement_name(pkg.package))
+        return installed is not None and same_version(installed, pkg.version)
+
     def verify_pkg(self, pkg):
-        try:
-            self.cmd(
-                'bin/python -c "'
-                "import pkg_resources; "
-                "assert pkg_resources.require('{}')[0].parsed_version == "
-                "pkg_resources.parse_version('{}')\"".format(
-                    pkg.package, pkg.version
-                )
-            )
-        except CmdExecutionError:
+        if not self.pkg_is_current(pkg):
             raise batou.UpdateNeeded()
 
     def update_pkg(self, pkg):
         if self.installer == "pip":
-            self.pip_install(pkg)
+            self.pip_install(*self._pending_batch(pkg))
         else:
             self.easy_install(pkg)
-
-    def pip_install(self, pkg):
+        self._venv_state = None
+
+    def _pending_batch(self, pkg):
+        """Return `pkg` followed by the directly subsequent sibling packages
+        that are outdated as well and can be installed with the same pip
+        invocation.
+
+        Only a consecutive run of packages is considered to keep the order
+        in which packages are installed relative to other components.
+
+        """
+        batch = [pkg]
+        siblings = pkg.parent.sub_components
+        for other in siblings[siblings.index(pkg) + 1 :]:
+            if not isinstance(other, Package):
+                break
+            if (
+                other.install_options != pkg.install_options
+                or other.dependencies != pkg.dependencies
+                or other.env != pkg.env
+                or other.timeout != pkg.timeout
+            ):
+                break
+            if not self.pkg_is_current(other):
+                batch.append(other)
+        return batch
+
+    def pip_install(self, pkg, *more):
         options = self.install_options
         options += pkg.install_options
         if not pkg.dependencies:
             options += ("--no-deps",)
         options = " ".join(options)
+        requirements = " ".join(
+            '"{}=={}"'.format(p.package, p.version) for p in (pkg,) + more
+        )
         self.cmd(
-            'bin/pip --timeout={} install {} "{}=={}"'.format(
-                pkg.timeout, options, pkg.package, pkg.version
+            "bin/pip --timeout={} install {} {}".format(
+                pkg.timeout, options, requirements
             ),
             env=pkg.env if pkg.env else {},
         )
@@ -1,6 +1,9 @@
+import http.client
 import os
 import os.path
+import socket
 import time
+import xmlrpc.client
 
 from batou import UpdateNeeded, output
 from batou.component import Attribute, Component, ConfigString, handle_event
@@ -9,7 +12,47 @@ from batou.lib.file import Directory, File
 from batou.lib.logrotate import RotatedLogfile
 from batou.lib.nagios import ServiceCheck
 from batou.lib.service import Service
-from batou.utils import Address, CmdExecutionError
+from batou.utils import Address
+
+
+class UnixStreamHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socketpath, timeout=None):
+        super(UnixStreamHTTPConnection, self).__init__(
+            "localhost", timeout=timeout
+        )
+        self.socketpath = socketpath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketpath)
+
+
+class UnixStreamTransport(xmlrpc.client.Transport):
+    """XML-RPC transport to talk to supervisord via its unix socket."""
+
+    def __init__(self, socketpath, timeout=None):
+        super(UnixStreamTransport, self).__init__()
+        self.socketpath = socketpath
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        self._connection = (
+            host,
+            UnixStreamHTTPConnection(self.socketpath, self.timeout),
+        )
+        return self._connection[1]
+
+
+# Process states in which supervisord has not decided yet whether a
+# process is up.
+STARTING_STATES = ("STARTING", "BACKOFF")
+
+# supervisord's fault code for stopping a process that is not running.
+NOT_RUNNING = 70
 
 
 class Program(Component):
@@ -91,28 +134,26 @@ redirect_stderr = true
             raise UpdateNeeded()
 
     def update(self):
-        self.ctl("reread")
-        self.ctl("update")
-        if self.enable:
-            self.ctl("restart {}".format(self.name))
-        else:
-            if self.is_running():
-                self.ctl("stop {}".format(self.name))
+        readded = self.supervisor.update_config()
+        if not self.enable:
+            if self.name in readded or self.is_running():
+                self.supervisor.stop(self.name)
             return
-        if self.supervisor.wait_for_running:
-            for retry in range(self.options["startsecs"]):
-                time.sleep(1)
-                if self.is_running():
-                    return
-            raise RuntimeError(
-                'Program "{}" did not start up'.format(self.name)
-            )
+        wait = self.supervisor.wait_for_running
+        if self.name in readded:
+            # supervisord started the program already when it added the
+            # new configuration, don't restart it once more.
+            startsecs = int(self.options["startsecs"])
+            retries = int(self.options["startretries"])
+            # Each retry backs off one second longer.
+            timeout = (startsecs + retries) * (retries + 1)
+            self.supervisor.await_start(self.name, timeout if wait else 0)
+        else:
+            self.supervisor.restart(self.name, wait=wait)
 
     def is_running(self):
-        out, err = self.ctl(
-            "status {}".format(self.name), ignore_returncode=True
-        )
-        return "RUNNING" in out
+        info = self.supervisor.process_info().get(self.name, {})
+        return info.get("statename") == "RUNNING"
 
     # Keep track whether
     _evaded = False
@@ -129,7 +170,7 @@ redirect_stderr = true
             "\u2623 Stopping {} for cold deployment".format(self.name)
         )
         try:
-            self.ctl("stop {}".format(self.name))
+            self.supervisor.stop(self.name)
         except Exception:
             pass
 
@@ -201,6 +242,10 @@ class Supervisor(Component):
     )
     check_contact_groups = None
 
+    _rpc = None
+    _process_info = None
+    _applied_config = None
+
     def configure(self):
         self.provide("supervisor", self)
 
@@ -251,18 +296,133 @@ class Supervisor(Component):
                 command=self.expand("{{component.workdir}}/check_supervisor"),
             )
 
+    # API for programs. All calls share one connection to supervisord.
+
+    @property
+    def rpc(self):
+        if self._rpc is None:
+            self._rpc = self._connect()
+        return self._rpc
+
+    def _connect(self):
+        return xmlrpc.client.ServerProxy(
+            "http://localhost", transport=UnixStreamTransport(self.socketpath)
+        ).supervisor
+
+    def process_info(self):
+        """Return the state of all processes by name.
+
+        The snapshot is shared by all programs until the state of
+        supervisord is changed through this component.
+
+        """
+        if self._process_info is None:
+            try:
+                processes = self.rpc.getAllProcessInfo()
+            except (OSError, xmlrpc.client.Error):
+                # supervisord is not running.
+                processes = []
+            self._process_info = {p["name"]: p for p in processes}
+        return self._process_info
+
+    def invalidate(self):
+        self._process_info = None
+
+    def _config_state(self):
+        state = []
+        with os.scandir(self.program_config_dir.path) as entries:
+            for entry in entries:
+                st = entry.stat()
+                state.append((entry.name, st.st_size, st.st_mtime_ns))
+        return sorted(state)
+
+    def update_config(self):
+        """Apply changed program configurations (like `supervisorctl reread`
+        and `supervisorctl update`).
+
+        This is skipped if no program configuration changed since it was
+        last applied. Returns the names of the groups that were (re)added,
+        supervisord starts their processes by itself.
+
+        """
+        state = self._config_state()
+        if state == self._applied_config:
+            return set()
+        self.invalidate()
+        [[added, changed, removed]] = self.rpc.reloadConfig()
+        for group in removed + changed:
+            self.rpc.stopProcessGroup(group)
+            self.rpc.removeProcessGroup(group)
+        for group in changed + added:
+            self.rpc.addProcessGroup(group)
+        self._applied_config = state
+        return set(changed + added)
+
+    def stop(self, name):
+        self.invalidate()
+        try:
+            self.rpc.stopProcess(name)
+        except xmlrpc.client.Fault as e:
+            if e.faultCode != NOT_RUNNING:
+                raise
+
+    def restart(self, name, wait=True):
+        """Restart a process.
+
+        If `wait` is true, this returns once supervisord considers the
+        process to be running (i.e. after its `startsecs`).
+
+        """
+        self.stop(name)
+        try:
+            self.rpc.startProcess(name, wait)
+        except xmlrpc.client.Fault as e:
+            raise RuntimeError(
+                'Program "{}" did not start up: {}'.format(name, e.faultString)
+            )
+
+    def await_start(self, name, timeout):
+        """Wait up to `timeout` seconds for a process that supervisord
+        started by itself to be running.
+
+        The process is started if supervisord did not start it (e.g. due
+        to `autostart = false`).
+
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self.invalidate()
+            state = self.process_info().get(name, {}).get("statename")
+            if state not in STARTING_STATES or time.monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+        if state == "RUNNING" or (state in STARTING_STATES and not timeout):
+            return
+        if state in STARTING_STATES or state in ("FATAL", "EXITED"):
+            raise RuntimeError(
+                'Program "{}" did not start up: {}'.format(name, state)
+            )
+        self.restart(name, wait=bool(timeout))
+
+    def wait_for_startup(self, timeout):
+        """Wait until no process is starting anymore."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.invalidate()
+            processes = self.process_info().values()
+            if not any(p["statename"] in STARTING_STATES for p in processes):
+                break
+            time.sleep(0.1)
+        self.invalidate()
+
 
 class RunningHelper(Component):
     def is_running(self):
         try:
-            pid, err = self.cmd("bin/supervisorctl pid")
-            try:
-                int(pid) > 0
-            except ValueError:
-                return False
-        except CmdExecutionError:
+            pid = self.parent.rpc.getPID()
+        except (OSError, xmlrpc.client.Error):
             return False
-        return True
+        return pid > 0
 
 
 class RunningSupervisor(RunningHelper):
@@ -272,6 +432,8 @@ class RunningSupervisor(RunningHelper):
     namevar = "service"
 
     def verify(self):
+        # Start with a fresh view on the processes in every deployment.
+        self.parent.invalidate()
         self.parent.assert_no_changes()
         self.assert_file_is_current(
             self.parent.pidfile, ["bin/supervisord", "etc/supervisord.conf"]
@@ -284,28 +446,27 @@ class RunningSupervisor(RunningHelper):
             self.service.start()
         else:
             self.reload_supervisor()
+        self.parent._applied_config = None
         if self.parent.wait_for_running:
-            # Wait max startup time now that supervisor is back
-            time.sleep(self.parent.max_startup_delay)
+            # Wait until the programs that are started by supervisor are up
+            # (at most the max startup time).
+            self.parent.wait_for_startup(self.parent.max_startup_delay)
 
     def reload_supervisor(self):
-        self.cmd("bin/supervisorctl reload")
+        self.parent.rpc.restart()
         # Reload is asynchronous and doesn't wait for supervisor to become
-        # fully running again. We actually could monitor supervisorctl,
-        # though. This can take a long time if supervisor needs to orderly
-        # shut down a lot of services.
+        # fully running again. This can take a long time if supervisor needs
+        # to orderly shut down a lot of services.
         wait = self.reload_timeout
         while wait:
-            out, err = "", ""
-            # Supervisor tends to "randomly" set zero and non-zero exit codes.
-            # See https://github.com/Supervisor/supervisor/issues/24 :-/
-            out, err = self.cmd("bin/supervisorctl pid", ignore_returncode=True)
-            if "SHUTDOWN_STATE" in out:
+            try:
+                state = self.parent.rpc.getState()["statename"]
+            except (OSError, xmlrpc.client.Error):
+                state = None
+            if state == "SHUTDOWN":
                 time.sleep(1)
                 continue
-            try:
-                int(out) > 0
-            except ValueError:
+            if state != "RUNNING":
                 time.sleep(1)
                 wait -= 1
             else:
@@ -324,4 +485,5 @@ class StoppedSupervisor(RunningHelper):
             raise UpdateNeeded()
 
     def update(self):
-        self.cmd("bin/supervisorctl shutdown")
+        self.parent.invalidate()
+        self.parent.rpc.shutdown()
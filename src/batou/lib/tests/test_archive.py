@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
+import json
 import os
 import pathlib
+import shutil
 import sys
 import time
 
+import mock
 import pytest
 
-from batou.lib.archive import Extract
+import batou
+from batou.lib.archive import Extract, Untar
 
 
 def test_unknown_extension_raises():
@@ -138,3 +142,78 @@ def test_dmg_does_not_support_strip(root):
     with pytest.raises(ValueError) as e:
         root.component += extract
         assert e.value.args[0] == "Strip is not supported by DMGExtractor"
+
+
+@pytest.fixture
+def extracted(root, tmp_path):
+    archive = tmp_path / "example.tar.gz"
+    shutil.copyfile(pathlib.Path(__file__).parent / "example.tar.gz", archive)
+    extract = Extract(str(archive), target="example", deep_verify=True)
+    root.component += extract
+    root.component.deploy()
+    return extract
+
+
+def test_extract_writes_manifest(extracted):
+    with open(extracted.extractor.manifest) as f:
+        manifest = json.load(f)
+    assert manifest["files"] == ["foo/bar/qux"]
+    assert manifest["strip"] == 0
+
+
+def test_extract_verify_does_not_read_unchanged_archive(extracted):
+    extractor = extracted.extractor
+    with (
+        mock.patch.object(extractor, "get_names_from_archive") as names,
+        mock.patch("batou.utils.hash") as hash_,
+    ):
+        extractor.verify()
+    assert not names.called
+    assert not hash_.called
+
+
+def test_extract_verify_ignores_touched_archive_with_same_content(extracted):
+    time.sleep(0.01)
+    os.utime(extracted.archive)
+    extracted.extractor.verify()
+
+
+def test_extract_verify_detects_changed_archive(extracted):
+    with open(extracted.archive, "ab") as f:
+        f.write(b"\0")
+    with pytest.raises(batou.UpdateNeeded):
+        extracted.extractor.verify()
+
+
+def test_extract_deep_verify_detects_missing_files(extracted):
+    os.unlink(extracted.target + "/foo/bar/qux")
+    with pytest.raises(batou.UpdateNeeded):
+        extracted.extractor.verify()
+    extracted.extractor.deep_verify = False
+    extracted.extractor.verify()
+
+
+def test_extract_verify_detects_removed_or_emptied_target(extracted):
+    extracted.extractor.deep_verify = False
+    shutil.rmtree(extracted.target + "/foo")
+    with pytest.raises(batou.UpdateNeeded):
+        extracted.extractor.verify()
+    shutil.rmtree(extracted.target)
+    with pytest.raises(batou.UpdateNeeded):
+        extracted.extractor.verify()
+
+
+def test_extractor_overriding_update_writes_manifest(root, tmp_path):
+    class LegacyUntar(Untar):
+        def update(self):
+            self.cmd("tar xf {{component.archive}} -C {{component.target}}")
+
+    archive = tmp_path / "example.tar.gz"
+    shutil.copyfile(pathlib.Path(__file__).parent / "example.tar.gz", archive)
+    extractor = LegacyUntar(str(archive), target="example")
+    root.component += extractor
+    root.component.deploy()
+    assert extractor.changed
+    assert os.path.exists(extractor.manifest)
+    root.component.deploy()
+    assert not extractor.changed
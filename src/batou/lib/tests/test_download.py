@@ -1,10 +1,20 @@
+import hashlib
+import http.server
 import os.path
+import threading
 import unittest
 
 import mock
 import pytest
 
-from ..download import Download
+import batou
+
+from ..download import (
+    ArtifactStore,
+    Download,
+    http_session,
+    missing_artifacts,
+)
 
 
 class DownloadTest(unittest.TestCase):
@@ -66,3 +76,269 @@ def test_downloads_file(root):
     assert os.path.isfile(
         os.path.join(root.environment.workdir_base, "mycomponent/test100k")
     )
+
+
+@pytest.fixture
+def local_download(root, tmpdir):
+    source = tmpdir / "source.bin"
+    source.write_binary(b"asdf" * 1024)
+    download = Download(
+        "file://" + str(source),
+        target="target.bin",
+        checksum="sha256:" + hashlib.sha256(b"asdf" * 1024).hexdigest(),
+    )
+    root.component += download
+    return download
+
+
+def test_verify_uses_cached_checksum(local_download, root):
+    root.component.deploy()
+    os.chdir(local_download.workdir)
+    assert os.path.exists(local_download._checksum_cache)
+    with mock.patch("batou.utils.hash") as buh:
+        local_download.verify()
+    assert not buh.called
+
+
+def test_verify_rehashes_changed_target(local_download, root):
+    root.component.deploy()
+    os.chdir(local_download.workdir)
+    with open(local_download.target, "ab") as f:
+        f.write(b"x")
+    with pytest.raises(batou.UpdateNeeded):
+        local_download.verify()
+    root.component.deploy()
+    os.chdir(local_download.workdir)
+    local_download.verify()
+
+
+def test_update_requests_hashes_while_streaming(local_download, root):
+    root.component.configure()
+    local_download.uri = "https://example.com/source.bin"
+    response = mock.Mock()
+    response.iter_content.return_value = [b"asdf" * 512, b"asdf" * 512]
+    response.status_code = 200
+    with (
+        mock.patch("batou.lib.download.http_session") as session,
+        mock.patch("batou.utils.hash") as buh,
+    ):
+        session().get.return_value = response
+        os.makedirs(local_download.workdir, exist_ok=True)
+        os.chdir(local_download.workdir)
+        local_download.update()
+    assert not buh.called
+    assert os.path.exists(local_download._checksum_cache)
+    with open(local_download.target, "rb") as f:
+        assert f.read() == b"asdf" * 1024
+
+
+@pytest.fixture
+def http_server(tmpdir):
+    """Serve files from a temporary directory with support for single range
+    requests and record the requests."""
+    docroot = tmpdir.mkdir("docroot")
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            self.respond(body=False)
+
+        def do_GET(self):
+            server.requests.append(self.path)
+            server.ranges.append(self.headers.get("Range"))
+            server.clients.add(self.client_address)
+            self.respond()
+
+        def respond(self, body=True):
+            path = docroot.join(self.path)
+            if not path.check(file=True):
+                self.send_error(404)
+                return
+            data = path.read_binary()
+            size = len(data)
+            range = self.headers.get("Range")
+            if range and server.accept_ranges:
+                start, end = range.replace("bytes=", "").split("-")
+                start, end = int(start), int(end or size - 1)
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%s" % size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = data[start : end + 1]
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", "bytes %s-%s/%s" % (start, end, size)
+                )
+            else:
+                self.send_response(200)
+            if server.accept_ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            if body:
+                self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.docroot = docroot
+    server.requests = []
+    server.ranges = []
+    server.clients = set()
+    server.accept_ranges = True
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+DATA = b"batou" * 100000
+KEY = "sha256:" + hashlib.sha256(DATA).hexdigest()
+
+
+def test_artifact_store_fetches_concurrently_requested_artifact_once(
+    http_server, tmpdir
+):
+    http_server.docroot.join("artifact").write_binary(DATA)
+    store = ArtifactStore(str(tmpdir / "store"))
+    assert KEY not in store
+    threads = [
+        threading.Thread(
+            target=store.fetch, args=(http_server.url + "/artifact", KEY)
+        )
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert KEY in store
+    assert http_server.requests == ["/artifact"]
+    with open(store.fetch(http_server.url + "/artifact", KEY), "rb") as f:
+        assert f.read() == DATA
+
+
+def test_artifact_store_rejects_wrong_content(http_server, tmpdir):
+    http_server.docroot.join("artifact").write_binary(b"wrong")
+    store = ArtifactStore(str(tmpdir / "store"))
+    with pytest.raises(ValueError):
+        store.fetch(http_server.url + "/artifact", KEY)
+    assert KEY not in store
+    store.receive(KEY, DATA[:10], 0)
+    store.receive(KEY, DATA[10:], 10)
+    store.commit(KEY)
+    assert KEY in store
+
+
+def test_download_uses_artifact_store(root):
+    root.component += Download(
+        "http://127.0.0.1:1/artifact", target="artifact", checksum=KEY
+    )
+    store = root.environment.artifacts
+    store.receive(KEY, DATA, 0)
+    store.commit(KEY)
+    root.component.deploy()
+    with open(os.path.join(root.workdir, "artifact"), "rb") as f:
+        assert f.read() == DATA
+
+
+def test_missing_artifacts_lists_each_outdated_download_once(root):
+    root.component += Download("http://x/a", target="a", checksum=KEY)
+    root.component += Download("http://y/a", target="b", checksum=KEY)
+    root.component += Download(
+        "http://x/c", checksum="sha256:1234", requests_kwargs={"auth": "x"}
+    )
+    root.component.configure()
+    assert missing_artifacts(root.environment, root.host) == [
+        ("http://x/a", KEY)
+    ]
+    with open(os.path.join(root.workdir, "a"), "wb") as f:
+        f.write(DATA)
+    with open(os.path.join(root.workdir, "b"), "wb") as f:
+        f.write(DATA)
+    assert missing_artifacts(root.environment, root.host) == []
+
+
+@pytest.fixture
+def http_download(root, http_server):
+    http_server.docroot.join("artifact").write_binary(DATA)
+    download = Download(
+        http_server.url + "/artifact", target="artifact", checksum=KEY
+    )
+    root.component += download
+    return download
+
+
+def read_artifact(root):
+    with open(os.path.join(root.workdir, "artifact"), "rb") as f:
+        return f.read()
+
+
+def test_download_resumes_partial_download(root, http_download, http_server):
+    with open(os.path.join(root.workdir, "artifact.part"), "wb") as f:
+        f.write(DATA[:1000])
+    root.component.deploy()
+    assert http_server.ranges == ["bytes=1000-"]
+    assert read_artifact(root) == DATA
+    assert not os.path.exists(os.path.join(root.workdir, "artifact.part"))
+
+
+def test_download_restarts_if_server_does_not_support_ranges(
+    root, http_download, http_server
+):
+    http_server.accept_ranges = False
+    with open(os.path.join(root.workdir, "artifact.part"), "wb") as f:
+        f.write(b"garbage")
+    root.component.deploy()
+    assert read_artifact(root) == DATA
+
+
+def test_download_completes_fully_downloaded_part(
+    root, http_download, http_server
+):
+    with open(os.path.join(root.workdir, "artifact.part"), "wb") as f:
+        f.write(DATA)
+    root.component.deploy()
+    assert http_server.ranges == ["bytes=%s-" % len(DATA)]
+    assert read_artifact(root) == DATA
+
+
+def test_download_fetches_ranges_in_parallel(
+    root, http_download, http_server, monkeypatch
+):
+    monkeypatch.setattr("batou.lib.download.RANGE_MIN_SIZE", 100000)
+    http_download.parallel = 4
+    root.component.deploy()
+    assert sorted(http_server.ranges) == [
+        "bytes=0-124999",
+        "bytes=125000-249999",
+        "bytes=250000-374999",
+        "bytes=375000-499999",
+    ]
+    assert read_artifact(root) == DATA
+
+
+def test_downloads_share_connections(root, http_server):
+    http_server.docroot.join("a").write_binary(DATA)
+    http_server.docroot.join("b").write_binary(DATA)
+    root.component += Download(http_server.url + "/a", checksum=KEY)
+    root.component += Download(http_server.url + "/b", checksum=KEY)
+    root.component.deploy()
+    assert http_server.requests == ["/a", "/b"]
+    assert len(http_server.clients) == 1
+
+
+def test_http_session_is_shared_per_thread():
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(http_session()))
+    thread.start()
+    thread.join()
+    assert http_session() is http_session()
+    assert sessions[0] is not http_session()
@@ -12,12 +12,14 @@ import yaml
 from mock import Mock, patch
 
 import batou
+from batou.component import Component
 from batou.lib.file import (
     BinaryFile,
     Content,
     Directory,
     File,
     FileComponent,
+    FileTree,
     JSONContent,
     Mode,
     Presence,
@@ -25,6 +27,7 @@ from batou.lib.file import (
     Symlink,
     SyncDirectory,
     YAMLContent,
+    copy_file,
     ensure_path_nonexistent,
 )
 from batou.tests.ellipsis import Ellipsis
@@ -192,9 +195,11 @@ def test_content_with_unicode_requires_encoding(root):
     path = "path"
     root.component.foobar = "äsdf"
     p = File(path, content="örks {{component.foobar}}", encoding="ascii")
-
+    root.component += p
+    # Content is rendered when the file is deployed.
     with pytest.raises(UnicodeEncodeError):
-        root.component |= p
+        root.component.deploy()
+    root.component.sub_components.remove(p)
 
     p = File(path, content="örks {{component.foobar}}", encoding="utf-8")
     root.component += p
@@ -372,6 +377,72 @@ def test_binary_file_component(root):
         assert f.read() == (b"\x89PNG\r\n\x1a\n")
 
 
+def test_binary_file_copies_source_without_loading_it(root):
+    with open("source", "wb") as f:
+        f.write(b"\x89PNG" * 1000)
+    p = BinaryFile("path", source="source", mode=0o600)
+    root.component += p
+    assert p.content is None
+    root.component.deploy()
+    assert p.changed
+    with open(p.path, "rb") as f:
+        assert f.read() == b"\x89PNG" * 1000
+    assert S_IMODE(os.stat(p.path).st_mode) == 0o600
+    root.component.deploy()
+    assert not p.changed
+
+
+def test_binary_file_replaces_changed_target_atomically(root):
+    with open("source", "wb") as f:
+        f.write(b"new")
+    p = BinaryFile("path", source="source")
+    root.component += p
+    with open(p.path, "wb") as f:
+        f.write(b"old")
+    os.chmod(p.path, 0o640)
+    inode = os.stat(p.path).st_ino
+    root.component.deploy()
+    with open(p.path, "rb") as f:
+        assert f.read() == b"new"
+    assert os.stat(p.path).st_ino != inode
+    assert S_IMODE(os.stat(p.path).st_mode) == 0o640
+    names = os.listdir(os.path.dirname(p.path))
+    assert "path" in names
+    assert not [name for name in names if name.endswith(".batou-tmp")]
+
+
+def test_binary_file_reuses_digests_of_unchanged_files(root):
+    with open("source", "wb") as f:
+        f.write(b"data")
+    p = BinaryFile("path", source="source")
+    root.component += p
+    root.component.deploy()
+    with patch("batou.utils.hash") as hash:
+        root.component.deploy()
+    assert not p.changed
+    assert not hash.called
+    with open("source", "wb") as f:
+        f.write(b"more")
+    os.utime("source", ns=(0, 0))
+    root.component.deploy()
+    assert p.changed
+    with open(p.path, "rb") as f:
+        assert f.read() == b"more"
+
+
+def test_binary_file_delayed_source(root):
+    p = BinaryFile("path", source="source")
+    root.component += p
+    content = [c for c in p.sub_components if isinstance(c, Content)][0]
+    with pytest.raises(AssertionError):
+        content.verify(predicting=True)
+    with open("source", "wb") as f:
+        f.write(b"data")
+    root.component.deploy()
+    with open(p.path, "rb") as f:
+        assert f.read() == b"data"
+
+
 def test_content_from_file_as_template_guessed(root):
     path = "path"
     with open(path, "w") as f:
@@ -434,6 +505,52 @@ def test_content_template_with_explicit_context(root):
         assert f.read() == "asdf"
 
 
+def test_content_is_rendered_when_deployed(root):
+    context = Mock()
+    context.foobar = "asdf"
+    p = File("path", content="{{component.foobar}}", template_context=context)
+    root.component += p
+    # Configuring only records the template.
+    context.foobar = "bsdf"
+    root.component.deploy()
+    assert p.content == b"bsdf"
+    with open(p.path) as f:
+        assert f.read() == "bsdf"
+
+
+def test_file_content_is_rendered_when_read_in_configure(root):
+    class Reader(Component):
+        foobar = "asdf"
+
+        def configure(self):
+            self.file = File("path", content="{{component.foobar}}")
+            self += self.file
+            self.seen = self.file.content
+
+    reader = Reader()
+    root.component += reader
+    assert reader.seen == b"asdf"
+    assert reader.file.content == b"asdf"
+
+
+def test_content_is_rendered_only_once(root):
+    p = Content("path", content="{{component.foobar}}")
+    root.component.foobar = "asdf"
+    root.component += p
+    p.render_content()
+    root.component.foobar = "bsdf"
+    root.component.deploy()
+    with open(p.path) as f:
+        assert f.read() == "asdf"
+
+
+def test_content_template_errors_are_raised_when_rendering(root):
+    p = File("path", content="{{component.doesnotexist}}")
+    root.component += p
+    with pytest.raises(batou.TemplatingError):
+        p._.render_content()
+
+
 def test_content_relative_source_path_computed_wrt_definition_dir(root):
     path = "path"
     source = "source"
@@ -1163,6 +1280,82 @@ def test_syncdirectory_needs_update_on_nonexisting_target(root):
         sd.verify()
 
 
+@pytest.fixture
+def synced(root):
+    os.makedirs("source/sub")
+    with open("source/one", "w") as f:
+        f.write("one")
+    with open("source/sub/two", "w") as f:
+        f.write("two")
+    os.chmod("source/sub/two", 0o755)
+    os.symlink("sub/two", "source/link")
+    sd = SyncDirectory("target", source="source")
+    root.component += sd
+    root.component.deploy()
+    return sd
+
+
+def test_syncdirectory_copies_files_symlinks_and_modes(synced):
+    assert synced.changed_files is None
+    target = synced.path
+    with open(target + "/sub/two") as f:
+        assert f.read() == "two"
+    assert os.readlink(target + "/link") == "sub/two"
+    assert S_IMODE(os.stat(target + "/sub/two").st_mode) & 0o100
+    with synced.chdir(synced.workdir):
+        synced.verify()
+
+
+def test_syncdirectory_reports_changed_files(synced, root):
+    with open("source/sub/two", "w") as f:
+        f.write("TWO")
+    with open("source/three", "w") as f:
+        f.write("three")
+    with pytest.raises(batou.UpdateNeeded):
+        synced.verify()
+    assert synced.changed_files == ["sub/two", "three"]
+    root.component.deploy()
+    with open(synced.path + "/sub/two") as f:
+        assert f.read() == "TWO"
+
+
+def test_syncdirectory_caches_digests_of_unchanged_files(synced):
+    # Same content, different modification time: the content is compared
+    # once and the digests are remembered.
+    os.utime(synced.path + "/one", (0, 0))
+    with patch("batou.utils.hash", wraps=batou.utils.hash) as hash:
+        synced.verify()
+        assert hash.call_count == 2
+        synced.verify()
+        assert hash.call_count == 2
+    assert os.path.exists(synced.manifest)
+
+
+def test_syncdirectory_excludes_relative_paths(root):
+    os.makedirs("source/sub")
+    open("source/two", "w").close()
+    open("source/sub/two", "w").close()
+    root.component += SyncDirectory(
+        "target", source="source", exclude=("sub/two",)
+    )
+    root.component.deploy()
+    assert os.listdir("work/mycomponent/target/sub") == []
+    assert os.path.exists("work/mycomponent/target/two")
+
+
+def test_copy_file_overwrites_in_place(tmpdir):
+    tmpdir.chdir()
+    with open("source", "wb") as f:
+        f.write(b"x" * 100000)
+    with open("target", "wb") as f:
+        f.write(b"y" * 200000)
+    inode = os.stat("target").st_ino
+    copy_file("source", "target")
+    with open("target", "rb") as f:
+        assert f.read() == b"x" * 100000
+    assert os.stat("target").st_ino == inode
+
+
 def test_directory_passes_args_to_syncdirectory(root):
     d = Directory(
         "target", source="source", verify_opts="-abc", sync_opts="-xyz"
@@ -1172,3 +1365,178 @@ def test_directory_passes_args_to_syncdirectory(root):
     assert isinstance(sd, SyncDirectory)
     assert sd.verify_opts == "-abc"
     assert sd.sync_opts == "-xyz"
+
+
+def test_file_subcomponents_share_stat_calls(root):
+    file = File("asdf", content="foo", mode=0o644, owner=getpass.getuser())
+    root.component += file
+    root.component.deploy()
+    root.host.stat_cache.invalidate()
+    with (
+        patch("os.stat", wraps=os.stat) as stat,
+        patch("os.lstat", wraps=os.lstat) as lstat,
+    ):
+        root.component.deploy()
+        file.last_updated()
+    assert not file.changed
+    assert [c[0][0] for c in stat.call_args_list].count(file.path) == 1
+    assert [c[0][0] for c in lstat.call_args_list].count(file.path) == 1
+
+
+def test_owners_are_looked_up_once(root):
+    root.component += File("a", content="", owner=getpass.getuser())
+    root.component += File("b", content="", owner=getpass.getuser())
+    with patch("pwd.getpwnam", wraps=pwd.getpwnam) as getpwnam:
+        root.component.deploy()
+    assert getpwnam.call_count == 1
+
+
+def test_stat_cache_is_invalidated_after_update(root):
+    file = File("asdf", content="foo")
+    root.component += file
+    root.component.deploy()
+    assert file.changed
+    # Presence has seen the file as missing before it created it.
+    assert root.host.stat_cache.stat(file.path) is not None
+    os.unlink(file.path)
+    # Any update of another component on the host resets the cache.
+    root.host.stat_cache.stat(file.path)
+    root.component.deploy()
+    assert os.path.exists(file.path)
+
+
+@pytest.fixture
+def tree_source(root):
+    os.makedirs("assets/css")
+    with open("assets/index.html", "w") as f:
+        f.write("<h1>{{component.title}}</h1>")
+    with open("assets/css/site.css", "w") as f:
+        f.write("body {}")
+    with open("assets/notes.txt~", "w") as f:
+        f.write("backup")
+    root.component.title = "Hello"
+    return root
+
+
+def test_filetree_requires_source_or_files(root):
+    with pytest.raises(batou.ComponentUsageError):
+        root.component += FileTree("tree")
+
+
+@pytest.mark.parametrize("path", ["../x", "a/../../x", "/etc/x", "."])
+def test_filetree_rejects_files_outside_the_tree(root, path):
+    with pytest.raises(batou.ComponentUsageError):
+        root.component += FileTree("tree", files={path: "x"})
+
+
+def test_filetree_copies_source_and_content(tree_source):
+    root = tree_source
+    tree = FileTree(
+        "tree",
+        source="assets",
+        exclude=["*~"],
+        files={"robots.txt": b"User-agent: *\n"},
+    )
+    root.component += tree
+    root.component.deploy()
+    assert tree.changed
+    with open(tree.path + "/index.html") as f:
+        assert f.read() == "<h1>{{component.title}}</h1>"
+    with open(tree.path + "/css/site.css") as f:
+        assert f.read() == "body {}"
+    with open(tree.path + "/robots.txt") as f:
+        assert f.read() == "User-agent: *\n"
+    assert not os.path.exists(tree.path + "/notes.txt~")
+    assert os.path.exists(tree.manifest)
+    root.component.deploy()
+    assert not tree.changed
+
+
+def test_filetree_renders_templates(tree_source):
+    root = tree_source
+    tree = FileTree(
+        "tree",
+        source="assets",
+        exclude=["*~"],
+        files={"version": "{{component.title}} {{args.version}}"},
+        is_template=True,
+        template_args={"version": "1.0"},
+    )
+    root.component += tree
+    root.component.deploy()
+    with open(tree.path + "/index.html") as f:
+        assert f.read() == "<h1>Hello</h1>"
+    with open(tree.path + "/version") as f:
+        assert f.read() == "Hello 1.0"
+
+
+def test_filetree_replaces_changed_files_atomically(tree_source):
+    root = tree_source
+    tree = FileTree("tree", source="assets")
+    root.component += tree
+    root.component.deploy()
+    target = tree.path + "/css/site.css"
+    with open(target, "w") as f:
+        f.write("body { color: red }")
+    inode = os.stat(target).st_ino
+    with open(tree.path + "/unmanaged", "w") as f:
+        f.write("")
+    with patch("batou.utils.hash", wraps=batou.utils.hash) as hash:
+        root.component.deploy()
+    assert tree.changed
+    # Unchanged files were not read again.
+    assert [c[0][0] for c in hash.call_args_list] == [target]
+    with open(target) as f:
+        assert f.read() == "body {}"
+    assert os.stat(target).st_ino != inode
+    assert os.path.exists(tree.path + "/unmanaged")
+
+
+def test_filetree_purges_unmanaged_files(tree_source):
+    root = tree_source
+    tree = FileTree("tree", source="assets", purge=True)
+    root.component += tree
+    root.component.deploy()
+    os.makedirs(tree.path + "/old/deeper")
+    with open(tree.path + "/old/deeper/file", "w") as f:
+        f.write("")
+    root.component.deploy()
+    assert tree.changed
+    assert not os.path.exists(tree.path + "/old")
+    assert os.path.exists(tree.path + "/css/site.css")
+
+
+def test_filetree_purge_keeps_excluded_directories(tree_source):
+    root = tree_source
+    tree = FileTree(
+        "tree", source="assets", exclude=["cache/", "/tmp"], purge=True
+    )
+    root.component += tree
+    root.component.deploy()
+    for path in ["cache/x", "css/cache/y", "tmp/z", "stale"]:
+        os.makedirs(os.path.dirname(tree.path + "/" + path), exist_ok=True)
+        with open(tree.path + "/" + path, "w") as f:
+            f.write("")
+    root.component.deploy()
+    assert tree.changed
+    assert os.path.exists(tree.path + "/cache/x")
+    assert os.path.exists(tree.path + "/css/cache/y")
+    assert os.path.exists(tree.path + "/tmp/z")
+    assert not os.path.exists(tree.path + "/stale")
+    root.component.deploy()
+    assert not tree.changed
+
+
+def test_filetree_copies_symlinks(tree_source):
+    root = tree_source
+    os.symlink("css/site.css", "assets/style.css")
+    tree = FileTree("tree", source="assets", purge=True)
+    root.component += tree
+    root.component.deploy()
+    assert os.readlink(tree.path + "/style.css") == "css/site.css"
+    root.component.deploy()
+    assert not tree.changed
+    os.unlink("assets/style.css")
+    os.symlink("index.html", "assets/style.css")
+    root.component.deploy()
+    assert os.readlink(tree.path + "/style.css") == "index.html"
@@ -1,5 +1,6 @@
 import os.path
 
+import mock
 import pytest
 
 import batou.lib.git
@@ -380,3 +381,96 @@ def test_can_read_untracked_files_correctly(root, repos_path, git_main_branch):
             f.write(s)
     with git.chdir(git.target):
         assert set(git.untracked_files()) == set(fun_strings)
+
+
+def test_parse_probe_reads_branch_and_status():
+    state = batou.lib.git.parse_probe(
+        "https://example.com/repo\nv1.0\nv1.1\n\0"
+        "# branch.oid 1234\0"
+        "# branch.head main\0"
+        "# branch.upstream origin/main\0"
+        "# branch.ab +2 -3\0"
+        "2 R. N... 100644 100644 100644 1 2 R100 new name\0old name\0"
+        "? new file\0"
+    )
+    assert state == dict(
+        url="https://example.com/repo",
+        tags=["v1.0", "v1.1"],
+        revision="1234",
+        branch="main",
+        ahead=2,
+        behind=3,
+        changes=True,
+        untracked=["new file"],
+    )
+
+
+def test_parse_probe_clean_detached_clone():
+    state = batou.lib.git.parse_probe(
+        "https://example.com/repo\n\0"
+        "# branch.oid 1234\0"
+        "# branch.head (detached)\0"
+    )
+    assert state["branch"] == "HEAD"
+    assert state["tags"] == []
+    assert not state["changes"]
+    assert state["ahead"] == 0
+
+
+@pytest.mark.slow
+def test_verify_probes_clone_once(root, repos_path):
+    cmd("cd {dir}; git tag v1.0".format(dir=repos_path))
+    clone = batou.lib.git.Clone(repos_path, target="clone", tag="v1.0")
+    root.component += clone
+    root.component.deploy()
+    clone.probe = mock.Mock(wraps=clone.probe)
+    clone.has_incoming_changesets = mock.Mock(return_value="")
+    cache = clone.host.probe_cache
+    cache.invalidate()
+    misses = cache.misses
+    clone.verify()
+    clone.verify()
+    # The second verify is answered from the host's probe cache.
+    assert clone.probe.call_count == 2
+    assert cache.misses == misses + 1
+
+
+@pytest.mark.slow
+def test_clones_share_object_store(root, repos_path, git_main_branch):
+    first = batou.lib.git.Clone(
+        repos_path, target="first", branch=git_main_branch, shared_objects=True
+    )
+    second = batou.lib.git.Clone(
+        repos_path, target="second", branch=git_main_branch, shared_objects=True
+    )
+    root.component += first
+    root.component += second
+    second.cmd = mock.Mock(wraps=second.cmd)
+    root.component.deploy()
+    assert os.path.isfile(root.component.map("second/foo"))
+    with open(root.component.map("second/.git/objects/info/alternates")) as f:
+        assert f.read().strip() == first.object_store + "/objects"
+    # The store is set up by the first clone and not fetched again.
+    commands = [call[0][0] for call in second.cmd.call_args_list]
+    assert not [c for c in commands if "--mirror" in c or "--prune" in c]
+    # Clones rely on the store's objects, so it must never lose any.
+    stdout, _ = cmd("git -C {} config gc.auto".format(first.object_store))
+    assert stdout.strip() == "0"
+
+
+@pytest.mark.slow
+def test_clone_without_origin_is_cloned_again(
+    root, repos_path, git_main_branch
+):
+    git = batou.lib.git.Clone(
+        repos_path, target="clone", branch=git_main_branch
+    )
+    root.component += git
+    root.component.deploy()
+    with git.chdir(git.target):
+        cmd("git remote remove origin")
+        with open("untracked", "w") as f:
+            f.write("")
+        assert git.untracked_files() == ["untracked"]
+    root.component.deploy()
+    assert git.remote_url() == repos_path
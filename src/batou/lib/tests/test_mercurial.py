@@ -84,6 +84,31 @@ def test_set_revision_does_not_pull_when_revision_matches(root, repos_path):
     assert "changeset:   1" in stdout
 
 
+@pytest.mark.slow
+def test_update_to_present_revision_does_not_pull(root, repos_path):
+    clone = batou.lib.mercurial.Clone(
+        repos_path, target="clone", branch="default"
+    )
+    root.component += clone
+    root.component.deploy()
+    clone.revision = clone.current_revision()
+    clone.branch = None
+    cmd(
+        'cd {dir}; touch bar; hg addremove; hg ci -m "commit"'.format(
+            dir=repos_path
+        )
+    )
+    cmd("cd {dir}/clone; echo foobar >foo".format(dir=root.workdir))
+    root.component.deploy()
+    assert clone.changed
+    with open(root.component.map("clone/foo")) as f:
+        assert not f.read()
+    stdout, stderr = cmd(
+        "cd {workdir}/clone; LANG=C hg incoming".format(workdir=root.workdir)
+    )
+    assert "changeset:   1" in stdout
+
+
 @pytest.mark.slow
 def test_set_revision_does_not_change_when_long_revision_matches(
     root, repos_path
@@ -205,3 +230,57 @@ def test_clean_clone_vcs_update_false_leaves_changes_intact(root, repos_path):
     with open(root.component.map("clone/foo")) as f:
         assert "asdf\n" == f.read()
     assert not os.path.exists(root.component.map("clone/bar"))
+
+
+def test_parse_probe_reads_parent_and_status():
+    state = batou.lib.mercurial.parse_probe(
+        '[\n {"branch": "default", "date": [1600000000, -7200],'
+        ' "node": "' + 40 * "a" + '", "rev": 3}\n]\n'
+        '[\n {"path": "foo", "status": "M"},\n'
+        ' {"path": "bar/baz qux", "status": "?"}\n]\n'
+        '[\n {"node": "' + 40 * "b" + '", "rev": 4}\n]\n'
+    )
+    assert state == dict(
+        revision=40 * "a",
+        branch="default",
+        date=1600007200.0,
+        changes=True,
+        untracked=["bar/baz qux"],
+        outgoing=True,
+    )
+
+
+def test_parse_probe_empty_clean_clone():
+    state = batou.lib.mercurial.parse_probe(
+        '[\n {"branch": "default", "date": [0, 0],'
+        ' "node": "' + 40 * "0" + '", "rev": -1}\n]\n[\n]\n[\n]\n'
+    )
+    assert state["revision"] is None
+    assert not state["changes"]
+    assert state["untracked"] == []
+    assert not state["outgoing"]
+
+
+@pytest.mark.slow
+def test_shared_store_clones_share_history(root, repos_path):
+    first = batou.lib.mercurial.Clone(
+        repos_path, target="first", branch="default", shared_store=True
+    )
+    second = batou.lib.mercurial.Clone(
+        repos_path, target="second", branch="default", shared_store=True
+    )
+    root.component += first
+    root.component += second
+    root.component.deploy()
+    assert os.path.isfile(root.component.map("second/foo"))
+    with open(root.component.map("second/.hg/sharedpath")) as f:
+        assert f.read().startswith(first.store)
+    cmd(
+        'cd {dir}; touch bar; hg addremove; hg ci -m "commit"'.format(
+            dir=repos_path
+        )
+    )
+    batou.lib.mercurial._pulled_stores.clear()
+    root.component.deploy()
+    assert os.path.isfile(root.component.map("first/bar"))
+    assert os.path.isfile(root.component.map("second/bar"))
@@ -1,5 +1,148 @@
-# Ensure we're at least import-ready.
+import sys
+
+import pytest
 
 import batou.lib.mysql
+from batou import UpdateNeeded
+from batou.lib.mysql import Command
+from batou.utils import CmdExecutionError
+
+# A stand-in for the mysql client: echoes `SELECT '<value>';` statements,
+# stops at `FAIL` statements, warns at length about `WARN` statements, stops
+# reading statements after `HANG`, records reconnects and everything else
+# and reports its own start.
+FAKE_CLIENT = """\
+import sys
+sys.stderr.write("Warning: Using a password is insecure.\\n")
+sys.stderr.flush()
+with open("starts", "a") as f:
+    f.write("start\\n")
+
+
+def run(statement):
+    statement = statement.strip()
+    if not statement:
+        return
+    if statement.startswith("SELECT '"):
+        print(statement[len("SELECT '"):-1], flush=True)
+    elif statement.startswith("FAIL"):
+        sys.stderr.write("ERROR 1064: " + statement + "\\n")
+        sys.exit(1)
+    elif statement.startswith("WARN"):
+        sys.stderr.write("Warning (Code 1287): " + statement + "\\n")
+        sys.stderr.write("x" * 1000000 + "\\n")
+        sys.stderr.flush()
+    elif statement.startswith("HANG"):
+        # Like an unterminated string that swallows the marker.
+        sys.stdin.read()
+    elif statement.startswith("QUIT"):
+        sys.exit(1)
+    else:
+        with open("statements", "a") as f:
+            f.write(statement + "\\n")
+
+
+buffer = ""
+for line in sys.stdin:
+    if line.startswith("\\\\g"):
+        run(buffer)
+        buffer = ""
+        continue
+    if line.startswith("\\\\r"):
+        with open("statements", "a") as f:
+            f.write(line)
+        continue
+    if line.startswith("\\\\"):
+        continue
+    buffer += line
+    while ";" in buffer:
+        statement, buffer = buffer.split(";", 1)
+        run(statement)
+"""
+
+
+@pytest.fixture
+def mysql(root, monkeypatch):
+    with open(root.workdir + "/fake_mysql.py", "w") as f:
+        f.write(FAKE_CLIENT)
+    monkeypatch.setattr(
+        Command,
+        "_client_command",
+        lambda self: "{} -u {}/fake_mysql.py".format(
+            sys.executable, root.workdir
+        ),
+    )
+    yield root
+    batou.lib.mysql.close_sessions()
+
+
+def test_commands_share_one_client_session(mysql):
+    mysql.component += Command("CREATE DATABASE foo", unless="SELECT 'bar'")
+    mysql.component += Command("CREATE DATABASE baz", unless="")
+    mysql.component.deploy()
+    with open(mysql.workdir + "/starts") as f:
+        assert f.read() == "start\n"
+    # The client reconnects after each statement to reset the session.
+    with open(mysql.workdir + "/statements") as f:
+        assert f.read() == ("\\r mysql\nCREATE DATABASE baz\n\\r mysql\n")
+
+
+def test_unless_output_is_attributed_to_its_command(mysql):
+    command = Command("CREATE DATABASE foo", unless="SELECT 'bar'")
+    mysql.component += command
+    with mysql.component.chdir(mysql.workdir):
+        assert command._mysql("SELECT 'bar'") == ("bar\n", "")
+        assert command._mysql("SELECT 'baz';") == ("baz\n", "")
+        command.unless = ""
+        with pytest.raises(UpdateNeeded):
+            command.verify()
+
+
+def test_failing_statement_stops_and_restarts_client(mysql):
+    command = Command("FAIL here; CREATE DATABASE foo")
+    mysql.component += command
+    with mysql.component.chdir(mysql.workdir):
+        with pytest.raises(CmdExecutionError) as e:
+            command.update()
+        assert e.value.cmd == "FAIL here; CREATE DATABASE foo"
+        assert e.value.stderr == "ERROR 1064: FAIL here\n"
+        assert command._mysql("SELECT 'ok'") == ("ok\n", "")
+    with open(mysql.workdir + "/starts") as f:
+        assert f.read() == "start\nstart\n"
+    # The statements after the failing one were not run.
+    with open(mysql.workdir + "/statements") as f:
+        assert f.read() == "\\r mysql\n"
+
+
+def test_dead_client_is_reported_and_restarted(mysql):
+    command = Command("QUIT")
+    mysql.component += command
+    with mysql.component.chdir(mysql.workdir):
+        with pytest.raises(CmdExecutionError) as e:
+            command.update()
+        assert e.value.returncode == 1
+        assert command._mysql("SELECT 'ok'") == ("ok\n", "")
+    with open(mysql.workdir + "/starts") as f:
+        assert f.read() == "start\nstart\n"
+
+
+def test_warnings_are_returned_without_blocking(mysql):
+    command = Command("WARN here")
+    mysql.component += command
+    with mysql.component.chdir(mysql.workdir):
+        out, err = command._mysql("WARN here")
+    assert out == ""
+    assert err.startswith("Warning (Code 1287): WARN here\n")
+    assert len(err) > 1000000
+
 
-batou.lib.mysql  # Ensure the unused import doesn't bark.
+def test_hanging_statement_times_out_and_restarts_client(mysql):
+    command = Command("HANG 'unterminated", timeout=0.5)
+    mysql.component += command
+    with mysql.component.chdir(mysql.workdir):
+        with pytest.raises(CmdExecutionError) as e:
+            command.update()
+        assert "Timed out" in e.value.stderr
+        assert command._mysql("SELECT 'ok'") == ("ok\n", "")
+    with open(mysql.workdir + "/starts") as f:
+        assert f.read() == "start\nstart\n"
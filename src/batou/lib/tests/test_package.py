@@ -0,0 +1,66 @@
+import mock
+
+from batou.component import Component
+from batou.lib.package import DPKG
+
+
+class AptSource(Component):
+    def verify(self):
+        pass
+
+
+def deploy_packages(root, components):
+    installed = {"c"}
+    calls = []
+
+    def run(command, *args, **kw):
+        calls.append(command)
+        stdout = "".join("{}\tinstall\n".format(p) for p in sorted(installed))
+        return stdout, ""
+
+    def install(self, command, *args, **kw):
+        calls.append(command)
+        installed.update(command.split("install ")[1].split())
+        return "", ""
+
+    for component in components:
+        root.component += component
+    with mock.patch("batou.utils.cmd", run):
+        with mock.patch.object(DPKG, "cmd", install):
+            root.component.deploy()
+    return calls
+
+
+def test_dpkg_shares_selections_and_installs_adjacent_packages_at_once(root):
+    calls = deploy_packages(root, [DPKG("a"), DPKG("b"), DPKG("c")])
+    assert calls == [
+        "LANG=C dpkg --get-selections",
+        "LANG=C apt-get -qy install a b",
+        "LANG=C dpkg --get-selections",
+    ]
+
+
+def test_dpkg_keeps_the_order_relative_to_other_components(root):
+    calls = deploy_packages(
+        root, [DPKG("a"), AptSource(), DPKG("b"), DPKG("c"), DPKG("d")]
+    )
+    assert calls == [
+        "LANG=C dpkg --get-selections",
+        "LANG=C apt-get -qy install a",
+        "LANG=C dpkg --get-selections",
+        "LANG=C apt-get -qy install b d",
+        "LANG=C dpkg --get-selections",
+    ]
+
+
+def test_dpkg_sees_packages_removed_by_other_components(root):
+    root.component += DPKG("c")
+    selections = ["c\tinstall\n", "c\tdeinstall\n"]
+    with mock.patch("batou.utils.cmd", lambda *a, **kw: (selections[0], "")):
+        root.component.deploy()
+    # Another component removed the package in the meantime.
+    root.host.probe_cache.invalidate()
+    with mock.patch("batou.utils.cmd", lambda *a, **kw: (selections[1], "")):
+        with mock.patch.object(DPKG, "cmd") as cmd:
+            root.component.deploy()
+    cmd.assert_called_once_with("LANG=C apt-get -qy install c")
@@ -1,9 +1,12 @@
+import os
 import sys
 
+import mock
 import pytest
 
+import batou
 from batou.component import Component
-from batou.lib.python import VirtualEnv
+from batou.lib.python import Package, VirtualEnv
 
 
 @pytest.mark.skipif(
@@ -55,3 +58,76 @@ def test_venv_does_not_update_if_python_does_not_change(root):
     assert playground.changed
     playground.deploy()
     assert not playground.changed
+
+
+@pytest.fixture
+def venv(root):
+    """A virtualenv component whose interpreter is the one running the tests.
+
+    This allows inspecting the virtualenv without creating one.
+
+    """
+    venv = VirtualEnv("{}.{}".format(*sys.version_info[:2]))
+    root.component += venv
+    os.makedirs(venv.workdir + "/bin", exist_ok=True)
+    os.symlink(sys.executable, venv.workdir + "/bin/python")
+    return venv
+
+
+def test_venv_state_reports_version_and_distributions(venv):
+    with venv.chdir(venv.workdir):
+        state = venv.venv.venv_state()
+    assert state["version"] == list(sys.version_info[:3])
+    assert state["pip"]
+    assert state["distributions"]["pytest"] == pytest.__version__
+
+
+def test_package_verify_uses_single_interpreter_call(venv):
+    venv.venv.cmd = mock.Mock(wraps=venv.venv.cmd)
+    current = Package("PyTest", version=pytest.__version__)
+    outdated = Package("mock", version="0.0.1")
+    missing = Package("batou-no-such-package", version="1.0")
+    venv += current
+    venv += outdated
+    venv += missing
+    with venv.chdir(venv.workdir):
+        venv.venv.verify()
+        current.verify()
+        with pytest.raises(batou.UpdateNeeded):
+            outdated.verify()
+        with pytest.raises(batou.UpdateNeeded):
+            missing.verify()
+    assert venv.venv.cmd.call_count == 1
+
+
+def test_outdated_packages_are_installed_with_one_pip_call(venv):
+    venv.venv.cmd = mock.Mock(return_value=("", ""))
+    venv.venv._venv_state = {
+        "version": list(sys.version_info[:3]),
+        "pip": True,
+        "distributions": {"a": "1.0", "b-c": "1.0"},
+    }
+    a = Package("a", version="2.0")
+    bc = Package("b_c", version="2.0")
+    d = Package("d", version="1.0", dependencies=False)
+    for pkg in [a, bc, d]:
+        venv += pkg
+    a.update()
+    command = venv.venv.cmd.call_args[0][0]
+    assert 'install  "a==2.0" "b_c==2.0"' in command
+    assert "d==1.0" not in command
+
+
+def test_package_with_extras_or_markers_matches_installed_distribution(venv):
+    venv.venv._venv_state = {
+        "version": list(sys.version_info[:3]),
+        "pip": True,
+        "distributions": {"foo-bar": "1.0"},
+    }
+    with_extras = Package("Foo.Bar[baz]", version="1.0")
+    with_marker = Package('foo_bar; python_version >= "3"', version="1.0")
+    venv += with_extras
+    venv += with_marker
+    with venv.chdir(venv.workdir):
+        with_extras.verify()
+        with_marker.verify()
@@ -1,5 +1,7 @@
 import os.path
+import xmlrpc.client
 
+import mock
 import pytest
 
 import batou.lib.supervisor
@@ -102,3 +104,85 @@ def test_setting_nagios_to_True_creates_a_nagios_nrpe_service(root):
     assert "NRPEService" in [
         x.__class__.__name__ for x in supervisor.sub_components
     ]
+
+
+@pytest.fixture
+def programs(root):
+    supervisor = batou.lib.supervisor.Supervisor()
+    root.component += supervisor
+    programs = []
+    for name in ["a", "b", "c"]:
+        program = batou.lib.supervisor.Program(name, command="bin/" + name)
+        root.component += program
+        programs.append(program)
+    root.component.configure()
+    supervisor._rpc = mock.Mock()
+    supervisor._rpc.getAllProcessInfo.return_value = [
+        {"name": "a", "statename": "RUNNING"},
+        {"name": "b", "statename": "STOPPED"},
+    ]
+    supervisor._rpc.reloadConfig.return_value = [[["c"], ["b"], []]]
+    os.makedirs(supervisor.program_config_dir.path)
+    return supervisor, programs
+
+
+def test_programs_share_one_process_info_snapshot(programs):
+    supervisor, (a, b, c) = programs
+    assert a.is_running()
+    assert not b.is_running()
+    assert not c.is_running()
+    assert supervisor.rpc.getAllProcessInfo.call_count == 1
+
+
+def test_program_config_is_only_applied_if_changed(programs):
+    supervisor, (a, b, c) = programs
+    b.update()
+    c.update()
+    assert supervisor.rpc.reloadConfig.call_count == 1
+    assert supervisor.rpc.addProcessGroup.call_args_list == [
+        mock.call("b"),
+        mock.call("c"),
+    ]
+    assert supervisor.rpc.startProcess.call_args_list == [
+        mock.call("b", True),
+        mock.call("c", True),
+    ]
+    with open(supervisor.program_config_dir.path + "/c.conf", "w") as f:
+        f.write("[program:c]")
+    c.update()
+    assert supervisor.rpc.reloadConfig.call_count == 2
+
+
+def test_program_started_by_config_update_is_not_restarted(programs):
+    supervisor, (a, b, c) = programs
+    supervisor.rpc.getAllProcessInfo.side_effect = [
+        [{"name": "b", "statename": "STARTING"}],
+        [{"name": "b", "statename": "RUNNING"}],
+    ]
+    b.update()
+    assert supervisor.rpc.addProcessGroup.call_args_list == [
+        mock.call("b"),
+        mock.call("c"),
+    ]
+    assert not supervisor.rpc.stopProcess.called
+    assert not supervisor.rpc.startProcess.called
+
+
+def test_program_that_fails_after_config_update_raises(programs):
+    supervisor, (a, b, c) = programs
+    supervisor.rpc.getAllProcessInfo.return_value = [
+        {"name": "b", "statename": "FATAL"}
+    ]
+    with pytest.raises(RuntimeError) as e:
+        b.update()
+    assert str(e.value) == 'Program "b" did not start up: FATAL'
+
+
+def test_program_that_does_not_start_raises(programs):
+    supervisor, (a, b, c) = programs
+    supervisor.rpc.startProcess.side_effect = xmlrpc.client.Fault(
+        60, "ABNORMAL_TERMINATION"
+    )
+    with pytest.raises(RuntimeError) as e:
+        a.update()
+    assert str(e.value) == 'Program "a" did not start up: ABNORMAL_TERMINATION'
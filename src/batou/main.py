@@ -1,4 +1,5 @@
 import argparse
+import importlib
 import os
 import os.path
 import sys
@@ -8,13 +9,33 @@ from importlib.metadata import version as get_version
 from typing import Optional
 
 import batou
-import batou.deploy
 import batou.migrate
-import batou.secrets.edit
-import batou.secrets.encryption
-import batou.secrets.manage
 from batou._output import TerminalBackend, output
 
+# Modules which carry a module-level `debug` flag that is set from the
+# global `--debug` argument once they have been imported.
+DEBUG_MODULES = ("batou.secrets.encryption", "batou.secrets.manage")
+
+
+class Command(object):
+    """Reference to a subcommand's entry point that is imported lazily.
+
+    Importing all subcommand modules up front pulls in the whole deployment
+    machinery (environment, components, templating, secrets) even for
+    `./batou --help`, which is also run remotely to bootstrap appenv.
+
+    """
+
+    def __init__(self, spec):
+        self.module, _, self.__name__ = spec.partition(":")
+
+    def load(self):
+        module = importlib.import_module(self.module)
+        return getattr(module, self.__name__)
+
+    def __call__(self, *args, **kw):
+        return self.load()(*args, **kw)
+
 
 def main(args: Optional[list] = None) -> None:
     os.chdir(os.environ["APPENV_BASEDIR"])
@@ -79,7 +100,8 @@ def main(args: Optional[list] = None) -> None:
         dest="check_and_predict_local",
         help="When running in consistency-only or predict-only mode, "
         "do not connect to the remote host, but check and predict "
-        "using the local host's state.",
+        "using the local host's state. The consistency check "
+        "configures all hosts in parallel local processes.",
     )
     p.add_argument(
         "-j",
@@ -99,10 +121,12 @@ def main(args: Optional[list] = None) -> None:
     )
     p.add_argument(
         "environment",
-        help="Environment to deploy.",
+        nargs="+",
+        help="Environment(s) to deploy. Several environments are "
+        "deployed at the same time.",
         type=lambda x: x.replace(".cfg", ""),
     )
-    p.set_defaults(func=batou.deploy.main)
+    p.set_defaults(func=Command("batou.deploy:main"))
 
     # SECRETS
     secrets = subparsers.add_parser(
@@ -144,12 +168,12 @@ def main(args: Optional[list] = None) -> None:
         nargs="?",
         help="Sub-file to edit. (i.e. secrets/{environment}-{subfile}",
     )
-    p.set_defaults(func=batou.secrets.edit.main)
+    p.set_defaults(func=Command("batou.secrets.edit:main"))
 
     p = sp.add_parser(
         "summary", help="Give a summary of secret files and who has access."
     )
-    p.set_defaults(func=batou.secrets.manage.summary)
+    p.set_defaults(func=Command("batou.secrets.manage:summary"))
 
     p = sp.add_parser(
         "add", help="Add a user's key to one or more secret files."
@@ -161,7 +185,7 @@ def main(args: Optional[list] = None) -> None:
         default="",
         help="The environments to update. Update all if not specified.",
     )
-    p.set_defaults(func=batou.secrets.manage.add_user)
+    p.set_defaults(func=Command("batou.secrets.manage:add_user"))
 
     p = sp.add_parser(
         "remove", help="Remove a user's key from one or more secret files."
@@ -173,7 +197,7 @@ def main(args: Optional[list] = None) -> None:
         default="",
         help="The environments to update. Update all if not specified.",
     )
-    p.set_defaults(func=batou.secrets.manage.remove_user)
+    p.set_defaults(func=Command("batou.secrets.manage:remove_user"))
 
     p = sp.add_parser(
         "reencrypt",
@@ -191,7 +215,7 @@ def main(args: Optional[list] = None) -> None:
         action="store_true",
         help="Force re-encryption even if keys have not changed.",
     )
-    p.set_defaults(func=batou.secrets.manage.reencrypt)
+    p.set_defaults(func=Command("batou.secrets.manage:reencrypt"))
 
     p = sp.add_parser(
         "decrypttostdout",
@@ -202,7 +226,7 @@ def main(args: Optional[list] = None) -> None:
         "file",
         help="The secret file to decrypt, should be contained in an environment.",
     )
-    p.set_defaults(func=batou.secrets.manage.decrypt_to_stdout)
+    p.set_defaults(func=Command("batou.secrets.manage:decrypt_to_stdout"))
 
     # migrate
     migrate = subparsers.add_parser(
@@ -226,11 +250,6 @@ def main(args: Optional[list] = None) -> None:
 
     args = parser.parse_args(args)
 
-    # Consume global arguments
-    batou.output.enable_debug = args.debug
-    batou.secrets.encryption.debug = args.debug
-    batou.secrets.manage.debug = args.debug
-
     # Pass over to function
     if args.func.__name__ == "print_usage":
         args.func()
@@ -240,11 +259,21 @@ def main(args: Optional[list] = None) -> None:
         output.backend = TerminalBackend()
         batou.migrate.assert_up_to_date()
 
+    func = args.func
+    if isinstance(func, Command):
+        func = func.load()
+
+    # Consume global arguments
+    batou.output.enable_debug = args.debug
+    for name in DEBUG_MODULES:
+        if name in sys.modules:
+            sys.modules[name].debug = args.debug
+
     func_args = dict(args._get_kwargs())
     del func_args["func"]
     del func_args["debug"]
     try:
-        return args.func(**func_args)
+        return func(**func_args)
     except batou.FileLockedError as e:
         # Nicer error reporting for non-deployment commands.
         print(e)
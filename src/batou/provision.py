@@ -18,6 +18,22 @@ def bool_arg(arg: str, state: bool) -> str:
     return f"--{toggle}{arg}"
 
 
+def write_file(path, content, mode=None):
+    """Replace the file at `path` atomically with `content`."""
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + "."
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 class Provisioner(object):
     rebuild = False
 
@@ -118,6 +134,13 @@ fi
         self._known_ssh_hosts = {}
 
     def _prepare_ssh(self, host):
+        # Hosts are provisioned in parallel, also by environments that are
+        # deployed at the same time. They share the key and the known hosts
+        # file, and the hosts of an environment share the SSH configuration.
+        with batou.utils.shared_files_locked():
+            self._prepare_ssh_locked(host)
+
+    def _prepare_ssh_locked(self, host):
         # XXX application / user-specific files
         # https://unix.stackexchange.com/questions/312988/understanding-home-configuration-file-locations-config-and-local-sha
         KNOWN_HOSTS_FILE = os.path.expanduser("~/.batou/known_hosts")
@@ -139,10 +162,8 @@ fi
             os.path.dirname(__file__), "insecure-private.key"
         )
         local_insecure_key = os.path.abspath("insecure-private.key")
-        with open(local_insecure_key, "w") as f_target:
-            with open(packaged_insecure_key) as f_packaged:
-                f_target.write(f_packaged.read())
-        os.chmod(local_insecure_key, 0o600)
+        with open(packaged_insecure_key) as f_packaged:
+            write_file(local_insecure_key, f_packaged.read(), 0o600)
 
         self._known_ssh_hosts[host.name] = """
 Host {hostname} {aliases}
@@ -182,8 +203,9 @@ Host {hostname} {aliases}
         self.ssh_config_file = os.path.abspath(
             "ssh_config_{}".format(host.environment.name)
         )
-        with open(self.ssh_config_file, "w") as f:
-            f.write("\n".join(ssh_config))
+        # Connectors of hosts that are provisioned already may be reading
+        # the config at the same time.
+        write_file(self.ssh_config_file, "\n".join(ssh_config))
 
     def configure_host(self, host, config):
         # Extract provisioning-specific config from host
@@ -1,9 +1,12 @@
+import contextlib
+import hashlib
 import json
 import os
 import os.path
 import pickle
 import pwd
 import subprocess
+import threading
 import traceback
 
 # Satisfy flake8 and support testing.
@@ -32,6 +35,17 @@ class Output(object):
         self.backend = backend
         self._buffer = []
         self._flushing = False
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def prefix(self, prefix):
+        """Prefix the lines written by the current thread with `prefix`."""
+        previous = getattr(self._local, "prefix", None)
+        self._local.prefix = prefix
+        try:
+            yield
+        finally:
+            self._local.prefix = previous
 
     # Helpers to allow constructing output with reordering and in a distributed
     # fashion.
@@ -66,6 +80,11 @@ class Output(object):
         if not message.strip():
             # Clean out lines which only contain whitespace.
             message = ""
+        prefix = getattr(self._local, "prefix", None)
+        if prefix:
+            message = "\n".join(
+                f"{prefix}: {line}" for line in message.split("\n")
+            )
         self.backend.line(message, **format)
 
     def annotate(self, message, debug=False, icon=False, **format):
@@ -161,6 +180,8 @@ class Deployment(object):
         timeout,
         platform,
         os_env=None,
+        resolve_cache=None,
+        resolve_v6_cache=None,
     ):
         self.env_name = env_name
         self.host_name = host_name
@@ -173,6 +194,8 @@ class Deployment(object):
         self.timeout = timeout
         self.platform = platform
         self.os_env = os_env
+        self.resolve_cache = resolve_cache or {}
+        self.resolve_v6_cache = resolve_v6_cache or {}
 
     def load(self):
         from batou.environment import Environment
@@ -186,21 +209,33 @@ class Deployment(object):
         self.environment.load()
         self.environment.overrides = self.overrides
 
-        from batou.utils import resolve_override, resolve_v6_override
+        from batou.utils import (
+            resolve_cache,
+            resolve_override,
+            resolve_v6_cache,
+            resolve_v6_override,
+        )
 
         resolve_override.update(self.resolve_override)
         resolve_v6_override.update(self.resolve_v6_override)
+        # Addresses that the controller already resolved.
+        resolve_cache.update(self.resolve_cache)
+        resolve_v6_cache.update(self.resolve_v6_cache)
 
         for hostname, data in self.host_data.items():
             self.environment.hosts[hostname].data.update(data)
         self.environment.secret_files = self.secret_files
         self.environment.secret_data = self.secret_data
-        return self.environment.configure()
+        self.environment.prefetch_addresses()
+        errors = self.environment.configure()
+        self.environment.save_resolver_cache()
+        return errors
 
     def deploy(self, root, predict_only):
         host = self.environment.get_host(self.host_name)
         root = self.environment.get_root(root, host)
         root.component.deploy(predict_only)
+        host.probe_cache.report(host.name)
 
 
 def lock():
@@ -374,9 +409,49 @@ def git_update_working_copy(branch):
     return id.strip().decode("ascii")
 
 
+# Files in the deployment base that determine what appenv builds. Their
+# fingerprint is recorded after a successful build so that the controller can
+# skip rebuilding if nothing changed.
+APPENV_FILES = ("appenv", "batou", "requirements.txt", "requirements.lock")
+APPENV_STAMP = ".appenv/batou.built"
+
+
+def appenv_fingerprint(base):
+    h = hashlib.sha256()
+    for name in APPENV_FILES:
+        h.update(name.encode("ascii") + b"\0")
+        try:
+            with open(os.path.join(base, name), "rb") as f:
+                h.update(f.read())
+        except FileNotFoundError:
+            h.update(b"<missing>")
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def appenv_built():
+    """Return the fingerprint of the last successful appenv build.
+
+    Returns `None` if batou was never built or if appenv's current
+    environment is not ready (anymore).
+
+    """
+    ready = os.path.join(deployment_base, ".appenv", "current", "appenv.ready")
+    if not os.path.exists(ready):
+        return None
+    try:
+        with open(os.path.join(deployment_base, APPENV_STAMP)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
 def build_batou():
     os.chdir(deployment_base)
     cmd("./batou --help")
+    os.makedirs(os.path.dirname(APPENV_STAMP), exist_ok=True)
+    with open(APPENV_STAMP, "w") as f:
+        f.write(appenv_fingerprint("."))
 
 
 def setup_deployment(*args):
@@ -403,6 +478,22 @@ def root_dependencies():
     return deps
 
 
+def missing_artifacts():
+    from batou.lib.download import missing_artifacts
+
+    environment = deployment.environment
+    host = environment.get_host(deployment.host_name)
+    return missing_artifacts(environment, host)
+
+
+def receive_artifact(key, data, offset):
+    deployment.environment.artifacts.receive(key, data, offset)
+
+
+def commit_artifact(key):
+    deployment.environment.artifacts.commit(key)
+
+
 def whoami():
     return pwd.getpwuid(os.getuid()).pw_name
 
@@ -9,13 +9,9 @@ Jinja2::
 
 """
 
-# There is a weird bug going on with Jinja2 on Python3.6 where this
-# test fails if Jinja tries to import ctypes itself ... o_O
-import ctypes
+import functools
 import io
 
-import jinja2
-
 from batou import TemplatingError, output
 
 
@@ -34,6 +30,8 @@ class TemplateEngine(object):
 
     def template(self, sourcefile, args):
         """Render template from `sourcefile` and return the value."""
+        import jinja2
+
         try:
             return self._render_template_file(sourcefile, args).getvalue()
         except jinja2.exceptions.TemplateError as e:
@@ -48,19 +46,44 @@ class TemplateEngine(object):
         raise NotImplementedError
 
 
+@functools.lru_cache(maxsize=None)
+def _jinja2_environment():
+    # Jinja2 is imported lazily as it is a noticeable part of
+    # batou's startup time and not needed by every subcommand.
+    import jinja2
+
+    return jinja2.Environment(
+        line_statement_prefix="@@",
+        keep_trailing_newline=True,
+        undefined=jinja2.StrictUndefined,
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(templatestr, filename=None):
+    """Return the compiled template for `templatestr`.
+
+    Compiling is the expensive part of rendering small templates. As the
+    same templates are expanded over and over again (e.g. for every command
+    of a component or for the files of many components) the compiled
+    templates are cached by their source and the file name that errors are
+    reported for.
+
+    """
+    env = _jinja2_environment()
+    code = env.compile(templatestr, filename=filename)
+    return env.template_class.from_code(env, code, env.make_globals(None))
+
+
 class Jinja2Engine(TemplateEngine):
     def __init__(self, *args, **kwargs):
         super(Jinja2Engine, self).__init__(*args, **kwargs)
-        self.env = jinja2.Environment(
-            line_statement_prefix="@@",
-            keep_trailing_newline=True,
-            undefined=jinja2.StrictUndefined,
-        )
+        self.env = _jinja2_environment()
 
     def _render_template_file(self, sourcefile, args):
         with open(sourcefile) as f:
             tmpl = f.read()
-        tmpl = self.env.from_string(tmpl)
+        tmpl = _compile(tmpl, sourcefile)
         output = io.StringIO()
         print(tmpl.render(args), file=output)
         return output
@@ -75,8 +98,7 @@ class Jinja2Engine(TemplateEngine):
             )
             output.annotate(templatestr[:100])
         try:
-            tmpl = self.env.from_string(templatestr)
-            tmpl.filename = identifier
+            tmpl = _compile(templatestr, identifier)
             return tmpl.render(**args)
         except Exception as e:
             raise TemplatingError.from_context(e, identifier)
@@ -384,6 +384,48 @@ def test_cmd_returns_output_if_ignore_returncode(mockroot):
     assert "important output\n" == out
 
 
+def test_probe_shares_results_between_components(root, tmpdir):
+    counter = str(tmpdir / "counter")
+    command = "echo x >> {} && wc -l < {}".format(counter, counter)
+    a, b = Component(), Component()
+    root.component += a
+    root.component += b
+    assert a.probe(command) == ("1\n", "")
+    assert b.probe(command) == ("1\n", "")
+    assert a.cmd(command) == ("2\n", "")
+    assert root.host.probe_cache.hits == 1
+    assert root.host.probe_cache.misses == 1
+
+
+def test_probe_remembers_failures(root):
+    c = Component()
+    root.component += c
+    for i in range(2):
+        with pytest.raises(CmdExecutionError) as e:
+            c.probe("echo failed && false")
+        assert e.value.returncode == 1
+    assert c.probe("echo failed && false", ignore_returncode=True) == (
+        "failed\n",
+        "",
+    )
+    assert root.host.probe_cache.misses == 1
+
+
+def test_probe_cache_invalidated_after_update(root, tmpdir):
+    counter = str(tmpdir / "counter")
+
+    class Probing(Component):
+        def verify(self):
+            self.probe("echo x >> {}".format(counter))
+            raise UpdateNeeded()
+
+    root.component += Probing()
+    root.component += Probing()
+    root.component.deploy()
+    with open(counter) as f:
+        assert f.read() == "x\nx\n"
+
+
 def test_touch_creates_new_file(tmpdir):
     reference = str(tmpdir / "reference")
     assert not os.path.exists(reference)
@@ -1,5 +1,7 @@
 import os
+import threading
 
+import mock
 import pytest
 
 from batou.tests.ellipsis import Ellipsis
@@ -104,3 +106,220 @@ ERROR: No host found in environment.
 ... DEPLOYMENT FAILED (during connect) ...
 """
     )  # noqa: E501 line too long
+
+
+def test_error_classes_group_errors_by_merge_key():
+    from batou import ConfigurationError, ReportingException
+    from batou.deploy import ErrorClasses
+
+    classes = ErrorClasses()
+    with mock.patch.object(
+        ReportingException, "should_merge", side_effect=AssertionError
+    ):
+        for i in reversed(range(200)):
+            error = ConfigurationError.from_context("broken")
+            error.affected_hostname = "host{}".format(i)
+            classes.add("host{}".format(i), error, (i, 1))
+        first = ConfigurationError.from_context("first")
+        classes.add("host100", first, (100, 0))
+
+    merged = classes.merged()
+    assert len(merged) == 2
+    reporting, affected, error = merged[0]
+    assert error.message == "broken"
+    assert len(reporting) == len(affected) == 200
+    assert merged[1][2].message == "first"
+
+
+def test_error_classes_fall_back_to_should_merge():
+    from batou import ConfigurationError
+    from batou.deploy import ErrorClasses
+
+    classes = ErrorClasses()
+    for hostname in ["host1", "host2"]:
+        error = ConfigurationError.from_context("broken")
+        error.data = bytearray(b"unhashable")
+        classes.add(hostname, error)
+    assert len(classes.merged()) == 1
+
+
+def provisioning_deployment(hosts):
+    from batou.deploy import Deployment
+
+    deployment = Deployment("test", None, None, False, 1)
+    deployment.environment.provisioners = {"dev": mock.Mock()}
+    deployment.environment.hosts = {}
+    for name, provision in hosts.items():
+        host = mock.Mock()
+        host.name = name
+        host.provisioner.name = "dev"
+        host.provisioner.rebuild = False
+        host.provisioner.provision.side_effect = provision
+        deployment.environment.hosts[name] = host
+    return deployment
+
+
+def test_provision_runs_hosts_in_parallel_with_prefixed_output(output):
+    from batou import output as batou_output
+
+    barrier = threading.Barrier(2, timeout=10)
+
+    def provision(host):
+        # Only passes if both hosts are provisioned at the same time.
+        barrier.wait()
+        batou_output.annotate("seeding")
+
+    deployment = provisioning_deployment(
+        {"host1": provision, "host2": provision}
+    )
+    deployment.provision()
+    for future in deployment._provisioning.values():
+        future.result()
+    assert "host1: seeding" in output.backend.output
+    assert "host2: seeding" in output.backend.output
+
+
+def test_failed_provisioning_only_affects_its_host():
+    from batou.deploy import Connector
+
+    def fail(host):
+        raise RuntimeError("provisioning failed")
+
+    deployment = provisioning_deployment({"broken": fail, "good": None})
+    deployment.provision()
+    deployment._provisioning["good"].result()
+
+    broken = deployment.environment.hosts["broken"]
+    connector = Connector(
+        broken, threading.Semaphore(), None, deployment._provisioning["broken"]
+    )
+    connector.start()
+    with pytest.raises(RuntimeError):
+        connector.join()
+    assert not broken.connect.called
+
+
+def test_local_consistency_check_configures_all_hosts(sample_service):
+    from batou.deploy import ConfigureErrors, Deployment
+
+    os.mkdir("components/broken")
+    with open("components/broken/component.py", "w") as f:
+        f.write(
+            """\
+from batou import ConfigurationError
+from batou.component import Component
+
+
+class Broken(Component):
+    def configure(self):
+        self.log("Configuring")
+        raise ConfigurationError.from_context("broken")
+"""
+        )
+    os.mkdir("environments/local-check")
+    with open("environments/local-check/environment.cfg", "w") as f:
+        f.write(
+            """\
+[environment]
+connect_method = local
+
+[hosts]
+host1 = hello1
+host2 = broken
+"""
+        )
+    deployment = Deployment(
+        "local-check",
+        None,
+        None,
+        False,
+        1,
+        consistency_only=True,
+        check_and_predict_local=True,
+    )
+    deployment.check_workers = 2
+    deployment.load()
+    with pytest.raises(ConfigureErrors) as e:
+        deployment.connect()
+    assert len(deployment.connections) == 2
+    assert e.value.all_reporting_hostnames == {"host1", "host2"}
+    # Both hosts were configured and report the same errors.
+    for reporting_hostnames, _, error in e.value.errors:
+        assert reporting_hostnames == {"host1", "host2"}
+    assert e.value.errors[0][2].message == "broken"
+
+
+def test_local_check_sets_up_hosts_like_local_host(monkeypatch):
+    from batou import remote_core
+    from batou.deploy import configure_locally
+    from batou.host import LocalHost
+
+    host = LocalHost("host1", mock.Mock(hostname_mapping={}, provisioners={}))
+    host.rpc = mock.Mock()
+    host.start()
+    assert [call[:2] for call in host.rpc.method_calls] == host.setup_calls()
+
+    worker_calls = []
+
+    def record(name):
+        def call(*args):
+            worker_calls.append((name, args))
+            return name
+
+        return call
+
+    monkeypatch.setattr(remote_core, "channel", None)
+    for name, _ in host.setup_calls():
+        monkeypatch.setattr(remote_core, name, record(name))
+    result, messages = configure_locally("host1", host.setup_calls())
+    assert worker_calls == host.setup_calls()
+    assert result == "setup_deployment"
+    assert messages == []
+
+
+def test_prefix_backend_prefixes_all_output():
+    from batou._output import PrefixBackend, TestBackend
+
+    backend = TestBackend()
+    prefixed = PrefixBackend(backend, "staging")
+    prefixed.line("one\ntwo")
+    prefixed.write("three\nfour\n")
+    prefixed.sep("=", "Summary")
+    assert backend.output == (
+        "staging: one\nstaging: two\n"
+        "staging: three\nstaging: four\n\n"
+        " === staging: Summary === "
+    )
+
+
+def test_verify_repositories_verifies_shared_repository_once(output):
+    from batou.deploy import verify_repositories
+
+    repository = mock.Mock()
+    repository.root = "/srv/deployment"
+    repository.branch = "main"
+    deployments = []
+    for name in ["staging", "production"]:
+        deployment = mock.Mock()
+        deployment.environment.name = name
+        deployment.environment.repository_url = None
+        deployment.environment.load_repository.return_value = repository
+        deployments.append(deployment)
+    verify_repositories(deployments)
+    assert repository.verify.call_count == 1
+    assert "staging: Verifying repository" in output.backend.output
+    assert "production: Verifying repository" not in output.backend.output
+
+
+def test_line_writer_passes_on_complete_lines_only():
+    import io
+
+    from batou._output import LineWriter
+
+    file = io.StringIO()
+    writer = LineWriter(file)
+    writer.write("one")
+    writer.flush()
+    assert file.getvalue() == ""
+    writer.write("\ntwo\nthr")
+    assert file.getvalue() == "one\ntwo\n"
@@ -447,6 +447,19 @@ Consistency check took total=...s
     )
 
 
+def test_check_consistency_works_for_several_environments():
+    os.chdir("examples/tutorial-secrets")
+    out, _ = cmd("./batou deploy tutorial gocept --consistency-only --local")
+    lines = out.splitlines()
+    # Both environments use the same repository.
+    assert "🔍 tutorial: Verifying repository ..." in lines
+    assert "🔍 gocept: Verifying repository ..." not in lines
+    for name in ["tutorial", "gocept"]:
+        assert f"{name}: 🔑 main: Loading secrets ..." in lines
+        assert f"{name}: Consistency check took total=" in out
+    assert lines[-1].strip("= ") == "CONSISTENCY CHECK (local) FINISHED"
+
+
 def test_predicting_deployment_works_with_local():
     os.chdir("examples/tutorial-secrets")
     out, _ = cmd("./batou deploy gocept --predict-only --local")
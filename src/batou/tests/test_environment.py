@@ -351,3 +351,62 @@ def test_environment_with_check_local_does_not_load_provisioners(
     e.load()
 
     assert not e.provisioners
+
+
+def test_render_contents_only_renders_roots_of_deploying_host():
+    from batou.lib.file import Content
+
+    e = Environment("name")
+    contents = {}
+    for hostname in ["foo", "bar"]:
+        root = Mock(ignore=False)
+        root.host.name = hostname
+        root.host.ignore = False
+        contents[hostname] = Mock(spec=Content)
+        root.component.recursive_sub_components = [contents[hostname]]
+        e.root_components.append(root)
+
+    e.deployment = Mock(host_name="foo")
+    assert e.render_contents() == []
+    assert contents["foo"].render_content.called
+    assert not contents["bar"].render_content.called
+
+    contents["foo"].render_content.side_effect = batou.TemplatingError("asdf")
+    e.deployment = None
+    errors = e.render_contents()
+    assert len(errors) == 1
+    assert isinstance(errors[0], batou.TemplatingError)
+    assert contents["bar"].render_content.called
+
+
+def test_resolver_cache_is_stored_with_ttl(tmpdir, monkeypatch):
+    e = Environment("name", basedir=str(tmpdir))
+    e.resolver_cache_ttl = "60"
+    monkeypatch.setitem(batou.utils.resolve_cache, "a.example.com", "1.2.3.4")
+    monkeypatch.setitem(batou.utils.resolve_v6_cache, "a.example.com", "::1")
+    monkeypatch.setitem(
+        batou.utils.resolve_cache, "b.example.com", OSError("failed")
+    )
+    e.save_resolver_cache()
+    assert tmpdir.join(".batou").listdir() == [
+        tmpdir.join(".batou", "resolver-cache-name.json")
+    ]
+
+    batou.utils.resolve_cache.clear()
+    batou.utils.resolve_v6_cache.clear()
+    e.load_resolver_cache()
+    assert batou.utils.resolve_cache == {"a.example.com": "1.2.3.4"}
+    assert batou.utils.resolve_v6_cache == {"a.example.com": "::1"}
+
+    batou.utils.resolve_cache.clear()
+    batou.utils.resolve_v6_cache.clear()
+    monkeypatch.setattr("time.time", lambda: 2e9)
+    e.load_resolver_cache()
+    assert batou.utils.resolve_cache == {}
+
+
+def test_resolver_cache_is_not_stored_without_ttl(tmpdir):
+    e = Environment("name", basedir=str(tmpdir))
+    batou.utils.resolve_cache["a.example.com"] = "1.2.3.4"
+    e.save_resolver_cache()
+    assert not tmpdir.join(".batou").exists()
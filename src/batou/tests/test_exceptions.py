@@ -81,3 +81,25 @@ def test_configurationerrors_can_be_sorted(root):
     errors.append(InvalidIPAddressError.from_context(("127.0.0.256/24")))
 
     errors.sort(key=lambda x: x.sort_key)
+
+
+def test_merge_key_ignores_affected_hostname():
+    errors = []
+    for hostname in ["host1", "host2"]:
+        error = ConfigurationError.from_context("asdf")
+        error.data = {"key": [1, {2}]}
+        error.affected_hostname = hostname
+        errors.append(error)
+    assert errors[0].merge_key() == errors[1].merge_key()
+    assert errors[0].should_merge(errors[1])
+
+    other = ConfigurationError.from_context("asdf")
+    other.data = {"key": [1, {3}]}
+    assert other.merge_key() != errors[0].merge_key()
+    assert not other.should_merge(errors[0])
+
+
+def test_merge_key_is_none_for_unhashable_attributes():
+    error = ConfigurationError.from_context("asdf")
+    error.data = bytearray(b"asdf")
+    assert error.merge_key() is None
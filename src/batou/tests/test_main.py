@@ -1,8 +1,10 @@
+import subprocess
+import sys
 from unittest import mock
 
 import pytest
 
-from ..main import main
+from ..main import Command, main
 
 
 def test_main__main__1(tmp_path, monkeypatch, capsys):
@@ -46,3 +48,78 @@ def test_main__main__3(tmp_path, monkeypatch, capsys):
         output = std.out if std.out else std.err
         assert output.startswith("usage:")
         assert joined in output
+
+
+# Import time budget for `batou.main` in microseconds. This is generous
+# compared to the actual timing (well below 100ms) to avoid flakiness on busy
+# machines but catches regressions like importing the deployment machinery
+# up front.
+STARTUP_BUDGET = 500_000
+
+
+def _import_batou_main(*options):
+    return subprocess.run(
+        [
+            sys.executable,
+            *options,
+            "-c",
+            "import sys, batou.main; print(*sys.modules)",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+
+
+def test_main__import__1():
+    """It does not import subcommand modules when being imported."""
+    modules = set(_import_batou_main().stdout.split())
+    assert "batou.main" in modules
+    for name in [
+        "batou.component",
+        "batou.deploy",
+        "batou.environment",
+        "batou.host",
+        "batou.secrets",
+        "batou.template",
+        "batou.utils",
+        "configupdater",
+        "execnet",
+        "jinja2",
+        "requests",
+        "yaml",
+    ]:
+        assert name not in modules
+
+
+@pytest.mark.slow
+def test_main__import__2():
+    """It imports within the startup time budget."""
+    timings = []
+    for _ in range(3):
+        result = _import_batou_main("-X", "importtime")
+        last = result.stderr.strip().splitlines()[-1]
+        assert last.endswith("| batou.main")
+        timings.append(int(last.split("|")[1]))
+    assert min(timings) < STARTUP_BUDGET
+
+
+def test_main__main__4(tmp_path, monkeypatch):
+    """It imports the subcommand module only when dispatching to it."""
+    monkeypatch.setenv("APPENV_BASEDIR", str(tmp_path))
+    monkeypatch.setattr("batou.migrate.assert_up_to_date", lambda: True)
+    with mock.patch("batou.deploy.main", spec=True) as deploy_main:
+        main(["deploy", "test.cfg", "production"])
+    assert deploy_main.call_args.kwargs["environment"] == [
+        "test",
+        "production",
+    ]
+
+
+def test_main__Command__1():
+    """It resolves the referenced function on load."""
+    import batou.migrate
+
+    command = Command("batou.migrate:main")
+    assert command.__name__ == "main"
+    assert command.load() is batou.migrate.main
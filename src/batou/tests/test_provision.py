@@ -68,3 +68,36 @@ def test_fc_dev_vm_provisioner_from_config_without_disk_size():
     assert provisioner.memory == "8192"
     assert provisioner.cores == "1"
     assert provisioner.disk_size is None
+
+
+def test_fc_dev_vm_prepares_ssh_for_parallel_hosts(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    import mock
+
+    from batou.provision import FCDevVM
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    provisioner = FCDevVM("dev")
+    provisioner.target_host = "vmhost"
+    hosts = []
+    for i in range(20):
+        host = mock.Mock()
+        host.name = f"host{i}"
+        host._aliases = []
+        host.environment.name = "dev"
+        hosts.append(host)
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        list(pool.map(provisioner._prepare_ssh, hosts))
+    config = (tmp_path / "ssh_config_dev").read_text()
+    for host in hosts:
+        assert f"Host {host.name} " in config
+    key = tmp_path / "insecure-private.key"
+    assert key.stat().st_mode & 0o777 == 0o600
+    # No temporary files are left behind.
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        ".batou",
+        "insecure-private.key",
+        "ssh_config_dev",
+    ]
@@ -1,8 +1,11 @@
 import os
+import pickle
 
 import mock
 import pytest
 
+import batou.utils
+from batou import remote_core
 from batou.deploy import Deployment
 from batou.environment import Environment
 from batou.host import RemoteHost
@@ -47,3 +50,46 @@ def test_remotehost_start(sample_service):
     h.rpc = mock.Mock()
     h.rpc.ensure_base.return_value = "/tmp"
     h.start()
+
+
+def test_remotehost_start_skips_build_if_appenv_is_current(sample_service):
+    env = Environment("test-with-env-config")
+    env.load()
+    env.configure()
+    h = RemoteHost("asdf", env)
+    h.connect = mock.Mock()
+    h.rpc = mock.Mock()
+    h.rpc.ensure_base.return_value = "/tmp"
+    h.rpc.appenv_built.return_value = remote_core.appenv_fingerprint(
+        env.base_dir
+    )
+    h.start()
+    assert not h.rpc.build_batou.called
+
+    h.rpc.appenv_built.return_value = None
+    h.start()
+    assert h.rpc.build_batou.called
+
+
+def test_remotehost_pushes_artifacts_from_controller(sample_service, tmpdir):
+    from batou.lib.download import ArtifactStore
+
+    source = tmpdir / "artifact"
+    source.write_binary(b"asdf" * 10)
+    key = "md5:" + batou.utils.hash(str(source), "md5")
+    env = Environment("test-with-env-config")
+    env.load()
+    env.configure()
+    env.artifact_cache = "controller"
+    remote = ArtifactStore(str(tmpdir / "remote"))
+    h = RemoteHost("asdf", env)
+    h.connect = mock.Mock()
+    h.rpc = mock.Mock()
+    h.rpc.ensure_base.return_value = "/tmp"
+    h.rpc.setup_deployment.return_value = pickle.dumps([])
+    h.rpc.missing_artifacts.return_value = [("file://" + str(source), key)]
+    h.rpc.receive_artifact.side_effect = remote.receive
+    h.rpc.commit_artifact.side_effect = remote.commit
+    h.start()
+    assert key in env.artifacts
+    assert key in remote
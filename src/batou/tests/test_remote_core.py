@@ -125,6 +125,33 @@ def test_build_batou_virtualenv_exists(mock_remote_core, tmpdir):
     assert next(calls) == "./batou --help"
 
 
+def test_build_batou_records_fingerprint(mock_remote_core, tmpdir):
+    remote_core.ensure_repository(str(tmpdir), "rsync")
+    base = remote_core.ensure_base("asdf")
+    with open(base + "/requirements.lock", "w") as f:
+        f.write("batou==2.8\n")
+    assert remote_core.appenv_built() is None
+    remote_core.build_batou()
+    # appenv did not signal a ready environment (the command is mocked)
+    assert remote_core.appenv_built() is None
+    os.makedirs(base + "/.appenv/current")
+    open(base + "/.appenv/current/appenv.ready", "w").close()
+    assert remote_core.appenv_built() == remote_core.appenv_fingerprint(base)
+
+
+def test_appenv_fingerprint_changes_with_lockfile(tmpdir):
+    base = str(tmpdir)
+    missing = remote_core.appenv_fingerprint(base)
+    with open(base + "/requirements.lock", "w") as f:
+        f.write("batou==2.8\n")
+    first = remote_core.appenv_fingerprint(base)
+    assert first != missing
+    assert first == remote_core.appenv_fingerprint(base)
+    with open(base + "/requirements.lock", "w") as f:
+        f.write("batou==2.9\n")
+    assert first != remote_core.appenv_fingerprint(base)
+
+
 def test_expand_deployment_base(tmpdir):
     with mock.patch("os.path.expanduser") as expanduser:
         expanduser.return_value = str(tmpdir)
@@ -347,3 +374,42 @@ def test_Deployment_sets_resolver_overrides(monkeypatch):
 
     assert batou.utils.resolve_override["asdf"] == "127.0.0.1"
     assert batou.utils.resolve_v6_override["asdf"] == "::1"
+
+
+def test_Deployment_uses_addresses_resolved_by_controller(monkeypatch):
+    monkeypatch.chdir("examples/tutorial-helloworld")
+    monkeypatch.setattr(
+        "socket.getaddrinfo", mock.Mock(side_effect=AssertionError)
+    )
+
+    dep = remote_core.Deployment(
+        env_name="tutorial",
+        host_name="localhost",
+        overrides={},
+        resolve_override={},
+        resolve_v6_override={},
+        secret_files=None,
+        secret_data=None,
+        host_data={},
+        timeout=None,
+        platform=None,
+        resolve_cache={"localhost": "127.0.0.1"},
+    )
+    dep.load()
+
+    assert batou.utils.resolve("localhost") == "127.0.0.1"
+
+
+def test_output_prefix_is_local_to_the_thread():
+    import threading
+
+    backend = mock.Mock()
+    output = remote_core.Output(backend)
+    with output.prefix("host1"):
+        output.line("one\ntwo")
+        thread = threading.Thread(target=output.line, args=("other",))
+        thread.start()
+        thread.join()
+    output.line("three")
+    lines = [call.args[0] for call in backend.line.call_args_list]
+    assert lines == ["host1: one\nhost1: two", "other", "three"]
@@ -89,3 +89,29 @@ def test_jinja2_unknown_variable_should_fail():
 def test_jinja2_umlaut_variables():
     tmpl = TemplateEngine.get("jinja2")
     assert "hello wörld" == tmpl.expand("hello {{hello2}}", sample_dict)
+
+
+def test_jinja2_compiles_templates_once():
+    first = TemplateEngine.get("jinja2")
+    second = TemplateEngine.get("jinja2")
+    template = "compiled once {{hello}}"
+    with mock.patch.object(
+        first.env, "compile", wraps=first.env.compile
+    ) as compile:
+        assert "compiled once world" == first.expand(template, sample_dict)
+        assert "compiled once world" == second.expand(template, sample_dict)
+        assert "compiled once world" == first.expand(
+            template, sample_dict, identifier="other"
+        )
+    assert compile.call_count == 2
+
+
+def test_jinja2_cached_templates_keep_their_identifier():
+    from batou.template import _compile
+
+    tmpl = TemplateEngine.get("jinja2")
+    template = "identified {{hello}}"
+    tmpl.expand(template, sample_dict, identifier="first.txt")
+    tmpl.expand(template, sample_dict, identifier="second.txt")
+    assert _compile(template, "first.txt").filename == "first.txt"
+    assert _compile(template, "second.txt").filename == "second.txt"
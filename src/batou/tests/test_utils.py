@@ -1,7 +1,10 @@
 import os
 import socket
+import subprocess
+import sys
 import tempfile
 import threading
+import time
 import unittest
 from io import StringIO
 
@@ -9,11 +12,14 @@ import mock
 import pytest
 
 import batou
+import batou.utils
 from batou.utils import (
     Address,
     CmdExecutionError,
+    CycleError,
     MultiFile,
     NetLoc,
+    StatCache,
     call_with_optional_args,
     cmd,
     flatten,
@@ -22,10 +28,12 @@ from batou.utils import (
     locked,
     notify,
     notify_macosx,
-    remove_nodes_without_outgoing_edges,
+    prefetch_addresses,
     resolve,
     resolve_v6,
+    resolved_addresses,
     revert_graph,
+    strongly_connected_components,
     topological_sort,
 )
 
@@ -125,6 +133,60 @@ selected (v6) foo.example.com, 2a02::1
     )  # noqa: E501 line too long
 
 
+@mock.patch("socket.getaddrinfo")
+def test_resolve_caches_addresses(gai):
+    gai.return_value = [(None, None, None, None, ("1.2.3.4", None))]
+    assert resolve("foo.example.com", 80) == "1.2.3.4"
+    assert resolve("foo.example.com", 443) == "1.2.3.4"
+    assert Address("foo.example.com:22").listen.host == "1.2.3.4"
+    assert gai.call_count == 1
+
+
+@mock.patch("socket.getaddrinfo", side_effect=socket.gaierror("failed"))
+def test_resolve_caches_failed_lookups(gai):
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            resolve("foo.example.com")
+    assert gai.call_count == 1
+    assert resolved_addresses(batou.utils.resolve_cache) == {}
+
+
+@mock.patch("socket.getaddrinfo", side_effect=socket.gaierror("failed"))
+def test_resolve_retries_failed_lookups_after_ttl(gai, monkeypatch):
+    with pytest.raises(socket.gaierror):
+        resolve("foo.example.com")
+    now = time.monotonic() + batou.utils.FAILED_LOOKUP_TTL
+    monkeypatch.setattr("time.monotonic", lambda: now)
+    gai.side_effect = None
+    gai.return_value = [(None, None, None, None, ("1.2.3.4", None))]
+    assert resolve("foo.example.com") == "1.2.3.4"
+    assert gai.call_count == 2
+
+
+def test_prefetch_addresses_fills_caches(monkeypatch):
+    def getaddrinfo(host, port, family):
+        if host == "unknown.example.com":
+            raise socket.gaierror("failed")
+        if family == socket.AF_INET6:
+            return [(None, None, None, None, ("::1", port, None, None))]
+        return [(None, None, None, None, ("127.0.0.1", port))]
+
+    gai = mock.Mock(side_effect=getaddrinfo)
+    monkeypatch.setattr(socket, "getaddrinfo", gai)
+    monkeypatch.setitem(batou.utils.resolve_override, "pinned", "1.2.3.4")
+    prefetch_addresses(
+        ["a.example.com", "b.example.com", "unknown.example.com", "pinned"],
+        v6=True,
+    )
+    assert gai.call_count == 7
+    assert resolved_addresses(batou.utils.resolve_cache) == {
+        "a.example.com": "127.0.0.1",
+        "b.example.com": "127.0.0.1",
+    }
+    assert resolve_v6("a.example.com") == "::1"
+    assert gai.call_count == 7
+
+
 def test_address_without_implicit_or_explicit_port_fails():
     with pytest.raises(ValueError):
         Address("localhost")
@@ -412,17 +474,71 @@ def test_topological_sort_raises_on_loop():
         topological_sort(graph)
 
 
+def test_topological_sort_reports_shortest_cycles():
+    graph = {
+        1: {2},
+        2: {3, 4},
+        3: {4},
+        4: {2, 5},
+        5: set(),
+        6: {6},
+        7: {1},
+    }
+    with pytest.raises(CycleError) as e:
+        topological_sort(graph)
+    assert e.value.cycles == [[2, 4], [6]]
+    assert e.value.args[0] == {2: {4}, 4: {2}, 6: {6}}
+
+
+def test_topological_sort_reverse_returns_dependencies_first():
+    graph = {1: {2, 3}, 2: {3}, 4: set()}
+    assert [4, 3, 2, 1] == topological_sort(graph, reverse=True)
+    # The graph is left alone.
+    assert graph == {1: {2, 3}, 2: {3}, 4: set()}
+
+
+def test_strongly_connected_components():
+    graph = {1: {2}, 2: {1, 3}, 3: {4}, 4: {3}, 5: set()}
+    components = strongly_connected_components(graph)
+    assert [{3, 4}, {1, 2}, {5}] == [set(c) for c in components]
+
+
+@pytest.mark.parametrize("shape", ["chain", "layers", "star"])
+def test_topological_sort_benchmark_10k_nodes(shape):
+    size = 10000
+    if shape == "chain":
+        graph = {i: {i + 1} for i in range(size - 1)}
+    elif shape == "layers":
+        # 100 layers of 100 nodes, each depending on all of the next layer.
+        graph = {
+            i: set(range((i // 100 + 1) * 100, (i // 100 + 2) * 100))
+            for i in range(size - 100)
+        }
+    else:
+        graph = {0: set(range(1, size))}
+    start = time.perf_counter()
+    order = topological_sort(graph)
+    duration = time.perf_counter() - start
+    assert len(order) == size
+    position = {node: i for i, node in enumerate(order)}
+    for node, dependencies in graph.items():
+        for dependency in dependencies:
+            assert position[node] < position[dependency]
+    # Generous bound: catches quadratic behaviour, not slow machines.
+    assert duration < 10
+
+    graph[size - 1] = {0}
+    start = time.perf_counter()
+    with pytest.raises(CycleError):
+        topological_sort(graph)
+    assert time.perf_counter() - start < 10
+
+
 def test_topological_sort_with_single_item():
     graph = {1: set()}
     assert [1] == topological_sort(graph)
 
 
-def test_graph_remove_leafs():
-    graph = {1: [1], 2: []}
-    remove_nodes_without_outgoing_edges(graph)
-    assert graph == {1: [1]}
-
-
 class Checksum(unittest.TestCase):
     fixture = os.path.join(
         os.path.dirname(__file__), "fixture", "component", "haproxy.cfg"
@@ -476,6 +592,40 @@ def test_cmd_returns_process_if_no_communicate(popen):
     assert p is process
 
 
+def test_cmd_stream_forwards_lines_and_keeps_tail(output, monkeypatch):
+    monkeypatch.setattr(output, "enable_debug", False)
+    monkeypatch.setattr(batou.utils, "STREAM_TAIL", 3)
+    stdout, stderr = cmd(
+        "for i in 1 2 3 4 5; do echo out$i; done; echo err >&2; printf end",
+        stream=True,
+    )
+    assert stdout == "out4\nout5\nend"
+    assert stderr == "err\n"
+    lines = output.backend.output.splitlines()
+    assert lines[:5] == ["out1", "out2", "out3", "out4", "out5"]
+    assert set(lines[5:]) == {"err", "end"}
+
+
+def test_cmd_stream_writes_log_and_reports_it(output, tmpdir):
+    log = str(tmpdir / "build.log")
+    with pytest.raises(CmdExecutionError) as e:
+        cmd("seq 1 1000; echo failed >&2; exit 2", stream=True, log=log)
+    assert e.value.returncode == 2
+    assert e.value.stdout.splitlines() == [str(i) for i in range(901, 1001)]
+    assert e.value.stderr == "failed\n"
+    assert e.value.log == log
+    with open(log) as f:
+        assert len(f.read().splitlines()) == 1001
+    e.value.report()
+    assert "for the full output." in output.backend.output
+
+
+def test_cmd_stream_silent_does_not_forward(output, monkeypatch):
+    monkeypatch.setattr(output, "enable_debug", False)
+    assert cmd("echo 1", stream=True, silent=True) == ("1\n", "")
+    assert output.backend.output == ""
+
+
 def test_call_with_optional_args():
     def foo():
         return 1
@@ -559,3 +709,52 @@ export NONCE_SALT=';FY@_]@c.yiSc+<Q&&YylX8*>iDr7VG5U64/jgoL.$VegW$daH`We _|Q9s~g
 export SECURE_AUTH_KEY='QXVjV-D(~RGX"Rhx(OPr3<j)F}>n4<A .;Ki5hrW}QbPl8%Tv:_$2t+:;}9~bw2SY'
 export SECURE_AUTH_SALT='Vy|F(qC=,Rh61%~A=3>76k5cgpWXZJd/-YiFwx2uacUTWB~F{?Hr::CL%e>AwE-W'"""
     )
+
+
+def test_stat_cache_invalidates_path_children_and_parents(tmpdir):
+    cache = StatCache()
+    paths = [
+        str(tmpdir),
+        str(tmpdir / "a"),
+        str(tmpdir / "a" / "b"),
+        str(tmpdir / "ab"),
+    ]
+    for path in paths:
+        cache.stat(path)
+        cache.lstat(path)
+    assert cache.stat(paths[1]) is None
+    cache.invalidate(paths[1])
+    assert set(cache.stats) == set(cache.lstats) == {paths[3]}
+    cache.invalidate()
+    assert not cache.stats
+
+
+def test_stat_cache_indexes_paths_cached_again_after_invalidation(tmpdir):
+    cache = StatCache()
+    parent, child = str(tmpdir / "a"), str(tmpdir / "a" / "b" / "c")
+    cache.stat(child)
+    cache.invalidate(parent)
+    assert not cache.stats
+    cache.stat(child)
+    cache.stat(str(tmpdir / "d"))
+    cache.invalidate(parent)
+    assert set(cache.stats) == {str(tmpdir / "d")}
+    assert parent not in cache.children
+
+
+def test_shared_files_locked_excludes_other_processes(tmp_path):
+    script = (
+        "import sys, time, batou.utils\n"
+        "with batou.utils.shared_files_locked(sys.argv[1]):\n"
+        "    print('locked', flush=True)\n"
+        "    time.sleep(0.5)\n"
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-c", script, str(tmp_path)], stdout=subprocess.PIPE
+    )
+    assert process.stdout.readline() == b"locked\n"
+    started = time.monotonic()
+    with batou.utils.shared_files_locked(str(tmp_path)):
+        assert time.monotonic() - started > 0.2
+    process.wait()
+    process.stdout.close()
@@ -1,18 +1,24 @@
+import concurrent.futures
 import contextlib
 import copy
 import fcntl
 import functools
+import grp
 import hashlib
 import inspect
 import itertools
 import os
+import pwd
 import re
+import selectors
 import shlex
+import shutil
 import socket
 import subprocess
 import sys
+import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from typing import Optional
 
 from batou import (
@@ -98,6 +104,30 @@ def locked(filename, exit_on_failure=False):
         lockfile.truncate()
 
 
+# Held by the thread of this process that has the shared lock file.
+_shared_files_lock = threading.RLock()
+
+
+@contextlib.contextmanager
+def shared_files_locked(base_dir="."):
+    """Wait for exclusive access to the files that all environments of a
+    deployment share, e.g. the SSH key and config of provisioned hosts.
+
+    Environments that are deployed at the same time run in separate
+    processes, their threads all wait for `.batou/shared.lock`.
+
+    """
+    directory = os.path.join(base_dir, ".batou")
+    os.makedirs(directory, exist_ok=True)
+    with _shared_files_lock:
+        with open(os.path.join(directory, "shared.lock"), "a+") as lockfile:
+            fcntl.lockf(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lockfile, fcntl.LOCK_UN)
+
+
 def flatten(list_of_lists):
     return list(itertools.chain.from_iterable(list_of_lists))
 
@@ -128,21 +158,64 @@ def notify_none(title, description):
     pass
 
 
-try:
-    subprocess.check_output(["which", "osascript"], stderr=subprocess.STDOUT)
-    notify = notify_macosx
-except (subprocess.CalledProcessError, OSError):
-    try:
-        subprocess.check_output(
-            ["which", "notify-send"], stderr=subprocess.STDOUT
-        )
-        notify = notify_send
-    except (subprocess.CalledProcessError, OSError):
-        notify = notify_none
+@functools.lru_cache(maxsize=None)
+def notify_backend():
+    """Detect the notification backend on first use.
+
+    This is deferred from import time to keep the startup of the CLI
+    (and of the remote bootstrapping) free of extra subprocesses.
+
+    """
+    if shutil.which("osascript"):
+        return notify_macosx
+    if shutil.which("notify-send"):
+        return notify_send
+    return notify_none
+
+
+def notify(title, description):
+    notify_backend()(title, description)
+
 
 resolve_override = {}
 resolve_v6_override = {}
 
+# Addresses (or lookup errors) by host name. The caches are shared by all
+# configure passes and can be filled in advance (see `prefetch_addresses`).
+resolve_cache = {}
+resolve_v6_cache = {}
+
+PREFETCH_WORKERS = 16
+
+# Failed lookups tend to be slow, so they are cached as well. But only for a
+# few seconds: the name may become resolvable during a longer run.
+FAILED_LOOKUP_TTL = 10
+failed_lookups = {}
+
+
+def _cached_lookup(host, cache, version, lookup):
+    if (
+        isinstance(cache.get(host), Exception)
+        and failed_lookups.get((version, host), 0) <= time.monotonic()
+    ):
+        del cache[host]
+    if host in cache:
+        result = cache[host]
+        output.annotate(
+            "resolved ({}) `{}` to {} (cached)".format(version, host, result),
+            debug=True,
+        )
+    else:
+        try:
+            result = lookup()
+        except OSError as e:
+            result = e
+            failed_lookups[version, host] = time.monotonic() + FAILED_LOOKUP_TTL
+        cache[host] = result
+    if isinstance(result, Exception):
+        raise result
+    return result
+
 
 def resolve(host, port=0, resolve_override=resolve_override):
     if host in resolve_override:
@@ -151,7 +224,9 @@ def resolve(host, port=0, resolve_override=resolve_override):
             "resolved (v4) `{}` to {} (override)".format(host, address),
             debug=True,
         )
-    else:
+        return address
+
+    def lookup():
         output.annotate("resolving (v4) `{}`".format(host), debug=True)
         responses = socket.getaddrinfo(host, int(port), socket.AF_INET)
         output.annotate(
@@ -161,7 +236,9 @@ def resolve(host, port=0, resolve_override=resolve_override):
         output.annotate(
             "selected (v4) {}, {}".format(host, address), debug=True
         )
-    return address
+        return address
+
+    return _cached_lookup(host, resolve_cache, "v4", lookup)
 
 
 def resolve_v6(host, port=0, resolve_override=resolve_v6_override):
@@ -171,7 +248,9 @@ def resolve_v6(host, port=0, resolve_override=resolve_v6_override):
             "resolved (v6) `{}` to {} (override)".format(host, address),
             debug=True,
         )
-    else:
+        return address
+
+    def lookup():
         output.annotate("resolving (v6) `{}`".format(host), debug=True)
         responses = socket.getaddrinfo(host, int(port), socket.AF_INET6)
         output.annotate(
@@ -189,7 +268,50 @@ def resolve_v6(host, port=0, resolve_override=resolve_v6_override):
         output.annotate(
             "selected (v6) {}, {}".format(host, address), debug=True
         )
-    return address
+        return address
+
+    return _cached_lookup(host, resolve_v6_cache, "v6", lookup)
+
+
+def resolved_addresses(cache):
+    """Return the hosts of a resolver cache that were resolved successfully.
+
+    Failed lookups are not passed on as they may succeed elsewhere.
+
+    """
+    return {
+        host: address
+        for host, address in cache.items()
+        if not isinstance(address, Exception)
+    }
+
+
+def prefetch_addresses(hosts, v4=True, v6=False):
+    """Resolve `hosts` in parallel to fill the resolver caches.
+
+    Errors are ignored here, they are reported when an address is used.
+
+    """
+
+    def prefetch(resolve, host):
+        try:
+            resolve(host)
+        except Exception:
+            pass
+
+    jobs = []
+    for host in sorted(set(hosts)):
+        if v4 and host not in resolve_override:
+            jobs.append((resolve, host))
+        if v6 and host not in resolve_v6_override:
+            jobs.append((resolve_v6, host))
+    if not jobs:
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(PREFETCH_WORKERS, len(jobs))
+    ) as pool:
+        for job in jobs:
+            pool.submit(prefetch, *job)
 
 
 ADDR_DEFAULT = object()  # sentinel
@@ -410,6 +532,17 @@ def ensure_graph_data(graph):
 
 
 class CycleError(ValueError):
+    """The graph contains cycles.
+
+    The first argument maps the nodes of the (shortest) cycles to the nodes
+    they depend on, the second argument lists the cycles.
+
+    """
+
+    @property
+    def cycles(self):
+        return self.args[1] if len(self.args) > 1 else []
+
     def __str__(self):
         message = []
         components = list(self.args[0].items())
@@ -421,43 +554,165 @@ class CycleError(ValueError):
         return "\n".join(message)
 
 
-def remove_nodes_without_outgoing_edges(graph):
-    for node, dependencies in list(graph.items()):
-        if not dependencies:
-            del graph[node]
-
+def _intern_graph(graph):
+    """Return the nodes of `graph` as a list and its edges as lists of
+    node indexes.
 
-def topological_sort(graph):
-    # Take a directed graph and provide a topological sort of all nodes.
-    #
-    # The graph is given as
-    #
-    # {node: [dependency, dependency], ...}
-    #
-    # If the graph has cycles a CycleError will be raised.
+    Nodes are numbered in the order in which they appear in the graph.
 
-    graph = ensure_graph_data(graph)
-    sorted = []
-    reverse_graph = revert_graph(graph)
-    roots = [
-        node for node, incoming in list(reverse_graph.items()) if not incoming
+    """
+    nodes = list(graph)
+    ids = {node: i for i, node in enumerate(nodes)}
+    for dependencies in graph.values():
+        for dependency in dependencies:
+            if dependency not in ids:
+                ids[dependency] = len(nodes)
+                nodes.append(dependency)
+    edges = [[] for _ in nodes]
+    for node, dependencies in graph.items():
+        edges[ids[node]] = [ids[dependency] for dependency in dependencies]
+    return nodes, edges
+
+
+def _reverse_edges(edges):
+    reverse = [[] for _ in edges]
+    for node, targets in enumerate(edges):
+        for target in targets:
+            reverse[target].append(node)
+    return reverse
+
+
+def _strongly_connected_components(edges, candidates):
+    """Tarjan's algorithm (without recursion) restricted to the node indexes
+    in `candidates`."""
+    candidates = set(candidates)
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for start in sorted(candidates):
+        if start in index:
+            continue
+        work = [(start, 0)]
+        while work:
+            node, position = work.pop()
+            if not position:
+                index[node] = lowlink[node] = len(index)
+                stack.append(node)
+                on_stack.add(node)
+            targets = edges[node]
+            while position < len(targets):
+                target = targets[position]
+                position += 1
+                if target not in candidates:
+                    continue
+                if target not in index:
+                    work.append((node, position))
+                    work.append((target, 0))
+                    break
+                if target in on_stack:
+                    lowlink[node] = min(lowlink[node], index[target])
+            else:
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+    return components
+
+
+def _shortest_cycle(edges, component):
+    """Return the shortest cycle through the first node of a strongly
+    connected component or `None` if it has no cycle."""
+    members = set(component)
+    start = min(component)
+    parents = {start: None}
+    queue = deque([start])
+    while queue:
+        node = queue.popleft()
+        for target in edges[node]:
+            if target == start:
+                cycle = [node]
+                while cycle[-1] != start:
+                    cycle.append(parents[cycle[-1]])
+                return cycle[::-1]
+            if target in members and target not in parents:
+                parents[target] = node
+                queue.append(target)
+    return None
+
+
+def strongly_connected_components(graph):
+    """Return the strongly connected components of `graph` as lists of
+    nodes (in reverse topological order of the components)."""
+    nodes, edges = _intern_graph(graph)
+    return [
+        [nodes[i] for i in component]
+        for component in _strongly_connected_components(
+            edges, range(len(nodes))
+        )
     ]
-    while roots:
-        root = roots.pop()
-        sorted.append(root)
-        for node in list(graph[root]):
-            graph[root].remove(node)
-            reverse_graph[node].remove(root)
-            if not reverse_graph[node]:
-                roots.append(node)
-    if any(graph.values()):
-        # Simplify the graph a bit to make it easier to spot the cycle.
-        remove_nodes_without_outgoing_edges(graph)
-        raise CycleError(dict(graph))
-    return sorted
+
+
+def topological_sort(graph, reverse=False):
+    """Return the nodes of a directed graph in topological order.
+
+    The graph is given as
+
+    {node: [dependency, dependency], ...}
+
+    and nodes are returned before their dependencies, or after them if
+    `reverse` is true. Nodes without an order between them keep the order
+    in which they appear in the graph. The graph is not modified.
+
+    If the graph has cycles a CycleError listing the shortest cycle of each
+    strongly connected component is raised.
+
+    """
+    nodes, dependencies = _intern_graph(graph)
+    edges = _reverse_edges(dependencies) if reverse else dependencies
+    in_degree = [0] * len(nodes)
+    for targets in edges:
+        for target in targets:
+            in_degree[target] += 1
+    ready = deque(i for i, degree in enumerate(in_degree) if not degree)
+    order = []
+    while ready:
+        node = ready.popleft()
+        order.append(node)
+        for target in edges[node]:
+            in_degree[target] -= 1
+            if not in_degree[target]:
+                ready.append(target)
+    if len(order) < len(nodes):
+        remaining = [i for i, degree in enumerate(in_degree) if degree]
+        cycles = []
+        for component in _strongly_connected_components(
+            dependencies, remaining
+        ):
+            cycle = _shortest_cycle(dependencies, component)
+            if cycle:
+                cycles.append([nodes[i] for i in cycle])
+        edges = {}
+        for cycle in cycles:
+            for node, dependency in zip(cycle, cycle[1:] + cycle[:1]):
+                edges.setdefault(node, set()).add(dependency)
+        raise CycleError(edges, cycles)
+    return [nodes[i] for i in order]
 
 
 class CmdExecutionError(DeploymentError, RuntimeError):
+    # Path of a file with the full output of a streamed command.
+    log = None
+
     def __init__(self, cmd, returncode, stdout, stderr):
         self.cmd = cmd
         self.returncode = returncode
@@ -472,11 +727,74 @@ class CmdExecutionError(DeploymentError, RuntimeError):
         output.annotate(self.stdout)
         output.line("STDERR", red=True)
         output.annotate(self.stderr)
+        if self.log:
+            output.line(f"see {self.log} for the full output.", red=True)
 
     def __str__(self):
         return f"Command {self.cmd} failed with return code {self.returncode}\n\nSTDOUT:\n{self.stdout}\n\nSTDERR:\n{self.stderr}"
 
 
+# Number of lines of each output stream that streamed commands keep for
+# error reports.
+STREAM_TAIL = 100
+
+# Pass on partial lines of streamed commands once they get this long.
+STREAM_LINE_LIMIT = 65536
+
+
+def stream_process(
+    process, silent=False, encoding="utf-8", tail=None, log=None
+):
+    """Forward the output of `process` line by line while it runs.
+
+    Only the last `tail` (default: `STREAM_TAIL`) lines of stdout and stderr
+    are kept in memory and returned. The full output is written to the file
+    `log` if given.
+
+    """
+    if tail is None:
+        tail = STREAM_TAIL
+    process.stdin.close()
+    tails = {
+        process.stdout: deque(maxlen=tail),
+        process.stderr: deque(maxlen=tail),
+    }
+    partial = {process.stdout: b"", process.stderr: b""}
+    selector = selectors.DefaultSelector()
+    for pipe in tails:
+        selector.register(pipe, selectors.EVENT_READ)
+    log_file = open(log, "w", encoding=encoding) if log else None
+    try:
+        while selector.get_map():
+            for key, _ in selector.select():
+                pipe = key.fileobj
+                data = os.read(key.fd, 65536)
+                if data:
+                    *lines, partial[pipe] = (partial[pipe] + data).split(b"\n")
+                    lines = [line + b"\n" for line in lines]
+                    if len(partial[pipe]) >= STREAM_LINE_LIMIT:
+                        lines.append(partial[pipe])
+                        partial[pipe] = b""
+                else:
+                    selector.unregister(pipe)
+                    lines = [partial[pipe]] if partial[pipe] else []
+                for line in lines:
+                    line = line.decode(encoding, errors="replace")
+                    tails[pipe].append(line)
+                    if log_file:
+                        log_file.write(line)
+                    if not silent:
+                        output.line(line.rstrip("\n"))
+    finally:
+        selector.close()
+        process.stdout.close()
+        process.stderr.close()
+        if log_file:
+            log_file.close()
+    process.wait()
+    return "".join(tails[process.stdout]), "".join(tails[process.stderr])
+
+
 def cmd(
     cmd,
     silent=False,
@@ -485,6 +803,8 @@ def cmd(
     env=None,
     acceptable_returncodes=[0],
     encoding="utf-8",
+    stream=False,
+    log=None,
 ):
     if not isinstance(cmd, str):
         # We use `shell=True`, so the command needs to be a single string and
@@ -512,16 +832,155 @@ def cmd(
     if not communicate:
         # XXX See #12550
         return process
-    stdout, stderr = process.communicate()
-    if encoding is not None:
-        stdout = stdout.decode(encoding, errors="replace")
-        stderr = stderr.decode(encoding, errors="replace")
+    if stream:
+        stdout, stderr = stream_process(
+            process, silent, encoding or "utf-8", log=log
+        )
+    else:
+        stdout, stderr = process.communicate()
+        if encoding is not None:
+            stdout = stdout.decode(encoding, errors="replace")
+            stderr = stderr.decode(encoding, errors="replace")
     if process.returncode not in acceptable_returncodes:
         if not ignore_returncode:
-            raise CmdExecutionError(cmd, process.returncode, stdout, stderr)
+            error = CmdExecutionError(cmd, process.returncode, stdout, stderr)
+            error.log = log
+            raise error
     return stdout, stderr
 
 
+class CmdCache(object):
+    """Remember the results of read-only commands on a host.
+
+    Results are shared until the cache is invalidated, which happens after
+    any component on the host was updated.
+
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def cmd(self, command, ignore_returncode=False, env=None):
+        key = (
+            command,
+            os.getcwd(),
+            tuple(sorted(env.items())) if env else (),
+        )
+        if key in self.results:
+            self.hits += 1
+            output.annotate("cmd (cached): {}".format(command), debug=True)
+        else:
+            self.misses += 1
+            try:
+                stdout, stderr = cmd(command, silent=True, env=env)
+                returncode = 0
+            except CmdExecutionError as e:
+                returncode, stdout, stderr = e.returncode, e.stdout, e.stderr
+            self.results[key] = (returncode, stdout, stderr)
+        returncode, stdout, stderr = self.results[key]
+        if returncode and not ignore_returncode:
+            raise CmdExecutionError(command, returncode, stdout, stderr)
+        return stdout, stderr
+
+    def invalidate(self):
+        self.results.clear()
+
+    def report(self, host):
+        total = self.hits + self.misses
+        if not total:
+            return
+        output.annotate(
+            "{}: {} of {} probes answered from cache ({:.0%})".format(
+                host, self.hits, total, self.hits / total
+            ),
+            debug=True,
+        )
+
+
+class StatCache(object):
+    """Remember file system metadata and user/group ids on a host.
+
+    Missing paths (or paths that can not be accessed) are remembered as
+    `None`. Entries are invalidated for single paths after components
+    changed them, or as a whole after any other component was updated.
+
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.lstats = {}
+        self.uids = {}
+        self.gids = {}
+        # The cached paths (and their parent directories) below each
+        # directory, to invalidate a subtree without scanning all entries.
+        self.children = {}
+
+    def _lookup(self, cache, func, path):
+        try:
+            return cache[path]
+        except KeyError:
+            pass
+        try:
+            result = func(path)
+        except OSError:
+            result = None
+        cache[path] = result
+        self._index(path)
+        return result
+
+    def _index(self, path):
+        parent = os.path.dirname(path)
+        while parent != path:
+            children = self.children.setdefault(parent, set())
+            if path in children:
+                break
+            children.add(path)
+            path, parent = parent, os.path.dirname(parent)
+
+    def stat(self, path):
+        return self._lookup(self.stats, os.stat, path)
+
+    def lstat(self, path):
+        return self._lookup(self.lstats, os.lstat, path)
+
+    def uid(self, name):
+        if name not in self.uids:
+            self.uids[name] = pwd.getpwnam(name).pw_uid
+        return self.uids[name]
+
+    def gid(self, name):
+        if name not in self.gids:
+            self.gids[name] = grp.getgrnam(name).gr_gid
+        return self.gids[name]
+
+    def invalidate(self, path=None):
+        """Forget everything or only about `path`, the paths below it, and
+        its parent directories."""
+        if path is None:
+            self.stats.clear()
+            self.lstats.clear()
+            self.uids.clear()
+            self.gids.clear()
+            self.children.clear()
+            return
+        parent = os.path.dirname(path)
+        self.children.get(parent, set()).discard(path)
+        while True:
+            self.stats.pop(parent, None)
+            self.lstats.pop(parent, None)
+            if parent == os.path.dirname(parent):
+                break
+            parent = os.path.dirname(parent)
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            self.stats.pop(path, None)
+            self.lstats.pop(path, None)
+            pending.extend(self.children.pop(path, ()))
+
+
 def get_output(command, default=None):
     stdout, stderr = cmd(command, ignore_returncode=True)  # type: ignore
     return stdout or default